@@ -0,0 +1,67 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Micro-benchmark: AppendOnlyDict._p_resolveConflict vs. bucket size
+
+Usage: bin/python benchmarks/bench_appendict.py [--sizes 100,1000] [-n 20]
+
+Each round resolves a conflict where committed and new each appended a
+few sessions to a bucket that already holds `size` sessions.
+"""
+import argparse
+import time
+
+from cipher.session.session import AppendOnlyDict
+
+
+def make_states(size, appended):
+    old = AppendOnlyDict()
+    for i in range(size):
+        old[('client-%d' % i, u'app.auth')] = 'pers_repr_%d' % i
+    committed = old.copy()
+    new = old.copy()
+    for i in range(appended):
+        committed[('committed-%d' % i, u'app.auth')] = 'c%d' % i
+        new[('new-%d' % i, u'app.auth')] = 'n%d' % i
+    return old.__getstate__(), committed.__getstate__(), new.__getstate__()
+
+
+def bench(size, appended, rounds):
+    old, committed, new = make_states(size, appended)
+    # resolution updates committed's data in place, give each round its own
+    committeds = [dict(committed, data=dict(committed['data']))
+                  for i in range(rounds)]
+    resolve = AppendOnlyDict()._p_resolveConflict
+    start = time.time()
+    for c in committeds:
+        resolve(old, c, new)
+    return (time.time() - start) / rounds
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='100,1000,10000,100000',
+                        help='comma separated bucket sizes')
+    parser.add_argument('--appended', type=int, default=3,
+                        help='sessions appended by each side')
+    parser.add_argument('-n', '--rounds', type=int, default=20)
+    options = parser.parse_args(argv)
+
+    print('%10s %14s' % ('size', 'usec/resolve'))
+    for size in [int(s) for s in options.sizes.split(',')]:
+        took = bench(size, options.appended, options.rounds)
+        print('%10d %14.1f' % (size, took * 1e6))
+
+
+if __name__ == '__main__':
+    main()
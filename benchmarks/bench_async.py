@@ -0,0 +1,182 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Benchmark: how long session access blocks an event loop
+
+Usage: bin/python benchmarks/bench_async.py [-n 2000] [--concurrency 20]
+           [--delay 1] [--workers 4]
+
+Runs requests that update the session of one of --clients visitors from a
+minimal event loop, either calling the SessionDataManager directly (sync)
+or through AsyncSession.  The FileStorage waits --delay milliseconds per
+load, like a storage server would.  Reports requests per second and how
+long single loop callbacks took: while one runs, the loop serves nobody.
+"""
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import transaction
+from ZODB.DB import DB
+from ZODB.FileStorage import FileStorage
+from ZODB.POSException import ConflictError
+
+from cipher.session.asyncsession import AsyncSession, SessionExecutor
+from cipher.session.session import SessionDataManager
+
+
+class SlowFileStorage(FileStorage):
+
+    delay = 0
+
+    def loadBefore(self, oid, tid):
+        time.sleep(self.delay)
+        return FileStorage.loadBefore(self, oid, tid)
+
+
+class Loop(object):
+    """Runs callbacks one at a time, in the thread calling run()"""
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        # seconds per callback
+        self.blocked = []
+
+    def call_soon_threadsafe(self, fn, *args):
+        self._queue.put((fn, args))
+
+    def run(self, until):
+        while not until():
+            fn, args = self._queue.get()
+            start = time.time()
+            fn(*args)
+            self.blocked.append(time.time() - start)
+
+
+def step(loop, gen, future=None, done=None):
+    """Resume the request gen with the result of future"""
+    try:
+        if future is None:
+            future = next(gen)
+        elif future.exception() is not None:
+            future = gen.throw(future.exception())
+        else:
+            future = gen.send(future.result())
+    except StopIteration:
+        done.append(1)
+        return
+    future.add_done_callback(
+        lambda f: loop.call_soon_threadsafe(step, loop, gen, f, done))
+
+
+def async_request(executor, client_id, conflicts):
+    while True:
+        session = AsyncSession(executor, client_id)
+        data = yield session.item(u'app')
+        data['hits'] = data.get('hits', 0) + 1
+        try:
+            yield session.commit()
+            return
+        except ConflictError:
+            # retried, like the publisher would
+            conflicts.append(1)
+
+
+def bench(mode, requests, concurrency, clients, delay, workers):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        storage = SlowFileStorage(os.path.join(tmpdir, 'Data.fs'))
+        # small caches, so requests load session data
+        db = DB(storage, cache_size=100)
+        conn = db.open()
+        conn.root()['sdm'] = sdm = SessionDataManager()
+        transaction.commit()
+        storage.delay = delay / 1000.0
+
+        rnd = random.Random(0)
+        loop = Loop()
+        done = []
+        conflicts = []
+        executor = None
+        if mode == 'async':
+            executor = SessionExecutor(
+                db, workers=workers,
+                getManager=lambda conn: conn.root()['sdm'])
+
+        def start():
+            client_id = 'client-%d' % rnd.randrange(clients)
+            if mode == 'sync':
+                data = sdm.get((client_id, u'app'))
+                data['hits'] = data.get('hits', 0) + 1
+                transaction.commit()
+                conn.cacheMinimize()
+                done.append(1)
+            else:
+                step(loop, async_request(executor, client_id, conflicts),
+                     done=done)
+
+        started = [0]
+
+        def until():
+            while (started[0] < requests
+                   and started[0] - len(done) < concurrency):
+                started[0] += 1
+                loop.call_soon_threadsafe(start)
+            return len(done) >= requests
+
+        begin = time.time()
+        loop.run(until)
+        took = time.time() - begin
+        if executor is not None:
+            executor.shutdown()
+        conn.close()
+        db.close()
+    finally:
+        shutil.rmtree(tmpdir)
+    blocked = sorted(loop.blocked)
+    return (requests / took, blocked[len(blocked) // 2] * 1000,
+            blocked[int(len(blocked) * 0.99)] * 1000, blocked[-1] * 1000,
+            len(conflicts))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--delay', type=float, default=1,
+                        help='milliseconds per storage load')
+    parser.add_argument('--workers', type=int, default=4)
+    options = parser.parse_args(argv)
+
+    print('%6s %12s %14s %14s %14s %10s' % (
+        'mode', 'requests/s', 'p50 block ms', 'p99 block ms',
+        'max block ms', 'conflicts'))
+    for mode in ('sync', 'async'):
+        rate, p50, p99, longest, conflicts = bench(
+            mode, options.requests, options.concurrency, options.clients,
+            options.delay, options.workers)
+        print('%6s %12.0f %14.2f %14.2f %14.2f %10d' % (
+            mode, rate, p50, p99, longest, conflicts))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Benchmark: session inserts into a single bucket vs. sharded buckets
+
+Usage: bin/python benchmarks/bench_buckets.py [-n 2000] [--shards 1,16,64]
+
+Every new session is committed in its own transaction, like a request of
+a new visitor, against a MappingStorage.  Reports inserts per second and
+the bytes written to the storage per commit.
+"""
+import argparse
+import time
+
+import transaction
+from ZODB.DB import DB
+from ZODB.MappingStorage import MappingStorage
+
+from cipher.session.session import SessionDataManager
+
+
+def written_bytes(storage):
+    return sum([len(record.data or b'')
+                for txn in storage.iterator() for record in txn])
+
+
+def bench(shards, sessions):
+    storage = MappingStorage()
+    db = DB(storage)
+    conn = db.open()
+    conn.root()['sdm'] = sdm = SessionDataManager(shards=shards)
+    transaction.commit()
+    before = written_bytes(storage)
+
+    start = time.time()
+    for i in range(sessions):
+        sdm.get(('client-%d' % i, u'app.auth'))['user'] = i
+        transaction.commit()
+    took = time.time() - start
+
+    per_commit = (written_bytes(storage) - before) / float(sessions)
+    conn.close()
+    db.close()
+    return sessions / took, per_commit
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--sessions', type=int, default=2000)
+    parser.add_argument('--shards', default='1,16,64',
+                        help='comma separated shard counts, 1 is unsharded')
+    options = parser.parse_args(argv)
+
+    print('%8s %12s %14s' % ('shards', 'inserts/s', 'bytes/commit'))
+    for shards in [int(s) for s in options.shards.split(',')]:
+        rate, per_commit = bench(shards, options.sessions)
+        print('%8d %12.0f %14.0f' % (shards, rate, per_commit))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Benchmark: bytes written per commit vs. CPU with compressed values
+
+Usage: bin/python benchmarks/bench_compression.py [-n 200]
+           [--thresholds 0,1024]
+
+Each commit changes a small value of session data that also holds a big
+payload (search result ids or wizard state), like a request that pages
+through search results would.  Reports the bytes the FileStorage grew by
+per commit, the CPU time per commit and the CPU time of loading the
+session data and reading the payload in a fresh connection.  Threshold 0
+is no compression.
+"""
+import argparse
+import os
+import shutil
+import tempfile
+
+import transaction
+from ZODB.DB import DB
+from ZODB.FileStorage import FileStorage
+
+from cipher.session.session import SessionDataManager
+
+PAYLOADS = {
+    'ids': lambda: list(range(100000, 105000)),
+    'wizard': lambda: dict([
+        ('field-%d' % i, u'Some answer to question %d of the wizard' % i)
+        for i in range(300)]),
+}
+
+
+def cpu():
+    return os.times()[0]
+
+
+def bench(payload, threshold, commits):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'Data.fs')
+        db = DB(FileStorage(path))
+        conn = db.open()
+        conn.root()['sdm'] = sdm = SessionDataManager()
+        sdm.compress_threshold = threshold or None
+        sdo = sdm.get('client')
+        sdo['payload'] = PAYLOADS[payload]()
+        transaction.commit()
+
+        size = os.path.getsize(path)
+        start = cpu()
+        for i in range(commits):
+            sdo['page'] = i
+            transaction.commit()
+        took = cpu() - start
+        written = os.path.getsize(path) - size
+
+        start = cpu()
+        for i in range(commits):
+            other = db.open()
+            other.cacheMinimize()
+            len(other.root()['sdm'].query('client')['payload'])
+            other.close()
+        read = cpu() - start
+        conn.close()
+        db.close()
+    finally:
+        shutil.rmtree(tmpdir)
+    return written / commits, took / commits * 1000, read / commits * 1000
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--commits', type=int, default=200)
+    parser.add_argument('--thresholds', default='0,1024',
+                        help='comma separated, 0 for no compression')
+    options = parser.parse_args(argv)
+
+    print('%8s %10s %14s %14s %14s' % (
+        'payload', 'threshold', 'bytes/commit', 'ms CPU/commit',
+        'ms CPU/read'))
+    for payload in sorted(PAYLOADS):
+        for threshold in [int(t) for t in options.thresholds.split(',')]:
+            written, took, read = bench(payload, threshold, options.commits)
+            print('%8s %10d %14.0f %14.3f %14.3f' % (
+                payload, threshold, written, took, read))
+
+
+if __name__ == '__main__':
+    main()
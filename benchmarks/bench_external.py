@@ -0,0 +1,95 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Benchmark: main database writes with session data in vs. out of the ZODB
+
+Usage: bin/python benchmarks/bench_external.py [-n 2000] [--clients 200]
+
+Runs requests that update the session of one of --clients visitors and,
+every --app-writes requests, an application object.  The sessions are kept
+either by a SessionDataManager in the main FileStorage or by an
+SQLiteSessionDataManager.  Reports requests per second and the
+transactions and bytes written to the main FileStorage per request.
+"""
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import transaction
+from persistent.mapping import PersistentMapping
+from ZODB.DB import DB
+from ZODB.FileStorage import FileStorage
+
+from cipher.session.external import SQLiteSessionDataManager
+from cipher.session.session import SessionDataManager
+
+
+def bench(backend, requests, clients, app_writes):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        storage = FileStorage(os.path.join(tmpdir, 'Data.fs'))
+        db = DB(storage)
+        conn = db.open()
+        root = conn.root()
+        root['app'] = app = PersistentMapping()
+        if backend == 'zodb':
+            root['sdm'] = sdm = SessionDataManager()
+        else:
+            sdm = SQLiteSessionDataManager(
+                os.path.join(tmpdir, 'sessions.db'))
+        transaction.commit()
+        size = os.path.getsize(storage.getName())
+        tid = storage.lastTransaction()
+
+        rnd = random.Random(0)
+        start = time.time()
+        for i in range(requests):
+            data = sdm.get(('client-%d' % rnd.randrange(clients), u'app'))
+            data['hits'] = data.get('hits', 0) + 1
+            if app_writes and not i % app_writes:
+                app['counter'] = i
+            transaction.commit()
+        took = time.time() - start
+
+        transactions = len([txn for txn in storage.iterator(tid)]) - 1
+        written = os.path.getsize(storage.getName()) - size
+        conn.close()
+        db.close()
+    finally:
+        shutil.rmtree(tmpdir)
+    return (requests / took, transactions / float(requests),
+            written / float(requests))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--requests', type=int, default=2000)
+    parser.add_argument('--clients', type=int, default=200)
+    parser.add_argument('--app-writes', type=int, default=10,
+                        help='write an application object every N requests')
+    options = parser.parse_args(argv)
+
+    print('%8s %12s %14s %14s' % (
+        'sessions', 'requests/s', 'main txn/req', 'main bytes/req'))
+    for backend in ('zodb', 'sqlite'):
+        rate, transactions, written = bench(
+            backend, options.requests, options.clients, options.app_writes)
+        print('%8s %12.0f %14.2f %14.0f' % (
+            backend, rate, transactions, written))
+
+
+if __name__ == '__main__':
+    main()
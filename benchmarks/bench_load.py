@@ -0,0 +1,269 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Load test: concurrent session traffic against a real ZODB
+
+Usage: bin/python benchmarks/bench_load.py [--threads 8] [--duration 10]
+           [--storage file|mapping] [--via session|manager]
+           [--output results.jsonl] [--label 3.0.1]
+
+Each worker thread has its own connection and runs requests in their own
+transactions: it picks a visitor out of --clients, reads the session data
+of a few packages and, with --write-ratio, updates one of them.  Reports
+throughput, commit latency percentiles, the rate of transactions failing
+with ConflictError and how many conflicts _p_resolveConflict resolved.
+Other errors are counted too, and the tracebacks of the first ones
+printed: a broken setup fails every transaction.  Runs that commit
+nothing have no commit latencies.
+
+With --output every run is appended to a JSON lines file, along with the
+version of cipher.session, so runs of releases can be compared.  Note that
+MappingStorage does not resolve conflicts, use it to see the raw conflict
+rate.  Lower --period to make the workers rotate buckets during the run.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import traceback
+
+import pkg_resources
+import transaction
+from ZODB.DB import DB
+from ZODB.FileStorage import FileStorage
+from ZODB.MappingStorage import MappingStorage
+from ZODB.POSException import ConflictError
+
+from cipher.session import metrics
+from cipher.session.session import Session, SessionDataManager, _RequestCache
+
+PACKAGES = (u'app.auth', u'app.cart', u'app.prefs')
+
+# tracebacks of unexpected errors reported, per worker
+MAX_ERROR_SAMPLES = 3
+
+
+class Request(object):
+    """Just enough of a request for Session"""
+
+    def __init__(self, client_id, sdm):
+        cache = _RequestCache(client_id)
+        for pkg_id in PACKAGES:
+            cache.managers[pkg_id] = sdm
+        self.annotations = {Session.cacheKey: cache}
+
+
+def request_via_session(sdm, client_id, write, rnd):
+    session = Session(Request(client_id, sdm))
+    session.get_many(PACKAGES)
+    if write:
+        data = session[rnd.choice(PACKAGES)]
+        data['hits'] = data.get('hits', 0) + 1
+        data['last'] = time.time()
+
+
+def request_via_manager(sdm, client_id, write, rnd):
+    sdm.query_many([(client_id, pkg_id) for pkg_id in PACKAGES])
+    if write:
+        data = sdm.get((client_id, rnd.choice(PACKAGES)))
+        data['hits'] = data.get('hits', 0) + 1
+        data['last'] = time.time()
+
+
+class Worker(threading.Thread):
+
+    def __init__(self, db, options, seed):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.db = db
+        self.options = options
+        self.rnd = random.Random(seed)
+        self.latencies = []
+        self.conflicts = 0
+        self.errors = 0
+        # tracebacks of the first errors, a broken setup fails every time
+        self.error_samples = []
+
+    def run(self):
+        options = self.options
+        handle = (request_via_session if options.via == 'session'
+                  else request_via_manager)
+        conn = self.db.open()
+        try:
+            sdm = conn.root()['sdm']
+            deadline = time.time() + options.duration
+            while time.time() < deadline:
+                transaction.begin()
+                client_id = 'client-%d' % self.rnd.randrange(options.clients)
+                write = self.rnd.random() < options.write_ratio
+                try:
+                    handle(sdm, client_id, write, self.rnd)
+                    start = time.time()
+                    transaction.commit()
+                    self.latencies.append(time.time() - start)
+                except ConflictError:
+                    transaction.abort()
+                    self.conflicts += 1
+                except Exception:
+                    if len(self.error_samples) < MAX_ERROR_SAMPLES:
+                        self.error_samples.append(traceback.format_exc())
+                    transaction.abort()
+                    self.errors += 1
+        finally:
+            transaction.abort()
+            conn.close()
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def milliseconds(seconds):
+    if seconds is None:
+        # nothing committed
+        return None
+    return seconds * 1000
+
+
+def resolution_counts():
+    attempted = succeeded = 0
+    for name, count in metrics.counters.items():
+        if name.endswith('.attempted'):
+            attempted += count
+        elif name.endswith('.succeeded'):
+            succeeded += count
+    return attempted, succeeded
+
+
+def bench(options):
+    tmpdir = None
+    if options.storage == 'file':
+        tmpdir = tempfile.mkdtemp()
+        storage = FileStorage(os.path.join(tmpdir, 'Data.fs'))
+    else:
+        storage = MappingStorage()
+    db = DB(storage, pool_size=options.threads)
+    try:
+        conn = db.open()
+        sdm = SessionDataManager(shards=options.shards)
+        sdm.period = options.period
+        sdm.timeout = options.period * 6
+        conn.root()['sdm'] = sdm
+        transaction.commit()
+        conn.close()
+
+        metrics.reset()
+        workers = [Worker(db, options, seed)
+                   for seed in range(options.threads)]
+        start = time.time()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        took = time.time() - start
+    finally:
+        db.close()
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir)
+
+    latencies = [l for worker in workers for l in worker.latencies]
+    conflicts = sum([worker.conflicts for worker in workers])
+    errors = sum([worker.errors for worker in workers])
+    error_samples = []
+    for worker in workers:
+        for sample in worker.error_samples:
+            if sample not in error_samples:
+                error_samples.append(sample)
+    transactions = len(latencies) + conflicts + errors
+    attempted, succeeded = resolution_counts()
+    return {
+        'transactions': transactions,
+        'committed': len(latencies),
+        'errors': errors,
+        'throughput': len(latencies) / took,
+        'p50_commit_ms': milliseconds(percentile(latencies, 50)),
+        'p99_commit_ms': milliseconds(percentile(latencies, 99)),
+        'conflict_rate': conflicts / float(transactions or 1),
+        'resolutions': attempted,
+        'resolution_rate': succeeded / float(attempted or 1),
+        'counters': dict(metrics.counters),
+        'error_samples': error_samples[:MAX_ERROR_SAMPLES],
+    }
+
+
+def format_ms(value):
+    if value is None:
+        return 'n/a'
+    return '%.2f ms' % value
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=10,
+                        help='seconds to run')
+    parser.add_argument('--storage', choices=('file', 'mapping'),
+                        default='file')
+    parser.add_argument('--via', choices=('session', 'manager'),
+                        default='session')
+    parser.add_argument('--clients', type=int, default=1000,
+                        help='number of distinct visitors')
+    parser.add_argument('--write-ratio', type=float, default=0.3)
+    parser.add_argument('--shards', type=int, default=1)
+    parser.add_argument('--period', type=int, default=600)
+    parser.add_argument('--output', help='append the results to this file')
+    parser.add_argument('--label', default='',
+                        help='stored with the results, e.g. a branch name')
+    options = parser.parse_args(argv)
+    # failed resolutions are expected under load, don't log their states
+    logging.basicConfig(level=logging.CRITICAL)
+
+    results = bench(options)
+    print('%-16s %d (%d committed, %d errors)' % (
+        'transactions', results['transactions'], results['committed'],
+        results['errors']))
+    print('%-16s %.0f commits/s' % ('throughput', results['throughput']))
+    print('%-16s %s' % ('p50 commit', format_ms(results['p50_commit_ms'])))
+    print('%-16s %s' % ('p99 commit', format_ms(results['p99_commit_ms'])))
+    print('%-16s %.2f%%' % ('conflict rate', results['conflict_rate'] * 100))
+    print('%-16s %.2f%% of %d' % ('resolved', results['resolution_rate'] * 100,
+                                  results['resolutions']))
+    for sample in results['error_samples']:
+        print()
+        print(sample.rstrip())
+
+    if options.output:
+        record = {
+            'label': options.label,
+            'version': pkg_resources.get_distribution(
+                'cipher.session').version,
+            'time': time.time(),
+            'options': vars(options),
+            'results': results,
+        }
+        with open(options.output, 'a') as f:
+            f.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Benchmark: SessionData pickles in the dict vs. the compact tuple format
+
+Usage: bin/python benchmarks/bench_pickle.py [-n 10000]
+
+Stores n typical sessions in a MappingStorage in either format and reports
+the average record size and the time to load them into a fresh connection.
+"""
+import argparse
+import time
+
+import transaction
+from persistent.list import PersistentList
+from persistent.mapping import PersistentMapping
+from ZODB.DB import DB
+from ZODB.MappingStorage import MappingStorage
+
+from cipher.session.session import SessionData
+
+
+def make_session(i):
+    sdo = SessionData()
+    sdo._pk = u'app.auth'
+    sdo['user'] = u'user-%d' % i
+    sdo['login_time'] = time.time()
+    return sdo
+
+
+def bench(sessions, legacy):
+    db = DB(MappingStorage())
+    conn = db.open()
+    root = conn.root()
+    root['sessions'] = PersistentList(
+        [make_session(i) for i in range(sessions)])
+    getstate = SessionData.__getstate__
+    if legacy:
+        # the dict format of before, with a float creation time
+        for sdo in root['sessions']:
+            sdo._ct = float(sdo._ct)
+        SessionData.__getstate__ = PersistentMapping.__getstate__
+    try:
+        transaction.commit()
+    finally:
+        SessionData.__getstate__ = getstate
+
+    storage = db.storage
+    size = sum([len(storage.load(sdo._p_oid)[0])
+                for sdo in root['sessions']])
+    conn.close()
+
+    conn = db.open()
+    conn.cacheMinimize()
+    start = time.time()
+    for sdo in conn.root()['sessions']:
+        sdo._p_activate()
+    took = time.time() - start
+    conn.close()
+    db.close()
+    return size / float(sessions), sessions / took
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--sessions', type=int, default=10000)
+    options = parser.parse_args(argv)
+
+    print('%8s %14s %12s' % ('format', 'bytes/record', 'loads/s'))
+    for name, legacy in (('dict', True), ('compact', False)):
+        size, rate = bench(options.sessions, legacy)
+        print('%8s %14.0f %12.0f' % (name, size, rate))
+
+
+if __name__ == '__main__':
+    main()
@@ -63,24 +63,32 @@ setup(
         'Framework :: Zope :: 3'],
     packages=find_packages('src'),
     package_dir={'': 'src'},
-    extras_require=dict(
-        test=['zope.testing',
-              'coverage',
-              ],
+    extras_require={
+        'test': ['zope.testing',
+                 'coverage',
+                 'futures',
+                 ],
         # ZODB bootstrap helper
-        bootstrap=[
+        'bootstrap': [
                 'transaction',
                 'zope.processlifetime',
                 'zope.app.appsetup',
                 ],
         # conflict aware / comparable credentials
-        credentials=[
+        'credentials': [
                 'zope.pluggableauth',
-                ]
-    ),
+                ],
+        # AsyncSession, concurrent.futures on Python 2
+        'async': [
+                'futures',
+                ],
+    },
     install_requires=[
         'repoze.session',
         'setuptools',
+        'transaction >= 2.4',
+        'zope.configuration',
+        'zope.event',
         'zope.interface',
         'zope.component',
         'zope.session',
@@ -92,6 +100,12 @@ setup(
         'zope.testrunner',
         ],
     test_suite = '__main__.alltests',
+    entry_points = {
+        'console_scripts': [
+            'cipher-session-gc = cipher.session.maintenance:main',
+            'cipher-session-replay = cipher.session.replay:main',
+        ],
+    },
     include_package_data=True,
     zip_safe=False
     )
@@ -18,8 +18,12 @@ PY3 = sys.version_info[0] >= 3
 
 if PY3:
 
-    pass
+    import pickle
+    string_types = (str,)
+    text_type = str
 
 else:
 
-    pass
+    import cPickle as pickle
+    string_types = (basestring,)
+    text_type = unicode
@@ -0,0 +1,259 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Session access for event loops that must not block
+
+Needs concurrent.futures (the futures backport on Python 2, see the async
+extra).  The methods of AsyncSession return futures, event loops that
+understand them wait for those instead of for the database::
+
+  executor = SessionExecutor(db, workers=4)
+  ...
+  session = AsyncSession(executor, client_id)
+  data = yield session.item(u'app.cart')
+  data['items'] = items
+  yield session.commit()
+"""
+import collections
+import threading
+
+import transaction
+import zope.component
+from concurrent import futures
+
+from cipher.session import interfaces
+from cipher.session import metrics
+
+
+def _globalManager(connection):
+    return zope.component.getUtility(interfaces.ISessionDataManager)
+
+
+class _Worker(object):
+    """A thread with a database connection of its own"""
+
+    def __init__(self, executor):
+        self.executor = executor
+        self._thread = futures.ThreadPoolExecutor(max_workers=1)
+        self.connection = None
+
+    def submit(self, fn, *args):
+        return self._thread.submit(self._run, fn, args)
+
+    def _run(self, fn, args):
+        # runs in the thread of the worker, the connection uses its
+        # (thread local) transaction manager like the session data managers
+        if self.connection is None and self.executor.db is not None:
+            self.connection = self.executor.db.open()
+        return fn(self, *args)
+
+    def manager(self):
+        return self.executor.getManager(self.connection)
+
+    def shutdown(self):
+        if self.connection is not None:
+            self._thread.submit(self.connection.close)
+        self._thread.shutdown()
+
+
+class SessionExecutor(object):
+    """A bounded pool of workers doing the database work of AsyncSessions
+
+    A worker serves one AsyncSession at a time, from its first call until
+    its commit() or abort(), so the session data of a request comes from
+    one connection and is changed in one transaction.  Sessions wait (not
+    blocking the caller) for a free worker.
+
+    getManager(connection) returns the ISessionDataManager, by default the
+    global utility.  Pass one that finds the local utility for a
+    SessionDataManager in the database.
+    """
+
+    def __init__(self, db=None, workers=4, getManager=None):
+        self.db = db
+        self.getManager = getManager or _globalManager
+        self._workers = [_Worker(self) for i in range(workers)]
+        self._free = collections.deque(self._workers)
+        # futures of sessions waiting for a worker
+        self._waiting = collections.deque()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Return a future of a free worker"""
+        future = futures.Future()
+        with self._lock:
+            if self._free:
+                worker = self._free.popleft()
+            else:
+                metrics.incr('async.waited')
+                self._waiting.append(future)
+                return future
+        future.set_result(worker)
+        return future
+
+    def release(self, worker):
+        with self._lock:
+            if not self._waiting:
+                self._free.append(worker)
+                return
+            future = self._waiting.popleft()
+        future.set_result(worker)
+
+    def shutdown(self):
+        for worker in self._workers:
+            worker.shutdown()
+
+
+def _chain(future, fn):
+    """Return a future of fn(result of future), fn returns a future too"""
+    outer = futures.Future()
+
+    def done(future):
+        try:
+            inner = fn(future.result())
+        except Exception as e:
+            outer.set_exception(e)
+            return
+        inner.add_done_callback(lambda inner: _copyResult(inner, outer))
+
+    future.add_done_callback(done)
+    return outer
+
+
+def _copyResult(source, target):
+    error = source.exception()
+    if error is not None:
+        target.set_exception(error)
+    else:
+        target.set_result(source.result())
+
+
+def _done(result):
+    future = futures.Future()
+    future.set_result(result)
+    return future
+
+
+class AsyncSession(object):
+    """The session data of a request, looked up by a SessionExecutor
+
+    Like Session, but the methods return futures of what Session would
+    return.  Session data is looked up once per request and loaded in the
+    worker, so reading it doesn't block the caller.  Persistent objects
+    kept in session data may still be ghosts, keep plain values there.
+    """
+
+    def __init__(self, executor, client_id):
+        self.executor = executor
+        self.client_id = client_id
+        # (client_id, pkg_id) -> session data
+        self._data = {}
+        self._worker = None
+
+    def _call(self, fn, *args):
+        """Return a future of fn(worker, *args), run by our worker"""
+        if self._worker is None:
+            # a future of the worker until the transaction ends
+            self._worker = self.executor.acquire()
+        return _chain(self._worker,
+                      lambda worker: worker.submit(fn, *args))
+
+    def get(self, pkg_id, default=None):
+        return _chain(self.get_many([pkg_id], default),
+                      lambda found: _done(found[pkg_id]))
+
+    def get_many(self, pkg_ids, default=None):
+        """Return a future of a dict of the session data of the packages"""
+        result = {}
+        missing = []
+        for pkg_id in pkg_ids:
+            data = self._data.get((self.client_id, pkg_id))
+            if data is None:
+                missing.append((self.client_id, pkg_id))
+            else:
+                result[pkg_id] = data
+        if not missing:
+            return _done(result)
+        metrics.incr('async.lookups')
+
+        def found(found):
+            for ident, data in found.items():
+                if data is None:
+                    data = default
+                else:
+                    self._data[ident] = data
+                result[ident[1]] = data
+            return _done(result)
+
+        return _chain(self._call(self._query, missing), found)
+
+    def item(self, pkg_id):
+        """Return a future of session[pkg_id], created if needed"""
+        ident = (self.client_id, pkg_id)
+        data = self._data.get(ident)
+        if data is not None and data.is_valid():
+            return _done(data)
+        metrics.incr('async.lookups')
+
+        def found(data):
+            self._data[ident] = data
+            return _done(data)
+
+        return _chain(self._call(self._get, ident), found)
+
+    def commit(self):
+        """Return a future of committing the transaction of the request"""
+        return self._end(transaction.commit)
+
+    def abort(self):
+        """Return a future of aborting the transaction of the request"""
+        return self._end(transaction.abort)
+
+    def _end(self, end):
+        self._data.clear()
+        if self._worker is None:
+            return _done(None)
+        worker, self._worker = self._worker, None
+        ended = futures.Future()
+
+        def finished(future):
+            # release the worker before the caller hears of it
+            self.executor.release(worker.result())
+            _copyResult(future, ended)
+
+        _chain(worker, lambda worker: worker.submit(self._finish, end)
+               ).add_done_callback(finished)
+        return ended
+
+    @staticmethod
+    def _query(worker, idents):
+        found = worker.manager().query_many(idents)
+        for data in found.values():
+            if data is not None:
+                # load it here, not in the caller
+                getattr(data, '_p_activate', lambda: None)()
+        return found
+
+    @staticmethod
+    def _get(worker, ident):
+        data = worker.manager().get(ident)
+        getattr(data, '_p_activate', lambda: None)()
+        return data
+
+    @staticmethod
+    def _finish(worker, end):
+        try:
+            end()
+        except Exception:
+            transaction.abort()
+            raise
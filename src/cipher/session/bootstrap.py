@@ -28,6 +28,36 @@ from cipher.session import interfaces
 from cipher.session.session import SessionDataManager
 
 
+def _localUtility(sm, provided):
+    """Return the unnamed utility providing provided registered in sm"""
+    utils = [reg for reg in sm.registeredUtilities()
+             if reg.provided.isOrExtends(provided)
+                and reg.name == '']
+    if not utils:
+        return None
+    # check our assumptions: there's only one, registered as a component
+    assert len(utils) == 1
+    assert utils[0].factory is None
+    return utils[0].component
+
+
+def _removeUtility(sm, provided):
+    """Unregister and delete the unnamed utility providing provided
+
+    Return the utility or None if there is none.
+    """
+    utility = _localUtility(sm, provided)
+    if utility is None:
+        return None
+    sm.unregisterUtility(utility, provided)
+
+    try:
+        del utility.__parent__[utility.__name__]
+    except:
+        pass
+    return utility
+
+
 @zope.component.adapter(IDatabaseOpenedWithRoot)
 def bootStrapSessionDataManager(event):
     """Subscriber to the IDatabaseOpenedWithRoot
@@ -43,38 +73,13 @@ def bootStrapSessionDataManager(event):
     try:
         # now first get rid of any ISessionDataContainer
         sm = root_folder.getSiteManager()
-        utils = [reg for reg in sm.registeredUtilities()
-                 if reg.provided.isOrExtends(ISessionDataContainer)
-                    and reg.name == '']
-        if utils:
-            # check our assumptions: there's only one, registered as a component
-            assert len(utils) == 1
-            assert utils[0].factory is None
-            utility = utils[0].component
-            sm.unregisterUtility(utility, ISessionDataContainer)
-
-            try:
-                del utility.__parent__[utility.__name__]
-            except:
-                pass
+        if _removeUtility(sm, ISessionDataContainer) is not None:
             transaction.commit()
 
-        utils = [reg for reg in sm.registeredUtilities()
-                 if reg.provided.isOrExtends(interfaces.ISessionDataManager)
-                    and reg.name == '']
-        if utils:
-            # check our assumptions: there's only one, registered as a component
-            assert len(utils) == 1
-            assert utils[0].factory is None
-            utility = utils[0].component
-            if isinstance(utility, SessionDataManager):
-                return  # nothing to do
-            sm.unregisterUtility(utility, interfaces.ISessionDataManager)
-
-            try:
-                del utility.__parent__[utility.__name__]
-            except:
-                pass
+        utility = _localUtility(sm, interfaces.ISessionDataManager)
+        if isinstance(utility, SessionDataManager):
+            return  # nothing to do
+        _removeUtility(sm, interfaces.ISessionDataManager)
 
         addConfigureUtility(
             root_folder,
@@ -88,3 +93,25 @@ def bootStrapSessionDataManager(event):
         raise
     finally:
         connection.close()
+
+
+@zope.component.adapter(IDatabaseOpenedWithRoot)
+def bootStrapExternalSessionDataManager(event):
+    """Subscriber to the IDatabaseOpenedWithRoot
+
+    Removes the ISessionDataManager (and any ISessionDataContainer) from the
+    database, so the global one, e.g. an SQLiteSessionDataManager, is used.
+    """
+
+    db, connection, root, root_folder = getInformationFromEvent(event)
+
+    try:
+        sm = root_folder.getSiteManager()
+        _removeUtility(sm, ISessionDataContainer)
+        _removeUtility(sm, interfaces.ISessionDataManager)
+        transaction.commit()
+    except:
+        transaction.abort()
+        raise
+    finally:
+        connection.close()
@@ -0,0 +1,159 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Compressed session data values, see session.CompressedSessionData
+
+Strings and containers (dicts, lists, tuples, sets) whose pickle is at
+least the threshold are stored as Compressed, a zlib compressed pickle.
+Values holding persistent objects are stored as they are.
+"""
+import zlib
+from io import BytesIO
+
+from persistent import Persistent
+
+from cipher.session import metrics
+from cipher.session._compat import pickle
+from cipher.session._compat import text_type
+
+# bytes of pickle
+THRESHOLD = 1024
+
+LEVEL = 6
+
+_STRINGS = (bytes, text_type)
+_CONTAINERS = (dict, list, tuple, set, frozenset)
+
+
+class Compressed(object):
+    """A zlib compressed pickle of a session data value"""
+
+    def __init__(self, compressed):
+        self.compressed = compressed
+
+    def __reduce__(self):
+        # pickles smaller than the __dict__
+        return (Compressed, (self.compressed, ))
+
+    def value(self):
+        metrics.incr('compression.decompressed')
+        return pickle.loads(zlib.decompress(self.compressed))
+
+    # conflict resolution compares the values of states, compressed.  The
+    # same value may compress to other bytes (another level or pickle
+    # order), so those are compared uncompressed.
+
+    def __eq__(self, other):
+        if not isinstance(other, Compressed):
+            return False
+        return (self.compressed == other.compressed
+                or self.value() == other.value())
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    # equal values don't have equal bytes to hash
+    __hash__ = None
+
+    def __repr__(self):
+        return '<Compressed %d bytes>' % len(self.compressed)
+
+
+class _PersistentValue(Exception):
+    pass
+
+
+def _refusePersistent(obj):
+    if isinstance(obj, Persistent):
+        raise _PersistentValue()
+    return None
+
+
+def compress(value, threshold=THRESHOLD):
+    """Return a Compressed of value, None if it's not worth it"""
+    if isinstance(value, _STRINGS):
+        if len(value) < threshold:
+            return None
+    elif not isinstance(value, _CONTAINERS):
+        return None
+    f = BytesIO()
+    pickler = pickle.Pickler(f, 2)
+    pickler.persistent_id = _refusePersistent
+    try:
+        pickler.dump(value)
+    except (_PersistentValue, pickle.PicklingError, TypeError):
+        # the storage pickles it or complains
+        return None
+    pickled = f.getvalue()
+    if len(pickled) < threshold:
+        return None
+    compressed = zlib.compress(pickled, LEVEL)
+    if len(compressed) >= len(pickled):
+        return None
+    metrics.incr('compression.compressed')
+    return Compressed(compressed)
+
+
+def pack(data, threshold=THRESHOLD, cache=None):
+    """Return (packed, compressed) of a dict of session data
+
+    packed is data with the values worth it compressed, compressed is
+    key -> (value, Compressed) of those.  The Compressed of cache (an
+    earlier compressed) are reused for strings that are still there, other
+    values may have changed in place.
+    """
+    packed = {}
+    compressed = {}
+    for key, value in data.items():
+        hit = None
+        if cache:
+            hit = cache.get(key)
+        if (hit is not None and hit[0] is value
+                and isinstance(value, _STRINGS)):
+            c = hit[1]
+        else:
+            c = compress(value, threshold)
+        if c is None:
+            packed[key] = value
+        else:
+            packed[key] = c
+            compressed[key] = (value, c)
+    return packed, compressed
+
+
+def unpack(packed):
+    """Return (data, compressed) of a packed dict, see pack()"""
+    data = {}
+    compressed = {}
+    for key, value in packed.items():
+        if isinstance(value, Compressed):
+            c, value = value, value.value()
+            if isinstance(value, _STRINGS):
+                compressed[key] = (value, c)
+        data[key] = value
+    return data, compressed
+
+
+def isPacked(data):
+    """Whether a dict of session data has compressed values"""
+    for value in data.values():
+        if isinstance(value, Compressed):
+            return True
+    return False
+
+
+def uncompressed(value):
+    """Return value, decompressed if it is a Compressed"""
+    if isinstance(value, Compressed):
+        return value.value()
+    return value
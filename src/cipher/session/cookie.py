@@ -0,0 +1,241 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Session data kept in signed cookies
+
+Register CookieSession instead of Session, e.g. in overrides.zcml::
+
+  <adapter
+      factory="cipher.session.cookie.CookieSession"
+      provides="zope.session.interfaces.ISession"
+      permission="zope.Public"
+      />
+
+The cookies are signed, not encrypted: the client can read what's in them.
+A signed cookie stays good until timeout, the client can send it again
+(replay it) until then.  invalidate() only makes the response expire it,
+don't rely on it to revoke what the cookie holds, e.g. on logout.
+"""
+import base64
+import hashlib
+import hmac
+import json
+import re
+import time
+import zlib
+
+import zope.component
+from zope.session.interfaces import IClientIdManager
+
+from cipher.session import metrics
+from cipher.session._compat import PY3, text_type
+from cipher.session.session import Session, SessionData, _beforeCommit
+
+
+def _b64encode(s):
+    return base64.urlsafe_b64encode(s).rstrip(b'=')
+
+
+def _b64decode(s):
+    return base64.urlsafe_b64decode(s + b'=' * (-len(s) % 4))
+
+
+class CookieSession(Session):
+    """Keeps session data in a signed cookie per package
+
+    Session data too big for a cookie, or with values that don't survive a
+    JSON round trip, is written to the ISessionDataManager instead, along
+    with session data that was there already.  Cookies are set when the
+    transaction commits, so no database writes happen for session data
+    that fits in a cookie.
+    """
+
+    # the cookies of a request, pkg_id -> [data, _lm when loaded, issued],
+    # are kept in the request annotations under this key
+    cookieKey = 'cipher.session.cookies'
+
+    cookiePrefix = 'session.'
+
+    # browsers keep at least 4096 bytes per cookie, name and attributes
+    # included
+    maxCookieSize = 3800
+
+    # payloads bigger than this are compressed, if that helps
+    compressAbove = 200
+
+    # cookies older than timeout are ignored, those older than period are
+    # renewed
+    timeout = 60 * 60
+    period = 10 * 60
+
+    _DATA_TYPE = SessionData
+
+    def __init__(self, request):
+        super(CookieSession, self).__init__(request)
+        cookies = request.annotations.get(self.cookieKey)
+        if cookies is None:
+            cookies = request.annotations[self.cookieKey] = {}
+        # requests may commit more than once
+        _beforeCommit(self._writeCookies, cookies)
+        self._cookies = cookies
+
+    def _cookieName(self, pkg_id):
+        # a native string of the characters allowed in cookie names
+        return self.cookiePrefix + str(re.sub(r'[^A-Za-z0-9_.-]', '_',
+                                              pkg_id))
+
+    def _mac(self, pkg_id, payload):
+        secret = zope.component.getUtility(IClientIdManager).secret
+        msg = b'\0'.join([text_type(self.client_id).encode('utf-8'),
+                          text_type(pkg_id).encode('utf-8'), payload])
+        return hmac.new(secret.encode('utf-8'), msg, hashlib.sha256).digest()
+
+    def _encode(self, pkg_id, data, issued):
+        """Return the cookie value or None if data doesn't fit"""
+        data = dict(data)
+        try:
+            payload = json.dumps([int(issued), data], separators=(',', ':'),
+                                 sort_keys=True)
+        except (TypeError, ValueError):
+            return None
+        if json.loads(payload)[1] != data:
+            # e.g. tuples or objects that just happen to be serializable
+            return None
+        payload = payload.encode('utf-8')
+        if len(payload) > self.compressAbove:
+            compressed = zlib.compress(payload)
+            if len(compressed) < len(payload):
+                payload = b'z' + compressed
+            else:
+                payload = b'j' + payload
+        else:
+            payload = b'j' + payload
+        value = _b64encode(payload) + b'.' + _b64encode(
+            self._mac(pkg_id, payload))
+        if PY3:
+            # cookie values are native strings
+            value = value.decode('ascii')
+        if len(value) > self.maxCookieSize:
+            return None
+        return value
+
+    def _decode(self, pkg_id, value):
+        """Return (issued, data) of a cookie value, None if it's not valid"""
+        try:
+            payload, mac = value.encode('ascii').split(b'.')
+            payload = _b64decode(payload)
+            mac = _b64decode(mac)
+        except (TypeError, ValueError, UnicodeError):
+            return None
+        if not hmac.compare_digest(mac, self._mac(pkg_id, payload)):
+            metrics.incr('cookie.forged')
+            return None
+        if payload[:1] == b'z':
+            payload = zlib.decompress(payload[1:])
+        else:
+            payload = payload[1:]
+        issued, data = json.loads(payload.decode('utf-8'))
+        if time.time() - issued > self.timeout:
+            return None
+        return issued, data
+
+    def _loadCookie(self, pkg_id):
+        """Return the session data in the cookie of pkg_id, if any
+
+        Session data found is cached like Session does.
+        """
+        entry = self._cookies.get(pkg_id)
+        if entry is not None:
+            return entry[0]
+        value = self.request.getCookies().get(self._cookieName(pkg_id))
+        if not value:
+            return None
+        decoded = self._decode(pkg_id, value)
+        if decoded is None:
+            return None
+        issued, data = decoded
+        sdo = self._DATA_TYPE(data)
+        sdo._pk = pkg_id
+        self._cookies[pkg_id] = [sdo, sdo._lm, issued]
+        self._cache.data[(self.client_id, pkg_id)] = sdo
+        return sdo
+
+    def get(self, pkg_id, default=None):
+        data = self._loadCookie(pkg_id)
+        if data is not None:
+            return data
+        return super(CookieSession, self).get(pkg_id, default)
+
+    def get_many(self, pkg_ids, default=None):
+        result = {}
+        rest = []
+        for pkg_id in pkg_ids:
+            data = self._loadCookie(pkg_id)
+            if data is None:
+                rest.append(pkg_id)
+            else:
+                result[pkg_id] = data
+        result.update(super(CookieSession, self).get_many(rest, default))
+        return result
+
+    def __getitem__(self, pkg_id):
+        ident = (self.client_id, pkg_id)
+        data = self._cache.data.get(ident)
+        if data is None:
+            data = self._loadCookie(pkg_id)
+        if data is None:
+            # session data from before or too big for a cookie
+            data = super(CookieSession, self).get(pkg_id)
+        if data is None or not data.is_valid():
+            data = self._DATA_TYPE()
+            data._pk = pkg_id
+            entry = self._cookies.get(pkg_id)
+            # an invalidated cookie is replaced
+            issued = None if entry is None else entry[2]
+            self._cookies[pkg_id] = [data, None, issued]
+            self._cache.data[ident] = data
+        return data
+
+    def _writeCookies(self, cookies):
+        now = time.time()
+        response = self.request.response
+        path = self.request.getApplicationURL(path_only=True)
+        for pkg_id, entry in list(cookies.items()):
+            sdo, lm, issued = entry
+            name = self._cookieName(pkg_id)
+            if not sdo.is_valid() or sdo._lm is None:
+                # invalidated, or new and never modified
+                if issued is not None:
+                    response.expireCookie(name, path=path)
+                    entry[2] = None
+                continue
+            if sdo._lm == lm and (issued is None
+                                  or now - issued < self.period):
+                continue
+            value = self._encode(pkg_id, sdo, now)
+            if value is not None:
+                response.setCookie(name, value, path=path, httpOnly=True)
+                metrics.incr('cookie.written')
+                # later commits of the request only write changes
+                entry[1:] = [sdo._lm, now]
+                continue
+            # doesn't fit, keep it on the server from now on
+            ident = (self.client_id, pkg_id)
+            server = self._sdc(pkg_id).get(ident)
+            server.clear()
+            server.update(sdo)
+            if issued is not None:
+                response.expireCookie(name, path=path)
+            del cookies[pkg_id]
+            self._cache.data[ident] = server
+            metrics.incr('cookie.fallback')
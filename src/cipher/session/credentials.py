@@ -18,12 +18,19 @@ from zope.pluggableauth.plugins import session
 
 
 class SessionCredentials(session.SessionCredentials):
-    # this is for session.SessionData._p_resolveConflict
-    def __cmp__(self, other):
+    # this is for session.SessionData._p_resolveConflict, which compares
+    # values with != (__cmp__ is not used on Python 3)
+    def __eq__(self, other):
         if isinstance(other, SessionCredentials):
-            if self.login == other.login and self.password == other.password:
-                return 0
-        return 1
+            return (self.login == other.login
+                    and self.password == other.password)
+        return False
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash((self.login, self.password))
 
     # I want to be able to see in zodbbrowser the login+password
     def __repr__(self):
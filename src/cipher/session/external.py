@@ -0,0 +1,370 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Session data managers keeping the session data outside of the ZODB
+
+Session churn then doesn't bloat the main database.  To switch, register
+the manager as the global ISessionDataManager and let bootstrap remove the
+one in the database::
+
+  <include package="cipher.session" file="meta.zcml" />
+  <session:sqliteSessionDataManager file="var/sessions.db" />
+  <include package="cipher.session" file="external.zcml" />
+
+(To keep sessions in a separate ZODB instead, mount a database and put a
+plain SessionDataManager there.)
+"""
+import sqlite3
+import threading
+import time
+
+import transaction
+import transaction.interfaces
+import zope.interface
+from repoze.session import manager
+from ZODB.POSException import ConflictError
+from zope.event import notify
+
+from cipher.session import interfaces
+from cipher.session import metrics
+from cipher.session._compat import pickle
+from cipher.session.session import CompressedSessionData, SessionData
+from cipher.session.session import _differs, _keyString, _stateDict
+
+# WAL lets the other processes read while one writes
+_SCHEMA = """
+PRAGMA journal_mode=WAL;
+CREATE TABLE IF NOT EXISTS sessions (
+    key TEXT PRIMARY KEY,
+    state BLOB NOT NULL,
+    serial INTEGER NOT NULL,
+    slice INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS sessions_slice ON sessions (slice);
+"""
+
+# SQLite limits the number of parameters of a statement
+_BATCH = 500
+
+
+@zope.interface.implementer(transaction.interfaces.ISavepointDataManager)
+class SessionTransaction(object):
+    """Writes the session data used by a transaction to the database
+
+    Session data written by others since it was loaded is resolved with
+    SessionData._p_resolveConflict, like the ZODB would.
+    """
+
+    def __init__(self, sdm, transaction_manager):
+        self.sdm = sdm
+        self.transaction_manager = transaction_manager
+        # key string -> [sdo, serial, pickled state, slice, now] as loaded,
+        # the state is None for new session data
+        self.loaded = {}
+        self.cleared = False
+        self._conn = None
+
+    def sortKey(self):
+        return 'cipher.session.external:%s' % self.sdm.file
+
+    def abort(self, txn):
+        self.loaded.clear()
+        self.cleared = False
+
+    def tpc_begin(self, txn):
+        pass
+
+    def commit(self, txn):
+        pass
+
+    def savepoint(self):
+        return _Savepoint(self)
+
+    def _changes(self):
+        """Return the (key, entry, state) to write and (key, entry) to touch
+
+        state is None for session data that didn't change.
+        """
+        writes = []
+        touches = []
+        touch_resolution = self.sdm.touch_resolution
+        for key, entry in self.loaded.items():
+            sdo, serial, pickled, bucket_slice, now = entry
+            if pickled is None and not self.sdm.nonlazy and (
+                    sdo.last_modified is None or not sdo.is_valid()):
+                metrics.incr('lazy.discarded')
+                continue
+            state = sdo.__getstate__()
+            if pickled is not None and not _differs(
+                    state, pickle.loads(pickled)):
+                if (bucket_slice != now
+                        and now - bucket_slice >= touch_resolution):
+                    # keep it alive
+                    touches.append((key, entry))
+                elif bucket_slice != now:
+                    metrics.incr('touch.skipped')
+                continue
+            writes.append((key, entry, state))
+        return writes, touches
+
+    def tpc_vote(self, txn):
+        writes, touches = self._changes()
+        if not writes and not touches and not self.cleared:
+            # read only, don't lock the database
+            return
+        conn = self._conn = self.sdm._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        if self.cleared:
+            conn.execute('DELETE FROM sessions')
+        for key, (sdo, serial, pickled, bucket_slice, now) in touches:
+            conn.execute(
+                'UPDATE sessions SET slice = ? '
+                'WHERE key = ? AND serial = ?', (now, key, serial))
+            metrics.incr('touch.written')
+        for key, (sdo, serial, pickled, bucket_slice, now), state in writes:
+            row = conn.execute('SELECT serial, state FROM sessions '
+                               'WHERE key = ?', (key, )).fetchone()
+            if row is not None and row[0] != serial:
+                if pickled is None:
+                    raise ConflictError(
+                        "Competing inserts of session data %r" % (key, ))
+                state = sdo._p_resolveConflict(
+                    pickle.loads(pickled), pickle.loads(bytes(row[1])),
+                    state)
+                serial = row[0]
+            conn.execute(
+                'INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?)',
+                (key, sqlite3.Binary(pickle.dumps(state, 2)),
+                 (serial or 0) + 1, now))
+
+    def tpc_finish(self, txn):
+        if self._conn is not None:
+            self._conn.execute('COMMIT')
+            self._conn = None
+        self.abort(txn)
+
+    def tpc_abort(self, txn):
+        if self._conn is not None:
+            self._conn.execute('ROLLBACK')
+            self._conn = None
+        self.abort(txn)
+
+
+def _copyState(sdo):
+    """Return the state of sdo with a copy of its (top level) data"""
+    state = sdo.__getstate__()
+    return (dict(state[0]), ) + state[1:]
+
+
+@zope.interface.implementer(transaction.interfaces.IDataManagerSavepoint)
+class _Savepoint(object):
+    """Rolls back the session data a transaction loaded to a savepoint"""
+
+    def __init__(self, dm):
+        self.dm = dm
+        self.cleared = dm.cleared
+        # key string -> (entry, state of the session data)
+        self.loaded = dict([(key, (list(entry), _copyState(entry[0])))
+                            for key, entry in dm.loaded.items()])
+
+    def rollback(self):
+        self.dm.cleared = self.cleared
+        self.dm.loaded.clear()
+        for key, (entry, state) in self.loaded.items():
+            entry[0].__setstate__(state)
+            self.dm.loaded[key] = list(entry)
+
+
+@zope.interface.implementer(interfaces.ISessionDataManager)
+class SQLiteSessionDataManager(object):
+    """Keeps session data in an SQLite database file
+
+    The file may be shared by the processes of a host.  Session data is
+    loaded when accessed and written back when the transaction commits if it
+    changed (values that don't compare equal to themselves are always
+    written).  Values must be picklable on their own, persistent objects in
+    it are copied.
+    """
+
+    # Make the data type replaceable for unit tests.
+    _DATA_TYPE = SessionData
+
+    # Sessions are rows, there are no buckets to shard
+    shards = 1
+
+    inline_gc = True
+
+    # Reading a session only moves it to the current period if it's at
+    # least touch_resolution seconds older.
+    touch_resolution = 0
+
+    # Only store new session data that was modified.
+    nonlazy = False
+
+    # Values of new session data whose pickle is at least this many bytes
+    # are stored compressed.
+    compress_threshold = None
+
+    # Values are pickled with the session data, persistent objects can't
+    # be stored apart
+    offload_threshold = None
+
+    transaction_manager = transaction.manager
+
+    def __init__(self, file, timeout=60 * 60, period=10 * 60,
+                 compress_threshold=None):
+        self.file = file
+        self.timeout = timeout
+        self.period = period
+        self.compress_threshold = compress_threshold
+        self._local = threading.local()
+        # the period of the last inline gc in this process
+        self._gc_slice = None
+        self._connection().executescript(_SCHEMA)
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # we BEGIN and COMMIT ourselves
+            conn = sqlite3.connect(self.file, timeout=30,
+                                   isolation_level=None)
+            self._local.conn = conn
+        return conn
+
+    def _slice(self, when=None):
+        return int(manager.timeslice(self.period, when))
+
+    def _join(self, when=None):
+        txn = self.transaction_manager.get()
+        try:
+            return txn.data(self)
+        except KeyError:
+            pass
+        dm = SessionTransaction(self, self.transaction_manager)
+        txn.join(dm)
+        txn.set_data(self, dm)
+        if self.inline_gc and self._gc_slice != self._slice(when):
+            self._gc_slice = self._slice(when)
+            self.gc(when=when)
+        return dm
+
+    def _unpickle(self, state):
+        state = pickle.loads(state)
+        klass = self._DATA_TYPE
+        if '_cz' in _stateDict(state):
+            klass = CompressedSessionData
+        sdo = klass.__new__(klass)
+        sdo.__setstate__(state)
+        return sdo
+
+    def _load(self, dm, keys, now):
+        """Load the live session data of the keys not loaded yet"""
+        keys = [k for k in keys if k not in dm.loaded]
+        conn = self._connection()
+        for i in range(0, len(keys), _BATCH):
+            batch = keys[i:i + _BATCH]
+            rows = conn.execute(
+                'SELECT key, state, serial, slice FROM sessions '
+                'WHERE slice >= ? AND key IN (%s)'
+                % ', '.join(['?'] * len(batch)),
+                [now - self.timeout] + batch)
+            for key, state, serial, bucket_slice in rows:
+                state = bytes(state)
+                dm.loaded[key] = [self._unpickle(state), serial, state,
+                                  bucket_slice, now]
+
+    def query_many(self, keys, default=None, when=None):  # 'when' for testing
+        keys = list(keys)
+        dm = self._join(when)
+        strings = [_keyString(k) for k in keys]
+        self._load(dm, strings, self._slice(when))
+        result = {}
+        for key, string in zip(keys, strings):
+            entry = dm.loaded.get(string)
+            result[key] = default if entry is None else entry[0]
+        return result
+
+    def query(self, key, default=None, when=None):  # 'when' for testing
+        return self.query_many((key, ), default, when=when)[key]
+
+    def has_key(self, key):
+        return self.query(key) is not None
+
+    def _newData(self, key):
+        if self.compress_threshold:
+            sdo = CompressedSessionData()
+            sdo._cz = self.compress_threshold
+        else:
+            sdo = self._DATA_TYPE()
+        if isinstance(key, tuple) and len(key) == 2:
+            # keys are (client_id, pkg_id) when coming from Session
+            sdo._pk = key[1]
+        return sdo
+
+    def get(self, key, when=None):  # 'when' for testing
+        sdo = self.query(key, when=when)
+        if sdo is None or not sdo.is_valid():
+            dm = self._join(when)
+            string = _keyString(key)
+            entry = dm.loaded.get(string)
+            serial = None if entry is None else entry[1]
+            now = self._slice(when)
+            sdo = self._newData(key)
+            dm.loaded[string] = [sdo, serial, None, now, now]
+            notify(manager.SessionBeginEvent(sdo))
+        return sdo
+
+    def __getitem__(self, key):
+        return self.get(key)
+
+    def gc(self, max_buckets=None, max_seconds=None, when=None):
+        """Remove expired session data, the oldest period first
+
+        Counts periods as buckets and commits after each one.
+        """
+        start = time.time()
+        live = self._slice(when) - self.timeout
+        conn = self._connection()
+        slices = [row[0] for row in conn.execute(
+            'SELECT DISTINCT slice FROM sessions WHERE slice < ? '
+            'ORDER BY slice', (live, ))]
+
+        removed = 0
+        for bucket_slice in slices:
+            if max_buckets is not None and removed >= max_buckets:
+                break
+            if (max_seconds is not None and removed
+                    and time.time() - start >= max_seconds):
+                break
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                rows = conn.execute('SELECT state FROM sessions '
+                                    'WHERE slice = ?', (bucket_slice, ))
+                states = [bytes(row[0]) for row in rows]
+                conn.execute('DELETE FROM sessions WHERE slice = ?',
+                             (bucket_slice, ))
+            except:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+            for state in states:
+                notify(manager.SessionEndEvent(self._unpickle(state)))
+            removed += 1
+        return removed
+
+    def clear(self):
+        dm = self._join()
+        dm.cleared = True
+        dm.loaded.clear()
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self.file)
@@ -0,0 +1,70 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Fingerprints of session data values
+
+Session data stores the fingerprints of its big values next to them (in
+'_fp', key -> fingerprint), conflict resolution compares those instead of
+the values.  Values without a fingerprint are compared as they are.
+
+Big strings have a fingerprint, other values have one if they provide
+IFingerprinted.  Persistent values are stored as references and have
+none, taking one would load them.
+"""
+import hashlib
+
+from persistent import Persistent
+
+from cipher.session import interfaces
+from cipher.session._compat import text_type
+
+# shorter strings compare faster than they hash
+MIN_SIZE = 1024
+
+
+def fingerprint(value):
+    """Return the fingerprint of a value, None if it has none"""
+    if isinstance(value, bytes):
+        if len(value) >= MIN_SIZE:
+            return b'b' + hashlib.sha1(value).digest()
+    elif isinstance(value, text_type):
+        if len(value) >= MIN_SIZE:
+            try:
+                return b'u' + hashlib.sha1(value.encode('utf-8')).digest()
+            except UnicodeError:
+                # lone surrogates
+                return None
+    elif isinstance(value, Persistent):
+        return None
+    elif interfaces.IFingerprinted.providedBy(value):
+        return b'o' + value.fingerprint()
+    return None
+
+
+def fingerprints(data, cache=None):
+    """Return key -> (value, fingerprint) of the values of data with one
+
+    The fingerprints of cache (the result of an earlier call) are reused
+    for values that are still there.
+    """
+    result = {}
+    for key, value in data.items():
+        if cache:
+            hit = cache.get(key)
+            if hit is not None and hit[0] is value:
+                result[key] = hit
+                continue
+        fp = fingerprint(value)
+        if fp is not None:
+            result[key] = (value, fp)
+    return result
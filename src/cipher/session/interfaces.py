@@ -12,6 +12,7 @@
 #
 ##############################################################################
 
+import zope.interface
 import zope.schema
 
 import repoze.session.interfaces
@@ -30,6 +31,157 @@ class ISessionDataManager(repoze.session.interfaces.ISessionDataManager):
         default=10 * 60,
         required=True,
         min=0)
+    shards = zope.schema.Int(
+        title=u"Bucket shards",
+        description=u"Number of shards a timeout bucket is split into, "
+                    u"1 for a single bucket.  Applies to buckets created "
+                    u"after a change.",
+        default=1,
+        required=True,
+        min=1)
+    touch_resolution = zope.schema.Int(
+        title=u"Access time resolution (seconds)",
+        description=u"Reading a session only writes it into the current "
+                    u"bucket when its bucket is at least this old.  Saves "
+                    u"writes on reads, but sessions may expire up to this "
+                    u"much before timeout.",
+        default=0,
+        required=True,
+        min=0)
+
+    nonlazy = zope.schema.Bool(
+        title=u"Store new session data right away",
+        description=u"If not set, new session data is only stored when "
+                    u"the transaction that created it modified it, "
+                    u"visitors that never change their session data cause "
+                    u"no writes.",
+        default=True,
+        required=True)
+
+    compress_threshold = zope.schema.Int(
+        title=u"Compress values of at least (bytes)",
+        description=u"Strings and containers in new session data whose "
+                    u"pickle is at least this big are stored zlib "
+                    u"compressed.  Not set for no compression.",
+        required=False,
+        min=1)
+
+    offload_threshold = zope.schema.Int(
+        title=u"Store values of at least (bytes) apart",
+        description=u"Strings and containers in new session data whose "
+                    u"pickle is at least this big are stored in objects "
+                    u"of their own (big bytes in blobs), loaded when "
+                    u"read.  Takes precedence over compress_threshold.  "
+                    u"Not set to store them with the session data.",
+        required=False,
+        min=1)
+
+    inline_gc = zope.schema.Bool(
+        title=u"Remove expired data while serving requests",
+        description=u"If not set, run gc() (e.g. the cipher-session-gc "
+                    u"script) regularly instead.",
+        default=True,
+        required=True)
+
+    def query_many(keys, default=None):
+        """Return a dict of the values associated with keys
+
+        The value of a key without session data is default.  The keys are
+        looked up in one pass over the buckets.
+        """
+
+    def gc(max_buckets=None, max_seconds=None):
+        """Remove expired session data, the oldest first
+
+        Stops after removing max_buckets buckets or after max_seconds,
+        commit and call again until it returns 0.
+
+        Return the number of buckets removed.
+        """
 
     def clear():
         """Clear all session data"""
+
+
+class IConflictPolicy(zope.interface.Interface):
+    """Resolves a key changed by both sides of a session data conflict
+
+    Register policies with cipher.session.policy.registerConflictPolicy or
+    the session:conflictPolicy ZCML directive.  Conflicts are resolved in
+    the process that commits to the storage, i.e. the ZEO server, so
+    register them there too; see cipher.session.storageserver.
+    """
+
+    def __call__(old, committed, new, committed_lm, new_lm):
+        """Return the resolved value of the key
+
+        old, committed and new are the values of the key in the states
+        passed to _p_resolveConflict, cipher.session.policy.MISSING if the
+        key is not there.  committed_lm and new_lm are the '_lm' (last
+        modified) times of the committed and new states.  Values that
+        OffloadingSessionData stored apart are the PersistentReferences of
+        their SessionValue or Blob, they can't be loaded while resolving:
+        return one of them as it is or raise ConflictError.
+
+        Return MISSING to drop the key, raise ConflictError if the
+        values can't be resolved.
+        """
+
+
+class IFingerprinted(zope.interface.Interface):
+    """A session data value conflict resolution compares by fingerprint
+
+    See cipher.session.fingerprint.  The fingerprint is taken when the
+    value is stored, don't change such values in place.
+    """
+
+    def fingerprint():
+        """Return a short bytes digest of the value
+
+        Values that are equal have the same fingerprint, values that
+        differ have different ones.
+        """
+
+
+class ISessionLookupCache(zope.interface.Interface):
+    """Where SessionDataManagers found session data, shared by processes
+
+    Register one as a utility and SessionDataManager.search loads session
+    data it finds there directly instead of searching the buckets.  Values
+    are (oid, slice, generation) tuples: the oid of the session data, the
+    start of the period of the bucket it was found in and the
+    SessionDataManager's generation (it changes on clear()).
+    """
+
+    def get_many(keys):
+        """Return a dict of the values of the keys found"""
+
+    def set_many(items):
+        """Set the values of the (key, value) items"""
+
+    def prune(before):
+        """Remove the values with a slice before before"""
+
+
+class ISessionInvalidation(zope.interface.Interface):
+    """Invalidates the session data of clients without scanning it all
+
+    Session data managers providing this find the session data of clients,
+    and the clients of principals Session told them about, by key.
+    """
+
+    def invalidate_clients(client_ids):
+        """Invalidate all session data of the clients
+
+        Return the number of session data objects invalidated.
+        """
+
+    def add_principal(principal_id, client_id):
+        """Remember that the principal used the client"""
+
+    def invalidate_principals(principal_ids):
+        """Invalidate all session data of the clients of the principals
+
+        E.g. after a password change.  Return the number of session data
+        objects invalidated.
+        """
@@ -0,0 +1,94 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""A session lookup cache shared by the processes of a host
+
+Every commit to a bucket makes all processes unpickle the whole bucket
+again to find a session in it.  With the cache they load the session data
+by its oid instead::
+
+  <include package="cipher.session" file="meta.zcml" />
+  <session:lookupCache file="var/session-lookup.db" />
+"""
+import sqlite3
+import threading
+
+import zope.interface
+
+from cipher.session import interfaces
+
+_SCHEMA = """
+PRAGMA journal_mode=WAL;
+CREATE TABLE IF NOT EXISTS lookup (
+    key TEXT PRIMARY KEY,
+    oid BLOB NOT NULL,
+    slice INTEGER NOT NULL,
+    generation INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS lookup_slice ON lookup (slice);
+"""
+
+# SQLite limits the number of parameters of a statement
+_BATCH = 500
+
+
+@zope.interface.implementer(interfaces.ISessionLookupCache)
+class SQLiteLookupCache(object):
+    """Keeps the lookup cache in an SQLite file, memory mapped
+
+    Nothing breaks when it's lost, so it doesn't wait for the disk.
+    """
+
+    mmap_size = 64 * 1024 * 1024
+
+    def __init__(self, file):
+        self.file = file
+        self._local = threading.local()
+        self._connection().executescript(_SCHEMA)
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.file, timeout=5)
+            conn.execute('PRAGMA synchronous=OFF')
+            conn.execute('PRAGMA mmap_size=%d' % self.mmap_size)
+            self._local.conn = conn
+        return conn
+
+    def get_many(self, keys):
+        keys = list(keys)
+        conn = self._connection()
+        result = {}
+        for i in range(0, len(keys), _BATCH):
+            batch = keys[i:i + _BATCH]
+            rows = conn.execute(
+                'SELECT key, oid, slice, generation FROM lookup '
+                'WHERE key IN (%s)' % ', '.join(['?'] * len(batch)), batch)
+            for key, oid, bucket_slice, generation in rows:
+                result[key] = (bytes(oid), bucket_slice, generation)
+        return result
+
+    def set_many(self, items):
+        conn = self._connection()
+        with conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO lookup VALUES (?, ?, ?, ?)',
+                [(key, sqlite3.Binary(oid), bucket_slice, generation)
+                 for key, (oid, bucket_slice, generation) in items])
+
+    def prune(self, before):
+        conn = self._connection()
+        with conn:
+            conn.execute('DELETE FROM lookup WHERE slice < ?', (before, ))
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self.file)
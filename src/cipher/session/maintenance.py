@@ -0,0 +1,109 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Offline maintenance of session data: the cipher-session-gc script
+
+Removes expired session buckets in small batches, each in its own
+transaction, so requests don't pay for it (see ISessionDataManager.inline_gc).
+Pass the site configuration with --zcml, otherwise SessionEndEvent
+subscribers and the lookup cache don't hear of the removed session data.
+"""
+import argparse
+import logging
+import os
+import time
+
+import transaction
+from ZODB.POSException import ConflictError
+
+from cipher.session import interfaces
+
+LOG = logging.getLogger('cipher.session.maintenance')
+
+# where zope.app.publication keeps the root folder
+ROOT_NAME = 'Application'
+
+
+def findSessionDataManagers(root_folder):
+    """Return the session data managers registered in the root folder"""
+    sm = root_folder.getSiteManager()
+    return [reg.component for reg in sm.registeredUtilities()
+            if reg.provided.isOrExtends(interfaces.ISessionDataManager)]
+
+
+def collect(db, max_buckets=1, max_seconds=None, root_name=ROOT_NAME,
+            retries=3):
+    """Run gc() on all session data managers, commit after each batch
+
+    Return the number of buckets removed.
+    """
+    total = 0
+    conn = db.open()
+    try:
+        root_folder = conn.root()[root_name]
+        for sdm in findSessionDataManagers(root_folder):
+            attempt = 0
+            while True:
+                try:
+                    removed = sdm.gc(max_buckets=max_buckets,
+                                     max_seconds=max_seconds)
+                    transaction.commit()
+                except ConflictError:
+                    transaction.abort()
+                    attempt += 1
+                    if attempt > retries:
+                        raise
+                    LOG.info("Conflict removing expired sessions, retrying")
+                    continue
+                attempt = 0
+                if not removed:
+                    break
+                total += removed
+    finally:
+        transaction.abort()
+        conn.close()
+    return total
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Remove expired session data in small batches")
+    parser.add_argument('config',
+                        help='ZConfig file with the <zodb> database section')
+    parser.add_argument('--max-buckets', type=int, default=1,
+                        help='buckets removed per transaction')
+    parser.add_argument('--max-seconds', type=float, default=None,
+                        help='time limit of one transaction')
+    parser.add_argument('--root-name', default=ROOT_NAME,
+                        help='name of the root folder in the database root')
+    parser.add_argument('--zcml', default=None,
+                        help='site configuration (e.g. site.zcml) to load '
+                             'before opening the database')
+    options = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+
+    if options.zcml:
+        from zope.configuration import xmlconfig
+        xmlconfig.file(os.path.abspath(options.zcml))
+
+    import ZODB.config
+    db = ZODB.config.databaseFromFile(open(options.config))
+    try:
+        start = time.time()
+        removed = collect(db, options.max_buckets, options.max_seconds,
+                          options.root_name)
+        LOG.info("Removed %d expired buckets in %.1f seconds",
+                 removed, time.time() - start)
+    finally:
+        db.close()
@@ -0,0 +1,318 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""A session data manager keeping session data in the memory of the process
+
+For single process deployments, session data is lost on restart.  Register
+it as the global ISessionDataManager and let bootstrap remove the one in the
+database::
+
+  <include package="cipher.session" file="meta.zcml" />
+  <session:memorySessionDataManager max_sessions="100000" />
+  <include package="cipher.session" file="external.zcml" />
+"""
+import threading
+import time
+from collections import OrderedDict
+
+import transaction
+import transaction.interfaces
+import zope.interface
+from repoze.session import manager
+from ZODB.POSException import ConflictError
+from zope.event import notify
+
+from cipher.session import interfaces
+from cipher.session import metrics
+from cipher.session.external import _Savepoint
+from cipher.session.session import SessionData, _keyString
+
+def _copy(sdo):
+    """Return a copy of sdo with a copy of its (top level) data"""
+    state = sdo.__getstate__()
+    copy = sdo.__class__.__new__(sdo.__class__)
+    copy.__setstate__((dict(state[0]), ) + state[1:])
+    return copy
+
+
+@zope.interface.implementer(transaction.interfaces.ISavepointDataManager)
+class MemoryTransaction(object):
+    """Stores the session data changed by a transaction in the manager
+
+    Session data stored by others since it was loaded is resolved with
+    SessionData._p_resolveConflict, like the ZODB would.  The locks of the
+    shards written are held from tpc_vote to tpc_finish.
+    """
+
+    def __init__(self, sdm, transaction_manager):
+        self.sdm = sdm
+        self.transaction_manager = transaction_manager
+        # key string -> [copy, original or None, now]
+        self.loaded = {}
+        self.cleared = False
+        self._writes = []
+        self._locks = []
+
+    def sortKey(self):
+        return 'cipher.session.memory:%d' % id(self.sdm)
+
+    def abort(self, txn):
+        self.loaded.clear()
+        self.cleared = False
+        self._writes = []
+
+    def tpc_begin(self, txn):
+        pass
+
+    def commit(self, txn):
+        pass
+
+    def savepoint(self):
+        return _Savepoint(self)
+
+    def _changes(self):
+        """Return the (key, sdo, original, now) to store"""
+        writes = []
+        for key, (sdo, original, now) in self.loaded.items():
+            if (original is not None and sdo._lm == original._lm
+                    and sdo._iv == original._iv):
+                # unchanged
+                continue
+            if original is None and not self.sdm.nonlazy and (
+                    sdo.last_modified is None or not sdo.is_valid()):
+                metrics.incr('lazy.discarded')
+                continue
+            writes.append((key, sdo, original, now))
+        return writes
+
+    def _release(self):
+        while self._locks:
+            self._locks.pop().release()
+
+    def tpc_vote(self, txn):
+        writes = self._changes()
+        if not writes and not self.cleared:
+            return
+        if self.cleared:
+            shards = list(self.sdm._shards)
+        else:
+            # always lock in the same order
+            shards = [self.sdm._shards[i] for i in sorted(set(
+                [self.sdm._shardIndex(key) for key, _, _, _ in writes]))]
+        for lock, store in shards:
+            lock.acquire()
+            self._locks.append(lock)
+        timeout = self.sdm.timeout
+        for key, sdo, original, now in writes:
+            entry = None
+            if not self.cleared:
+                entry = self.sdm._shard(key)[1].get(key)
+            if entry is None or entry[0] is original or (
+                    original is None and now - entry[1] > timeout):
+                # nobody stored it since we loaded it (expired ones are
+                # left to gc)
+                continue
+            if original is None:
+                raise ConflictError(
+                    "Competing inserts of session data %r" % (key, ))
+            sdo.__setstate__(sdo._p_resolveConflict(
+                original.__getstate__(), entry[0].__getstate__(),
+                sdo.__getstate__()))
+        self._writes = writes
+
+    def tpc_finish(self, txn):
+        if self.cleared:
+            for lock, store in self.sdm._shards:
+                store.clear()
+        evicted = []
+        limit = max(1, self.sdm.max_sessions // len(self.sdm._shards))
+        for key, sdo, original, now in self._writes:
+            store = self.sdm._shard(key)[1]
+            store.pop(key, None)
+            # keep a copy, the transaction may go on using sdo
+            store[key] = [_copy(sdo), now]
+            while len(store) > limit:
+                evicted.append(store.popitem(last=False)[1][0])
+        self._release()
+        self.abort(txn)
+        for sdo in evicted:
+            metrics.incr('memory.evicted')
+            notify(manager.SessionEndEvent(sdo))
+
+    def tpc_abort(self, txn):
+        self._release()
+        self.abort(txn)
+
+
+@zope.interface.implementer(interfaces.ISessionDataManager)
+class MemorySessionDataManager(object):
+    """Keeps session data in a dict per shard in least recently used order
+
+    Requests get copies of the session data, the copies they changed replace
+    the stored ones when the transaction commits, so aborted transactions
+    don't change anything.  Concurrent changes of the same session data are
+    merged with SessionData._p_resolveConflict, if that fails the later
+    commit raises ConflictError.  Sessions expire timeout seconds (give or
+    take period) after they were last accessed, least recently used sessions
+    are dropped when there are more than max_sessions.
+    """
+
+    # Make the data type replaceable for unit tests.
+    _DATA_TYPE = SessionData
+
+    inline_gc = True
+
+    # Reading a session only refreshes its access time if that is at least
+    # touch_resolution seconds older.
+    touch_resolution = 0
+
+    # Only store new session data that was modified.
+    nonlazy = False
+
+    # Session data is kept as it is, not pickled
+    compress_threshold = None
+    offload_threshold = None
+
+    transaction_manager = transaction.manager
+
+    def __init__(self, timeout=60 * 60, period=10 * 60, shards=16,
+                 max_sessions=100000):
+        self.timeout = timeout
+        self.period = period
+        # shards are locked separately, requests of different sessions
+        # rarely wait for each other
+        self.shards = shards
+        self.max_sessions = max_sessions
+        # (lock, OrderedDict of key string -> [sdo, access slice])
+        self._shards = [(threading.Lock(), OrderedDict())
+                        for i in range(shards)]
+        # the period of the last inline gc
+        self._gc_slice = None
+
+    def _shardIndex(self, key):
+        return hash(key) % len(self._shards)
+
+    def _shard(self, key):
+        return self._shards[self._shardIndex(key)]
+
+    def _slice(self, when=None):
+        return int(manager.timeslice(self.period, when))
+
+    def _join(self, when=None):
+        txn = self.transaction_manager.get()
+        try:
+            return txn.data(self)
+        except KeyError:
+            pass
+        state = MemoryTransaction(self, self.transaction_manager)
+        txn.join(state)
+        txn.set_data(self, state)
+        if self.inline_gc and self._gc_slice != self._slice(when):
+            self._gc_slice = self._slice(when)
+            self.gc(when=when)
+        return state
+
+    def _lookup(self, key, now):
+        """Return the stored session data of key if it's live"""
+        lock, store = self._shard(key)
+        with lock:
+            entry = store.get(key)
+            if entry is None or now - entry[1] > self.timeout:
+                # expired ones are left to gc
+                return None
+            if now - entry[1] >= self.touch_resolution and entry[1] != now:
+                entry[1] = now
+                # most recently used last
+                del store[key]
+                store[key] = entry
+            return entry[0]
+
+    def query_many(self, keys, default=None, when=None):  # 'when' for testing
+        state = self._join(when)
+        now = self._slice(when)
+        result = {}
+        for key in keys:
+            string = _keyString(key)
+            loaded = state.loaded.get(string)
+            if loaded is None:
+                sdo = None if state.cleared else self._lookup(string, now)
+                if sdo is None:
+                    result[key] = default
+                    continue
+                loaded = state.loaded[string] = [_copy(sdo), sdo, now]
+            result[key] = loaded[0]
+        return result
+
+    def query(self, key, default=None, when=None):  # 'when' for testing
+        return self.query_many((key, ), default, when=when)[key]
+
+    def has_key(self, key):
+        return self.query(key) is not None
+
+    def _newData(self, key):
+        sdo = self._DATA_TYPE()
+        if isinstance(key, tuple) and len(key) == 2:
+            # keys are (client_id, pkg_id) when coming from Session
+            sdo._pk = key[1]
+        return sdo
+
+    def get(self, key, when=None):  # 'when' for testing
+        sdo = self.query(key, when=when)
+        if sdo is None or not sdo.is_valid():
+            state = self._join(when)
+            sdo = self._newData(key)
+            state.loaded[_keyString(key)] = [sdo, None, self._slice(when)]
+            notify(manager.SessionBeginEvent(sdo))
+        return sdo
+
+    def __getitem__(self, key):
+        return self.get(key)
+
+    def gc(self, max_buckets=None, max_seconds=None, when=None):
+        """Remove expired session data
+
+        Counts the shards it removed data from as buckets.
+        """
+        start = time.time()
+        live = self._slice(when) - self.timeout
+
+        removed = 0
+        for lock, store in self._shards:
+            if max_buckets is not None and removed >= max_buckets:
+                break
+            if (max_seconds is not None and removed
+                    and time.time() - start >= max_seconds):
+                break
+            expired = []
+            with lock:
+                # least recently used first
+                while store:
+                    key = next(iter(store))
+                    sdo, bucket_slice = store[key]
+                    if bucket_slice >= live:
+                        break
+                    expired.append(sdo)
+                    del store[key]
+            for sdo in expired:
+                notify(manager.SessionEndEvent(sdo))
+            if expired:
+                removed += 1
+        return removed
+
+    def clear(self):
+        state = self._join()
+        state.cleared = True
+        state.loaded.clear()
+
+    def __len__(self):
+        return sum([len(store) for lock, store in self._shards])
@@ -0,0 +1,183 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Process-local counters and histograms of session storage activity
+
+Everything recorded here is also passed on to the sinks registered with
+addSink, e.g. to forward it to statsd::
+
+    def statsdSink(kind, name, value):
+        if kind == 'count':
+            client.incr('session.' + name, value)
+        else:
+            client.timing('session.' + name, value * 1000)
+
+Conflict resolution is recorded under ``resolve.<subsystem>``:
+
+``attempted``, ``succeeded``, ``failed``
+    counters of _p_resolveConflict calls and their outcome
+
+``failed.<reason>``
+    counters of failures by reason, e.g. ``resolve.bucket.failed.clear``
+
+``seconds``
+    histogram of the time spent resolving
+
+``size``
+    histogram of the bucket sizes seen by the resolver
+"""
+import functools
+import logging
+import math
+import threading
+import time
+
+from ZODB.POSException import ConflictError
+
+LOG = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+
+# name -> count
+counters = {}
+
+# name -> Histogram
+histograms = {}
+
+_sinks = []
+
+
+class Histogram(object):
+    """Summary of observed values
+
+    Values are counted in power of two buckets keyed by their upper bound,
+    values <= 0 are counted under 0.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+        self.buckets = {}
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        if value > 0:
+            bound = 2.0 ** math.ceil(math.log(value, 2))
+        else:
+            bound = 0
+        self.buckets[bound] = self.buckets.get(bound, 0) + 1
+
+    @property
+    def mean(self):
+        if not self.count:
+            return None
+        return float(self.total) / self.count
+
+    def __repr__(self):
+        return '<%s count=%d mean=%r max=%r>' % (
+            self.__class__.__name__, self.count, self.mean, self.max)
+
+
+def _emit(kind, name, value):
+    for sink in list(_sinks):
+        try:
+            sink(kind, name, value)
+        except Exception:
+            # metrics must never break the code they measure
+            LOG.exception("Metrics sink %r failed", sink)
+
+
+def incr(name, value=1):
+    with _lock:
+        counters[name] = counters.get(name, 0) + value
+    _emit('count', name, value)
+
+
+def observe(name, value):
+    """Add value to the histogram name"""
+    with _lock:
+        histogram = histograms.get(name)
+        if histogram is None:
+            histogram = histograms[name] = Histogram()
+        histogram.add(value)
+    _emit('value', name, value)
+
+
+def addSink(sink):
+    """Register sink(kind, name, value) to receive everything recorded
+
+    kind is 'count' for counters and 'value' for histogram values.
+    """
+    with _lock:
+        _sinks.append(sink)
+
+
+def removeSink(sink):
+    with _lock:
+        _sinks.remove(sink)
+
+
+def resolver(subsystem):
+    """Count and time the _p_resolveConflict it decorates
+
+    Reasons of failures are counted by the resolver itself with
+    failure(subsystem, reason).
+    """
+    prefix = 'resolve.%s.' % subsystem
+
+    def decorator(func):
+        @functools.wraps(func)
+        def _p_resolveConflict(self, old, committed, new):
+            incr(prefix + 'attempted')
+            start = time.time()
+            try:
+                resolved = func(self, old, committed, new)
+            except ConflictError:
+                incr(prefix + 'failed')
+                raise
+            finally:
+                observe(prefix + 'seconds', time.time() - start)
+            incr(prefix + 'succeeded')
+            return resolved
+        return _p_resolveConflict
+    return decorator
+
+
+def failure(subsystem, reason):
+    incr('resolve.%s.failed.%s' % (subsystem, reason))
+
+
+def reset():
+    with _lock:
+        counters.clear()
+        histograms.clear()
+
+
+def _cleanUp():
+    reset()
+    with _lock:
+        del _sinks[:]
+
+try:
+    from zope.testing.cleanup import addCleanUp
+except ImportError:  # pragma: no cover
+    pass
+else:
+    addCleanUp(_cleanUp)
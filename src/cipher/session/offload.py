@@ -0,0 +1,102 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Big session data values stored apart, see session.OffloadingSessionData
+
+Strings and containers whose pickle is at least the threshold are stored
+in a SessionValue of their own, bytes of at least BLOB_THRESHOLD in a
+ZODB Blob if the storage supports blobs.  The session data only refers to
+them, they are loaded when read.
+"""
+from io import BytesIO
+
+from persistent import Persistent
+from ZODB.blob import Blob
+from ZODB.interfaces import IBlobStorage
+
+from cipher.session import metrics
+from cipher.session._compat import pickle
+from cipher.session._compat import text_type
+
+# bytes of pickle
+THRESHOLD = 4096
+
+BLOB_THRESHOLD = 1024 * 1024
+
+_STRINGS = (bytes, text_type)
+_CONTAINERS = (dict, list, tuple, set, frozenset)
+
+
+class SessionValue(Persistent):
+    """A big session data value"""
+
+    def __init__(self, value):
+        self.value = value
+
+
+def _refer(obj):
+    # persistent objects in values are stored as references
+    if isinstance(obj, Persistent):
+        return 1
+    return None
+
+
+def _size(value):
+    """Return the size of the pickle of value"""
+    if isinstance(value, _STRINGS):
+        return len(value)
+    f = BytesIO()
+    pickler = pickle.Pickler(f, 2)
+    pickler.persistent_id = _refer
+    try:
+        pickler.dump(value)
+    except (pickle.PicklingError, TypeError):
+        # the storage pickles it or complains
+        return 0
+    return len(f.getvalue())
+
+
+def offload(value, threshold=THRESHOLD, jar=None):
+    """Return a SessionValue or Blob of value, None if it's not worth it
+
+    jar is the connection of the session data, blobs are only used if its
+    storage supports them.
+    """
+    if not isinstance(value, _STRINGS + _CONTAINERS):
+        return None
+    size = _size(value)
+    if size < threshold:
+        return None
+    metrics.incr('offload.stored')
+    if (isinstance(value, bytes) and size >= BLOB_THRESHOLD
+            and jar is not None
+            and IBlobStorage.providedBy(jar.db().storage)):
+        return Blob(value)
+    return SessionValue(value)
+
+
+def isOffloaded(value):
+    return isinstance(value, (SessionValue, Blob))
+
+
+def loaded(value):
+    """Return value, read from its SessionValue or Blob if offloaded"""
+    if isinstance(value, SessionValue):
+        return value.value
+    if isinstance(value, Blob):
+        f = value.open('r')
+        try:
+            return f.read()
+        finally:
+            f.close()
+    return value
@@ -0,0 +1,147 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Conflict policies for keys changed by both sides of a session data conflict
+
+See interfaces.IConflictPolicy.
+
+Conflicts are resolved by the process that commits to the storage: with
+ZEO, the storage server, which never loads the application's ZCML.  Make
+the application register its policies from a function named by an entry
+point in the ``cipher.session.conflict_policies`` group::
+
+    entry_points={
+        'cipher.session.conflict_policies': [
+            'myapp = myapp.session:registerPolicies',
+        ],
+    }
+
+and load them in the server by adding ``%import cipher.session.storageserver``
+to zeo.conf.  Without it, the server resolves conflicts as if no policy
+was registered.
+"""
+import pkg_resources
+import zope.interface
+from ZODB.POSException import ConflictError
+
+from cipher.session import interfaces
+from cipher.session._compat import string_types
+
+
+class _Missing(object):
+    """Marks a key which is not (or no longer) in the session data"""
+
+    def __repr__(self):
+        return 'MISSING'
+
+MISSING = _Missing()
+
+# (pkg_id, key prefix) -> policy, pkg_id None matches any package
+_policies = {}
+
+
+def registerConflictPolicy(policy, pkg_id=None, prefix=u''):
+    """Register policy for the keys starting with prefix of package pkg_id"""
+    _policies[(pkg_id, prefix)] = policy
+
+
+def queryConflictPolicy(pkg_id, key, default=None):
+    """Return the most specific policy registered for key of pkg_id
+
+    A policy registered for the package beats one registered for any
+    package, then the longest matching prefix wins.
+    """
+    found = default
+    found_rank = None
+    for (p_pkg_id, prefix), policy in _policies.items():
+        if p_pkg_id is not None and p_pkg_id != pkg_id:
+            continue
+        if prefix and not (isinstance(key, string_types)
+                           and key.startswith(prefix)):
+            continue
+        rank = (p_pkg_id is not None, len(prefix))
+        if found_rank is None or rank > found_rank:
+            found = policy
+            found_rank = rank
+    return found
+
+
+def clearConflictPolicies():
+    _policies.clear()
+
+
+POLICIES_ENTRY_POINT = 'cipher.session.conflict_policies'
+
+
+def loadConflictPolicies(working_set=None):
+    """Call the functions of the conflict policy entry points
+
+    They register the conflict policies of their applications.  Return
+    the names of the entry points.
+    """
+    if working_set is None:
+        working_set = pkg_resources.working_set
+    names = []
+    for entry_point in working_set.iter_entry_points(POLICIES_ENTRY_POINT):
+        entry_point.resolve()()
+        names.append(entry_point.name)
+    return names
+
+try:
+    from zope.testing.cleanup import addCleanUp
+except ImportError:  # pragma: no cover
+    pass
+else:
+    addCleanUp(clearConflictPolicies)
+
+
+@zope.interface.provider(interfaces.IConflictPolicy)
+def lastWriterWins(old, committed, new, committed_lm, new_lm):
+    """The value of the later modification (by '_lm') wins"""
+    if committed_lm > new_lm:
+        return committed
+    return new
+
+
+@zope.interface.provider(interfaces.IConflictPolicy)
+def maxValue(old, committed, new, committed_lm, new_lm):
+    """The larger value wins, e.g. for "last seen" timestamps"""
+    if committed is MISSING or new is MISSING:
+        raise ConflictError("Can't take the max of a deleted value")
+    return max(committed, new)
+
+
+@zope.interface.provider(interfaces.IConflictPolicy)
+def sumOfDeltas(old, committed, new, committed_lm, new_lm):
+    """Apply both increments to the old value, e.g. for counters"""
+    if committed is MISSING or new is MISSING:
+        raise ConflictError("Can't sum the deltas of a deleted value")
+    if old is MISSING:
+        old = 0
+    return committed + new - old
+
+
+@zope.interface.provider(interfaces.IConflictPolicy)
+def setUnion(old, committed, new, committed_lm, new_lm):
+    """Union of both values, sets or lists/tuples (keeping the order)"""
+    if committed is MISSING or new is MISSING:
+        raise ConflictError("Can't build the union with a deleted value")
+    if (isinstance(committed, (set, frozenset))
+            and isinstance(new, (set, frozenset))):
+        return committed | new
+    if (isinstance(committed, (list, tuple))
+            and isinstance(new, (list, tuple))):
+        added = [v for v in new if v not in committed]
+        return committed.__class__(list(committed) + added)
+    raise ConflictError("Can't build the union of %s and %s" % (
+        committed.__class__.__name__, new.__class__.__name__))
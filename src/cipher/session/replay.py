@@ -0,0 +1,268 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Replay session conflict resolution offline: the cipher-session-replay
+script
+
+Consecutive revisions of an object in a storage were written one after
+another, they never conflicted.  The conflicts themselves are recorded
+where they happen: record() makes a storage (e.g. the FileStorage of the
+storage server) append the conflicts it fails to resolve, or resolves
+slowly, to a file, with the state the new transaction wanted to write.
+
+The script resolves the recorded conflicts of session buckets and their
+index, session data and session data managers again, against a copy of
+the storage (opened read only) for the states both transactions started
+from and the committed one, with the code the storage server would use.
+It reports the resolutions that failed or took longer than --slow
+milliseconds, with the keys both sides changed and the types of their
+values, and per class statistics.  --profile runs the resolutions under
+cProfile.
+"""
+from __future__ import print_function
+
+import argparse
+import cProfile
+import itertools
+import logging
+import pstats
+import sys
+import threading
+import time
+
+from ZODB.ConflictResolution import PersistentReferenceFactory, state
+from ZODB.FileStorage import FileStorage
+from ZODB.POSException import ConflictError
+from ZODB.utils import get_pickle_metadata, oid_repr, p64, tid_repr
+
+from cipher.session import compression, metrics
+from cipher.session._compat import pickle
+from cipher.session.session import _marker, _differs, _stateDict
+
+# the classes of session storage that resolve conflicts
+CLASSES = (
+    'cipher.session.session.AppendOnlyDict',
+    'cipher.session.session.BucketIndex',
+    'cipher.session.session.SessionData',
+    'cipher.session.session.CompressedSessionData',
+    'cipher.session.session.OffloadingSessionData',
+    'cipher.session.session.SessionDataManager',
+    )
+
+
+class Replay(object):
+    """The resolution of a recorded conflict of an object
+
+    old and committed are serials, new is the pickle the new transaction
+    wanted to store.
+    """
+
+    def __init__(self, oid, klass, old, committed, new):
+        self.oid = oid
+        self.klass = klass
+        self.old = old
+        self.committed = committed
+        self.new = new
+        self.seconds = None
+        self.failure = None
+        # the failure reasons resolvers counted with metrics.failure
+        self.reasons = []
+
+    def run(self, storage):
+        def sink(kind, name, value):
+            if name.startswith('resolve.') and '.failed.' in name:
+                self.reasons.append(name.split('.failed.')[1])
+        metrics.addSink(sink)
+        start = time.time()
+        try:
+            storage.tryToResolveConflict(self.oid, self.committed, self.old,
+                                         self.new)
+        except ConflictError as e:
+            self.failure = e
+        finally:
+            self.seconds = time.time() - start
+            metrics.removeSink(sink)
+
+    def contested(self, storage):
+        """Return (key, value type names) of the keys both sides changed"""
+        prfactory = PersistentReferenceFactory()
+        old, committed, new = [
+            _data(state(storage, self.oid, serial, prfactory, p))
+            for serial, p in ((self.old, b''), (self.committed, b''),
+                              (None, self.new))]
+        result = []
+        for key in sorted(set(old).union(committed).union(new), key=repr):
+            o_value = old.get(key, _marker)
+            c_value = committed.get(key, _marker)
+            n_value = new.get(key, _marker)
+            if _differs(o_value, c_value) and _differs(o_value, n_value):
+                result.append((key, [_typeName(v) for v in
+                                     (o_value, c_value, n_value)]))
+        return result
+
+    def format(self, storage):
+        lines = ['%s %s old %s committed %s: %.2fms%s' % (
+            self.klass, oid_repr(self.oid), tid_repr(self.old),
+            tid_repr(self.committed), self.seconds * 1000,
+            self.failure is not None and ' FAILED (%s)' % ', '.join(
+                self.reasons or ['unknown']) or '')]
+        for key, types in self.contested(storage):
+            lines.append('  %r: %s' % (key, ' -> '.join(types)))
+        return '\n'.join(lines)
+
+
+def _data(state):
+    """Return the dict of session data in a state"""
+    if isinstance(state, tuple):
+        # SessionData
+        state = _stateDict(state)
+    if isinstance(state, dict):
+        data = state.get('data', state)
+        if isinstance(data, dict):
+            if compression.isPacked(data):
+                # CompressedSessionData, compare the values
+                data = compression.unpack(data)[0]
+            return data
+    return {}
+
+
+def _typeName(value):
+    if value is _marker:
+        return 'missing'
+    return type(value).__name__
+
+
+def record(storage, path, slow=None):
+    """Append the conflicts storage fails to resolve to the file path
+
+    With slow, also those that took at least slow milliseconds.  Wraps the
+    tryToResolveConflict of the storage instance, call it where it is
+    opened, e.g. in the storage server.
+    """
+    resolve = storage.tryToResolveConflict
+    lock = threading.Lock()
+
+    def tryToResolveConflict(oid, committedSerial, oldSerial, newpickle,
+                             *args, **kw):
+        start = time.time()
+        failed = True
+        try:
+            resolved = resolve(oid, committedSerial, oldSerial, newpickle,
+                               *args, **kw)
+            failed = False
+            return resolved
+        finally:
+            if failed or (slow is not None
+                          and (time.time() - start) * 1000 >= slow):
+                with lock:
+                    with open(path, 'ab') as f:
+                        pickle.dump(
+                            (oid, oldSerial, committedSerial, newpickle), f,
+                            2)
+
+    storage.tryToResolveConflict = tryToResolveConflict
+
+
+def recorded(path, classes=CLASSES, oids=None):
+    """Yield the Replays of the conflicts record() appended to path"""
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                oid, old, committed, new = pickle.load(f)
+            except EOFError:
+                break
+            if oids is not None and oid not in oids:
+                continue
+            klass = '.'.join(get_pickle_metadata(new))
+            if klass not in classes:
+                continue
+            yield Replay(oid, klass, old, committed, new)
+
+
+def replay(storage, replays, slow=None, out=None, profile=None):
+    """Run the replays, print the slow and failed ones
+
+    Return a dict of class name -> (count, failures, total seconds,
+    max seconds).
+    """
+    if out is None:
+        out = sys.stdout
+    stats = {}
+    for r in replays:
+        if profile is not None:
+            profile.enable()
+        r.run(storage)
+        if profile is not None:
+            profile.disable()
+        count, failures, total, longest = stats.get(r.klass, (0, 0, 0, 0))
+        stats[r.klass] = (count + 1, failures + (r.failure is not None),
+                          total + r.seconds, max(longest, r.seconds))
+        if r.failure is not None or (slow is not None
+                                     and r.seconds * 1000 >= slow):
+            print(r.format(storage), file=out)
+    return stats
+
+
+def _oid(value):
+    return p64(int(value, 0))
+
+
+def main(argv=None, out=None):
+    parser = argparse.ArgumentParser(
+        description="Replay session conflict resolution offline")
+    parser.add_argument('path', help='the FileStorage (Data.fs)')
+    parser.add_argument('conflicts', help='the file record() wrote')
+    parser.add_argument('--oid', type=_oid, action='append',
+                        help='only objects with this oid, e.g. 0x1a2b, '
+                             'from the ConflictError in the logs')
+    parser.add_argument('--class', dest='classes', action='append',
+                        help='dotted names of the classes to replay '
+                             '(default: %s)' % ', '.join(CLASSES))
+    parser.add_argument('--slow', type=float, default=10,
+                        help='report resolutions slower than this (ms)')
+    parser.add_argument('--limit', type=int, default=None,
+                        help='stop after this many replays')
+    parser.add_argument('--profile', metavar='FILE', default=None,
+                        help='save cProfile stats to FILE ("-" prints the '
+                             'top functions)')
+    options = parser.parse_args(argv)
+    if out is None:
+        out = sys.stdout
+
+    # the resolvers log the failures we report
+    logging.basicConfig(level=logging.CRITICAL)
+
+    storage = FileStorage(options.path, read_only=True)
+    try:
+        replays = recorded(options.conflicts,
+                           tuple(options.classes or CLASSES),
+                           options.oid and set(options.oid))
+        if options.limit is not None:
+            replays = itertools.islice(replays, options.limit)
+        profile = options.profile and cProfile.Profile() or None
+        stats = replay(storage, replays, options.slow, out, profile)
+    finally:
+        storage.close()
+
+    print('%-45s %8s %8s %10s %10s' % (
+        'class', 'replays', 'failed', 'mean ms', 'max ms'), file=out)
+    for klass, (count, failures, total, longest) in sorted(stats.items()):
+        print('%-45s %8d %8d %10.2f %10.2f' % (
+            klass, count, failures, total / count * 1000, longest * 1000),
+            file=out)
+    if profile is not None:
+        if options.profile == '-':
+            pstats.Stats(profile, stream=out).sort_stats(
+                'cumulative').print_stats(25)
+        else:
+            profile.dump_stats(options.profile)
@@ -14,12 +14,20 @@
 """Session handling
 """
 import logging
+import time
+import zlib
+from binascii import hexlify
 
+import transaction
 import zope.interface
 import zope.component
 from persistent import Persistent
 from persistent.mapping import PersistentMapping
 from ZODB.POSException import ConflictError
+from ZODB.POSException import POSKeyError
+from ZODB.POSException import ReadConflictError
+from ZODB.utils import z64
+from zope.event import notify
 from zope.location.location import Location
 from zope.publisher.interfaces import IRequest
 from zope.session.interfaces import ISession
@@ -27,12 +35,27 @@ from zope.session.interfaces import IClientId
 
 from repoze.session import data
 from repoze.session import manager
+from repoze.session.interfaces import ISessionData
 
+from cipher.session import compression
 from cipher.session import interfaces
+from cipher.session import metrics
+from cipher.session import offload
+from cipher.session.fingerprint import fingerprint, fingerprints
 from cipher.session._compat import PY3
+from cipher.session._compat import text_type
+from cipher.session.policy import MISSING
+from cipher.session.policy import queryConflictPolicy
+
+try:
+    from zope.authentication.interfaces import IUnauthenticatedPrincipal
+except ImportError:
+    IUnauthenticatedPrincipal = None
 
 LOG = logging.getLogger('cipher.session.session')
 
+_marker = MISSING
+
 
 def formatExtraData(extra, **inData):
     for name, data in inData.items():
@@ -40,11 +63,115 @@ def formatExtraData(extra, **inData):
     return extra
 
 
+def _differs(a, b, a_fp=None, b_fp=None):
+    # compare two values taken from persistent state, values which can't
+    # be compared (e.g. PersistentReferences) are considered different,
+    # values which both have fingerprints are compared by those
+    if a is b:
+        return False
+    if a is _marker or b is _marker:
+        return True
+    if a_fp is not None and b_fp is not None:
+        return a_fp != b_fp
+    try:
+        return bool(a != b)
+    except ValueError:
+        return True
+
+
+def _threeWayMerge(old, committed, new, collide, fingerprints=None):
+    """Merge the changes old->committed and old->new of dicts
+
+    Keys changed on both sides are resolved by
+    collide(key, old_value, committed_value, new_value), which returns the
+    value (MISSING to drop the key) or raises ConflictError.  Missing keys
+    are passed as MISSING.
+
+    fingerprints are the fingerprint dicts of old, committed and new, if
+    they have any.
+
+    Return the merged dict.
+    """
+    o_fps, c_fps, n_fps = fingerprints or ({}, {}, {})
+    merged = dict(new)
+    for key in set(old).union(committed):
+        o_value = old.get(key, _marker)
+        c_value = committed.get(key, _marker)
+        o_fp = o_fps.get(key)
+        c_fp = c_fps.get(key)
+        if not _differs(o_value, c_value, o_fp, c_fp):
+            # committed did not touch the key, new's version wins
+            continue
+        n_value = new.get(key, _marker)
+        n_fp = n_fps.get(key)
+        if not _differs(o_value, n_value, o_fp, n_fp):
+            # only committed touched the key
+            value = c_value
+        elif not _differs(c_value, n_value, c_fp, n_fp):
+            # both made the same change
+            continue
+        else:
+            value = collide(key, o_value, c_value, n_value)
+        if value is _marker:
+            merged.pop(key, None)
+        else:
+            merged[key] = value
+    return merged
+
+
+def _dataDiffers(a, b):
+    """Whether the 'data' of two session data states differ
+
+    Values that have fingerprints in both states are compared by those.
+    """
+    a_data = a['data']
+    b_data = b['data']
+    a_fps = a.get('_fp')
+    b_fps = b.get('_fp')
+    if (not a_fps or not b_fps or not isinstance(a_data, dict)
+            or not isinstance(b_data, dict)):
+        return _differs(a_data, b_data)
+    if len(a_data) != len(b_data):
+        return True
+    for key, value in a_data.items():
+        if _differs(value, b_data.get(key, _marker),
+                    a_fps.get(key), b_fps.get(key)):
+            return True
+    return False
+
+
 class AppendOnlyDict(PersistentMapping):
     # taken from Products.faster.appendict by Tres Seaver
+
+    # key -> fingerprint of the values that have one, conflict resolution
+    # compares those instead of the values.  Values can't change, so they
+    # are taken when they are added.
+    _fp = None
+
+    # key -> how often its value was replaced, see replace()
+    _rc = None
+
     def __setitem__(self, key, value):
         if key in self.data:
             raise TypeError("Can't update key in AppendOnlyDict!")
+        self._set(key, value)
+
+    def replace(self, key, value):
+        """Replace the value of a key
+
+        For session data that was invalidated, conflict resolution merges
+        replacements of different keys.
+        """
+        if key not in self.data:
+            raise KeyError(key)
+        if self._rc is None:
+            self._rc = {}
+        self._rc[key] = self._rc.get(key, 0) + 1
+        if self._fp is not None:
+            self._fp.pop(key, None)
+        self._set(key, value)
+
+    def _set(self, key, value):
         if isinstance(value, (dict, list)):
             raise TypeError("Can't add non-persistent mutable subobjects!")
         if not PY3:
@@ -53,6 +180,11 @@ class AppendOnlyDict(PersistentMapping):
                 if not isinstance(value, Persistent):
                     raise TypeError(
                         "Can't add non-persistent mutable subobjects!")
+        fp = fingerprint(value)
+        if fp is not None:
+            if self._fp is None:
+                self._fp = {}
+            self._fp[key] = fp
         PersistentMapping.__setitem__(self, key, value)
 
     def __delitem__(self, key):
@@ -60,6 +192,7 @@ class AppendOnlyDict(PersistentMapping):
             raise TypeError("Can't delete from AppendOnlyDict!")
         PersistentMapping.__delitem__(self, key)
 
+    @metrics.resolver('bucket')
     def _p_resolveConflict(self, old, committed, new):
         """ Resolve competing inserts.
 
@@ -73,29 +206,52 @@ class AppendOnlyDict(PersistentMapping):
         # _p_resolveConflict is called with persistent state
         # we are operating against the PersistentMapping.__getstate__
         # representation, which aliases '_container' to self.data.
-        if not committed['data'] or not new['data']:
+        old_data = old['data']
+        committed_data = committed['data']
+        new_data = new['data']
+        metrics.observe('resolve.bucket.size', len(committed_data))
+        if (not committed_data or not new_data
+                or len(committed_data) < len(old_data)
+                or len(new_data) < len(old_data)):
             LOG.error("Can't resolve 'clear'")
+            metrics.failure('bucket', 'clear')
             raise ConflictError("Can't resolve 'clear'")
 
-        # save old state, messing with result_data overwrite state
-        extra = {}
-        formatExtraData(extra, old=old, committed=committed, new=new)
-
-        result = old.copy()
-        c_new = {}
-        result_data = result['data']
-
-        for k, v in committed['data'].items():
-            if k not in result_data:
-                c_new[k] = 1
-                result_data[k] = v
-
-        for k, v in new['data'].items():
-            if k in c_new:
+        # Only look at the few keys new appended or replaced, committed
+        # already has all of old's keys.  Don't touch the states until we
+        # know the result, the diagnostics on failure need them as they
+        # came in.
+        old_rc = old.get('_rc') or {}
+        committed_rc = committed.get('_rc') or {}
+        new_rc = new.get('_rc') or {}
+        replaced = [k for k, count in new_rc.items()
+                    if count != old_rc.get(k, 0)]
+        if len(new_data) == len(old_data) and not replaced:
+            # new appended nothing
+            return dict(committed)
+        for k in replaced:
+            if committed_rc.get(k, 0) != old_rc.get(k, 0):
+                extra = formatExtraData(
+                    {}, old=old, committed=committed, new=new, k=k)
+                LOG.error("Conflicting replace", extra=extra)
+                metrics.failure('bucket', 'replace')
+                raise ConflictError("Conflicting replace")
+        committed_fps = committed.get('_fp') or {}
+        new_fps = new.get('_fp') or {}
+        added = {}
+        for k in new_data:
+            if k in old_data:
+                continue
+            v = new_data[k]
+            if k in committed_data:
+                # appended on both sides
+                rdata_k = committed_data[k]
                 try:
                     verror = False
-                    rdata_k = result_data[k]
-                    neq = (v != rdata_k)
+                    if k in new_fps and k in committed_fps:
+                        neq = new_fps[k] != committed_fps[k]
+                    else:
+                        neq = (v != rdata_k)
                     # value is not the same -> raise ConflictError
                 except ValueError:
                     # uncomparable PersistentReferences -> raise ConflictError
@@ -103,19 +259,205 @@ class AppendOnlyDict(PersistentMapping):
                     verror = True
                 if neq:
                     # log everything, debugging ConflictResolution is hard
-                    formatExtraData(extra, k=k, v=v, c_new=c_new, result=result,
-                                    rdata_k=rdata_k, verror=verror)
+                    extra = formatExtraData(
+                        {}, old=old, committed=committed, new=new,
+                        k=k, v=v, rdata_k=rdata_k, verror=verror)
                     LOG.error("Conflicting insert", extra=extra)
+                    metrics.failure('bucket', 'insert')
                     raise ConflictError("Conflicting insert")
-            if k in result_data:
                 continue
-            result_data[k] = v
+            added[k] = v
 
+        result = dict(committed)
+        if replaced:
+            result['_rc'] = dict(committed_rc)
+            for k in replaced:
+                result['_rc'][k] = new_rc[k]
+                added[k] = new_data[k]
+        if added:
+            committed_data.update(added)
+            fps = dict([(k, fp) for k, fp in committed_fps.items()
+                        if k not in added])
+            fps.update([(k, new_fps[k]) for k in added if k in new_fps])
+            if fps or committed_fps:
+                result['_fp'] = fps
         return result
 
 
+def _keyString(key):
+    """Return a text key for keys of session data, e.g. in SQL tables"""
+    if not isinstance(key, tuple):
+        key = (key,)
+    return u'\x00'.join([text_type(part) for part in key])
+
+
+def _shardHash(key):
+    # hash() of strings is not stable across processes, crc32 is
+    if not isinstance(key, tuple):
+        key = (key,)
+    h = 0
+    for part in key:
+        if not isinstance(part, bytes):
+            part = text_type(part).encode('utf-8')
+        h = zlib.crc32(part, h)
+    return h & 0xffffffff
+
+
+class ShardedBucket(Persistent):
+    """A session bucket split into AppendOnlyDict shards
+
+    Keys are hashed into a fixed set of shards, an insert only rewrites
+    (and resolves conflicts on) the shard of the key.  The bucket itself
+    never changes after creation.
+    """
+
+    _SHARD_TYPE = AppendOnlyDict
+
+    def __init__(self, shards):
+        self.shards = tuple([self._SHARD_TYPE() for i in range(shards)])
+
+    def _shard(self, key):
+        return self.shards[_shardHash(key) % len(self.shards)]
+
+    def get(self, key, default=None):
+        return self._shard(key).get(key, default)
+
+    def __getitem__(self, key):
+        return self._shard(key)[key]
+
+    def __setitem__(self, key, value):
+        self._shard(key)[key] = value
+
+    def replace(self, key, value):
+        self._shard(key).replace(key, value)
+
+    def __contains__(self, key):
+        return key in self._shard(key)
+
+    has_key = __contains__
+
+    def __len__(self):
+        return sum([len(shard) for shard in self.shards])
+
+    def __iter__(self):
+        for shard in self.shards:
+            for key in shard:
+                yield key
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return [v for shard in self.shards for v in shard.values()]
+
+    def items(self):
+        return [i for shard in self.shards for i in shard.items()]
+
+    def __repr__(self):
+        return '<%s with %d shards>' % (self.__class__.__name__,
+                                        len(self.shards))
+
+
+# Buckets also keep the clients of principals Session told the manager
+# about, under (_PRINCIPAL, principal_id, client_id) -> True.  Session keys
+# are (client_id, pkg_id), see SessionDataManager.add_principal.
+_PRINCIPAL = u'\x00principal'
+
+
+def _isPrincipalKey(key):
+    return isinstance(key, tuple) and len(key) == 3 and key[0] == _PRINCIPAL
+
+
+# The fields of the compact SessionData state, see SessionData.__getstate__
+_STATE_FIELDS = ('data', '_lm', '_ct', '_iv', '_pk')
+
+
+def _compactState(state):
+    """Return the tuple form of a SessionData state dict"""
+    compact = (state.get('data'), state.get('_lm'), state.get('_ct'),
+               bool(state.get('_iv')), state.get('_pk'))
+    extra = dict([(k, v) for k, v in state.items()
+                  if k not in _STATE_FIELDS])
+    if extra:
+        compact += (extra, )
+    return compact
+
+
+def _stateDict(state):
+    """Return the dict form of a SessionData state, old pickles have that"""
+    if not isinstance(state, tuple):
+        return state
+    data, lm, ct, iv, pk = state[:5]
+    result = {'data': data, '_lm': lm, '_ct': ct}
+    if iv:
+        result['_iv'] = True
+    if pk is not None:
+        result['_pk'] = pk
+    if len(state) > 5:
+        result.update(state[5])
+    return result
+
+
+def _mergedFingerprints(merged, committed, new):
+    """Return the fingerprints of the merged data of two states
+
+    Merged values came from one of them or from a conflict policy, those
+    have no fingerprint until the session data is written again.
+    """
+    result = {}
+    for state in (committed, new):
+        fps = state.get('_fp')
+        if not fps:
+            continue
+        for key, fp in fps.items():
+            if key in merged and merged[key] is state['data'].get(key):
+                result[key] = fp
+    return result
+
+
 class SessionData(data.SessionData):
 
+    # _pk is the package id of the session data, used to look up the
+    # conflict policies of the package.
+    _pk = None
+
+    def __init__(self, d=None):
+        super(SessionData, self).__init__(d)
+        # whole seconds pickle smaller
+        self._ct = int(self._ct)
+
+    # There are a lot of these, their state is a tuple of the values of
+    # _STATE_FIELDS instead of a dict of the attributes, so the names
+    # aren't pickled with every one.  Attributes not in _STATE_FIELDS
+    # follow in a dict.  _lm stays a float, conflict resolution relies on
+    # it to tell whether both sides wrote.
+
+    # The fingerprints of the values are taken when the state is written,
+    # values can be changed by any of the mapping methods.  Those of the
+    # values that didn't change since are reused: _v_fp is key ->
+    # (value, fingerprint).
+
+    def __getstate__(self):
+        state = super(SessionData, self).__getstate__()
+        state['data'] = self._stateData()
+        self._v_fp = fingerprints(state['data'],
+                                  getattr(self, '_v_fp', None))
+        if self._v_fp:
+            state['_fp'] = dict([(k, fp) for k, (v, fp)
+                                 in self._v_fp.items()])
+        return _compactState(state)
+
+    def __setstate__(self, state):
+        state = dict(_stateDict(state))
+        fps = state.pop('_fp', None) or {}
+        super(SessionData, self).__setstate__(state)
+        self._v_fp = dict([(k, (self.data[k], fp)) for k, fp in fps.items()
+                           if k in self.data])
+
+    def _stateData(self):
+        """Return the 'data' of the state"""
+        return self.data
+
     # ZODB conflict resolution (to prevent write conflicts)
     # parts/inspiration taken from repoze.session
 
@@ -123,9 +465,55 @@ class SessionData(data.SessionData):
         extra = {}
         formatExtraData(extra, old=old, committed=committed, new=new)
         LOG.error("Competing writes to session data:", extra=extra)
+        metrics.failure('data', 'competing')
         raise ConflictError("Competing writes to session data:")
 
+    def _mergeData(self, old, committed, new):
+        """Three-way merge of the 'data' of committed and new against old.
+
+        Keys changed on both sides are handed to the conflict policy
+        registered for them, if any.
+
+        Return the merged dict or None if the changes collide.
+        """
+        old_data = old.get('data')
+        if old_data is None:
+            old_data = {}
+        committed_data = committed['data']
+        new_data = new['data']
+        for d in (old_data, committed_data, new_data):
+            if not isinstance(d, dict):
+                return None
+
+        def collide(key, o_value, c_value, n_value):
+            policy = queryConflictPolicy(
+                new.get('_pk', committed.get('_pk')), key)
+            if policy is None:
+                raise ConflictError("Competing writes to %r" % (key, ))
+            # offloaded values stay PersistentReferences, see
+            # IConflictPolicy
+            return policy(compression.uncompressed(o_value),
+                          compression.uncompressed(c_value),
+                          compression.uncompressed(n_value),
+                          committed['_lm'], new['_lm'])
+
+        try:
+            return _threeWayMerge(
+                old_data, committed_data, new_data, collide,
+                (old.get('_fp') or {}, committed.get('_fp') or {},
+                 new.get('_fp') or {}))
+        except ConflictError:
+            return None
+
+    @metrics.resolver('data')
     def _p_resolveConflict(self, old, committed, new):
+        # the states may come in either format, resolve the dict format and
+        # return the format of new
+        compact = isinstance(new, tuple)
+        old = _stateDict(old)
+        committed = _stateDict(committed)
+        new = _stateDict(new)
+
         # dict modifiers set '_lm'.
         resolved = dict(new)
         if committed['_lm'] != new['_lm']:
@@ -133,25 +521,172 @@ class SessionData(data.SessionData):
 
             # for this to work perfectly, you better put comparable items
             # into the session
-            # if they don't compare naturally, add a __cmp__ method
-            try:
-                neq = (committed['data'] != new['data'])
-            except ValueError:
-                # uncomparable PersistentReferences? -> raise ConflictError
-                neq = True
-            if neq:
-                # if it's a real conflict, raise ConflictError
-                # otherwise update the resolved dict with good values
-                self._internalResolveConflict(resolved, old, committed, new)
+            # if they don't compare naturally, add __eq__ and __ne__
+            # methods, or provide IFingerprinted
+            if _dataDiffers(committed, new):
+                # both sides wrote, merge the keys they touched,
+                # only changes to the same key are a real conflict
+                merged = self._mergeData(old, committed, new)
+                if merged is None:
+                    self._internalResolveConflict(
+                        resolved, old, committed, new)
+                resolved['data'] = merged
+                fps = _mergedFingerprints(merged, committed, new)
+                if fps:
+                    resolved['_fp'] = fps
+                else:
+                    resolved.pop('_fp', None)
 
         invalid = committed.get('_iv') or new.get('_iv')
         if invalid:
             resolved['_iv'] = True
         resolved['_lm'] = max(committed['_lm'], new['_lm'])
+        if compact:
+            return _compactState(resolved)
+        return resolved
+
+
+class _Unpacked(object):
+    """The data of CompressedSessionData, decompressed on first use
+
+    Like PersistentMapping.data, this is only used while the instance
+    has no 'data' of its own.
+    """
+
+    def __get__(self, inst, class_):
+        if inst is None:
+            return self
+        return inst._unpack()
+
+
+class CompressedSessionData(SessionData):
+    """Session data that stores big values compressed
+
+    Strings and containers whose pickle is at least _cz bytes are stored
+    as zlib compressed pickles, see cipher.session.compression.  They are
+    decompressed when data is first used, not when the session data is
+    loaded, e.g. to check whether it is valid.  Session data written
+    before its data was used writes the compressed values it loaded.
+    """
+
+    _cz = compression.THRESHOLD
+
+    data = _Unpacked()
+
+    def __setstate__(self, state):
+        super(CompressedSessionData, self).__setstate__(state)
+        if compression.isPacked(self.__dict__['data']):
+            self._v_packed = self.__dict__.pop('data')
+
+    def _unpack(self):
+        packed = self.__dict__.pop('_v_packed', None)
+        if packed is None:
+            raise AttributeError('data')
+        data, self._v_cz = compression.unpack(packed)
+        self.__dict__['data'] = data
+        return data
+
+    def _stateData(self):
+        packed = self.__dict__.get('_v_packed')
+        if packed is not None:
+            return packed
+        packed, self._v_cz = compression.pack(
+            self.data, self._cz, getattr(self, '_v_cz', None))
+        return packed
+
+
+class OffloadingSessionData(SessionData):
+    """Session data that stores big values apart
+
+    Strings and containers whose pickle is at least _ol bytes are moved to
+    persistent objects of their own when the session data is written, see
+    cipher.session.offload.  Writing the session data after changing a
+    small value doesn't write them again, loading it doesn't load them
+    until they are read.  Changing a value read from there in place
+    doesn't write it, set it again.  Conflict resolution sees the
+    references of offloaded values, each new value gets a new one.
+    """
+
+    _ol = offload.THRESHOLD
+
+    def __getitem__(self, key):
+        return offload.loaded(self.data[key])
+
+    def items(self):
+        return [(k, offload.loaded(v)) for k, v in self.data.items()]
+
+    def values(self):
+        return [offload.loaded(v) for v in self.data.values()]
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def itervalues(self):
+        return iter(self.values())
+
+    def pop(self, key, *args):
+        return offload.loaded(
+            super(OffloadingSessionData, self).pop(key, *args))
+
+    def popitem(self):
+        key, value = super(OffloadingSessionData, self).popitem()
+        return key, offload.loaded(value)
+
+    def _stateData(self):
+        data = self.data
+        for key, value in list(data.items()):
+            if offload.isOffloaded(value):
+                continue
+            stored = offload.offload(value, self._ol, self._p_jar)
+            if stored is not None:
+                data[key] = stored
+        return data
+
+
+class BucketIndex(PersistentMapping):
+    """The buckets of a SessionDataManager by the start of their period
+
+    Values are (bucket, ahead) tuples, ahead is true for buckets created
+    before their period started.  Creating the next bucket ahead makes head
+    rotation conflict-free: concurrent requests crossing a period boundary
+    find the bucket there or all add an (empty) one for the same key, which
+    _p_resolveConflict reduces to the committed one.  After an idle period
+    they all move the same bucket created ahead to the current period (see
+    SessionDataManager._takeOver), which merges as the same change.  Only
+    managers without a bucket created ahead, e.g. migrated ones, still
+    conflict when concurrent requests create the head.
+    """
+
+    @metrics.resolver('index')
+    def _p_resolveConflict(self, old, committed, new):
+        # we are operating against the PersistentMapping.__getstate__
+        def collide(key, o_value, c_value, n_value):
+            if (o_value is _marker and c_value is not _marker
+                    and n_value is not _marker and c_value[1]
+                    and n_value[1]):
+                # both created the bucket ahead, nobody wrote into new's
+                return c_value
+            metrics.failure('index', 'competing')
+            raise ConflictError("Competing writes to bucket %r" % (key, ))
+
+        resolved = dict(new)
+        resolved['data'] = _threeWayMerge(
+            old['data'], committed['data'], new['data'], collide)
         return resolved
 
 
-@zope.interface.implementer(interfaces.ISessionDataManager)
+class _ManagerTransaction(object):
+    """What a transaction did with a SessionDataManager"""
+
+    def __init__(self):
+        # key -> (new session data, when) to store if it's modified
+        self.new = {}
+        # lookup cache key -> (session data, slice) to add after commit
+        self.cached = {}
+
+
+@zope.interface.implementer(interfaces.ISessionDataManager,
+                            interfaces.ISessionInvalidation)
 class SessionDataManager(manager.SessionDataManager, Location):
 
     # We have the option of using an OOBTree as a bucket type or an
@@ -164,44 +699,564 @@ class SessionDataManager(manager.SessionDataManager, Location):
     # Make the data type replaceable for unit tests.
     _DATA_TYPE = SessionData
 
-    def __init__(self):
+    # With shards > 1 new buckets are ShardedBuckets instead of _BUCKET_TYPE.
+    shards = 1
+
+    # With inline_gc expired buckets are removed by the request that
+    # creates the next bucket, otherwise leave that to gc().
+    inline_gc = True
+
+    # A session found in an older bucket is only copied into the head
+    # bucket (which is what keeps it alive) if that bucket is at least
+    # touch_resolution seconds older than the head.
+    touch_resolution = 0
+
+    # Values of new session data whose pickle is at least this many bytes
+    # are stored compressed, see CompressedSessionData.
+    compress_threshold = None
+
+    # Values of new session data whose pickle is at least this many bytes
+    # are stored apart, see OffloadingSessionData.  Takes precedence over
+    # compress_threshold.
+    offload_threshold = None
+
+    # The buckets by the start of their period (a BucketIndex).  Managers
+    # from before the index kept them in a linked list in 'head', see
+    # _getIndex.
+    _index = None
+
+    # Incremented by clear(), lookup cache entries of other generations
+    # are ignored.
+    _generation = 0
+
+    def __init__(self, shards=1, lazy=False):
+        self.shards = shards
         # some init values from zope.session
-        super(SessionDataManager, self).__init__(1 * 60 * 60, 10 * 60)
-        # houston, we got a problem with ftests
-        self.nonlazy = True
+        self.timeout = 1 * 60 * 60
+        self.period = 10 * 60
+        self._index = BucketIndex()
+        # Lazy managers only store new session data once it's modified,
+        # e.g. not for crawlers that never log in.  Not the default, that
+        # stores all session data when it's created.
+        self.nonlazy = not lazy
+
+    def _newBucket(self):
+        if self.shards > 1:
+            return ShardedBucket(self.shards)
+        return self._BUCKET_TYPE()
+
+    def _slice(self, when=None):
+        return int(manager.timeslice(self.period, when))
+
+    def _getIndex(self):
+        if self._index is None:
+            # migrate the linked list of (time, bucket) ListNodes
+            index = BucketIndex()
+            node = self.__dict__.get('head')
+            while node is not None:
+                when, bucket = node.ob
+                index.setdefault(self._slice(when), (bucket, False))
+                node = node.next
+            self.__dict__.pop('head', None)
+            self._index = index
+        return self._index
+
+    def _headBucket(self, when=None):
+        """Return the bucket of the current period to write into"""
+        now = self._slice(when)
+        index = self._getIndex()
+        entry = index.get(now)
+        if entry is None:
+            bucket = self._takeOver(index, now)
+            if bucket is None:
+                # nobody created it ahead, concurrent creations conflict
+                bucket = self._newBucket()
+            index[now] = (bucket, False)
+        else:
+            bucket, ahead = entry
+            if ahead and bucket._p_serial == z64:
+                # created ahead by this very transaction, don't let
+                # conflict resolution throw it away now that it has data
+                index[now] = (bucket, False)
+        if now + self.period not in index:
+            index[now + self.period] = (self._newBucket(), True)
+            if self.inline_gc:
+                self.gc(when=when)
+        return bucket
+
+    def _takeOver(self, index, now):
+        """Return the bucket created ahead for a period nobody wrote in
+
+        After an idle period the newest bucket is one created ahead for a
+        period that has passed, it's empty.  Concurrent requests all move
+        it to the current period, BucketIndex._p_resolveConflict merges
+        that like the creation of the same bucket.
+        """
+        if not index:
+            return None
+        newest = max(index.keys())
+        bucket, ahead = index[newest]
+        if newest >= now or not ahead or len(bucket):
+            return None
+        del index[newest]
+        return bucket
+
+    def set(self, k, v, when=None):
+        bucket = self._headBucket(when)
+        old = bucket.get(k)
+        if old is not None and not old.is_valid():
+            # invalidated in this period, e.g. by invalidate_clients
+            bucket.replace(k, v)
+        else:
+            bucket[k] = v
+
+    def search(self, k, default=None, when=None):   # 'when' for testing
+        return self.search_many((k, ), when=when).get(k, default)
+
+    def _lookupCache(self):
+        """Return the ISessionLookupCache if there is one and we can use it"""
+        if self._p_jar is None or self._p_oid is None:
+            return None
+        return zope.component.queryUtility(interfaces.ISessionLookupCache)
+
+    def _cacheKey(self, key):
+        # databases on a host may share the cache and have managers with
+        # the same oid, their storages have different names
+        storage = self._p_jar.db().storage.getName()
+        if not isinstance(storage, text_type):
+            storage = storage.decode('utf-8', 'replace')
+        return u'%s\x00%s\x00%s' % (storage,
+                                     hexlify(self._p_oid).decode('ascii'),
+                                     _keyString(key))
+
+    def _searchCache(self, cache, keys, now):
+        """Return the session data of keys the lookup cache knows
+
+        Only entries of live, untouched session data of the current
+        generation are used, the rest is looked up in the buckets.
+        """
+        keys = dict([(self._cacheKey(k), k) for k in keys])
+        found = {}
+        for cache_key, (oid, bucket_slice, generation) in cache.get_many(
+                keys).items():
+            if generation != self._generation:
+                continue
+            if now - bucket_slice > self.timeout:
+                continue
+            if (bucket_slice != now
+                    and now - bucket_slice >= self.touch_resolution):
+                # the bucket scan will touch it
+                continue
+            try:
+                sdo = self._p_jar.get(oid)
+                sdo._p_activate()
+            except (POSKeyError, ReadConflictError):
+                # not in the snapshot of this connection
+                continue
+            if not ISessionData.providedBy(sdo):
+                # an entry of another database
+                continue
+            if not sdo.is_valid():
+                continue
+            found[keys[cache_key]] = sdo
+        metrics.incr('lookup_cache.hit', len(found))
+        metrics.incr('lookup_cache.miss', len(keys) - len(found))
+        return found
+
+    def _join(self):
+        """Return what the current transaction did with us"""
+        txn = transaction.get()
+        try:
+            return txn.data(self)
+        except KeyError:
+            pass
+        state = _ManagerTransaction()
+        txn.set_data(self, state)
+        txn.addBeforeCommitHook(self._storeNew, (state, ))
+        txn.addAfterCommitHook(self._writeCache, (state, ))
+        return state
+
+    def _storeNew(self, state):
+        """Store the new session data of a lazy transaction that changed"""
+        for key, (sdo, when) in state.new.items():
+            if sdo.last_modified is None or not sdo.is_valid():
+                metrics.incr('lazy.discarded')
+                continue
+            self.set(key, sdo, when)
+            metrics.incr('lazy.stored')
+            if self._lookupCache() is not None:
+                self._cacheLater(key, sdo, self._slice(when))
+        state.new.clear()
+
+    def _cacheLater(self, key, sdo, now):
+        """Add key to the lookup cache once sdo is committed"""
+        self._join().cached[self._cacheKey(key)] = (sdo, now)
+
+    def _writeCache(self, status, state):
+        if not status or not state.cached:
+            return
+        cache = self._lookupCache()
+        if cache is None:
+            return
+        cache.set_many([
+            (cache_key, (sdo._p_oid, bucket_slice, self._generation))
+            for cache_key, (sdo, bucket_slice) in state.cached.items()
+            if sdo._p_oid is not None])
+
+    def search_many(self, keys, when=None,   # 'when' for testing
+                    touch=True):
+        """Return a dict of the keys found and their values
+
+        Looks for all keys in one pass over the live buckets, newest first.
+        With an ISessionLookupCache the keys it knows are loaded by oid
+        without unpickling their buckets.  Unless touch is false, session
+        data found in older buckets is kept alive (see touch_resolution).
+        """
+        now = self._slice(when)
+        index = self._getIndex()
+
+        missing = keys
+        found = {}
+
+        cache = self._lookupCache()
+        if cache is not None and keys:
+            found = self._searchCache(cache, keys, now)
+            missing = [k for k in keys if k not in found]
+            cached = []
+
+        bucket_slice = now
+        while missing and now - bucket_slice <= self.timeout:
+            entry = index.get(bucket_slice)
+            if entry is not None:
+                bucket = entry[0]
+                still_missing = []
+                for k in missing:
+                    value = bucket.get(k, _marker)
+                    if value is _marker:
+                        still_missing.append(k)
+                        continue
+                    touched = False
+                    if (touch and bucket_slice != now
+                            and value.is_valid()):
+                        if now - bucket_slice >= self.touch_resolution:
+                            self.set(k, value, when)
+                            metrics.incr('touch.written')
+                            touched = True
+                        else:
+                            # recent enough, save the write
+                            metrics.incr('touch.skipped')
+                    if cache is not None:
+                        if touched or value._p_oid is None:
+                            self._cacheLater(k, value, now)
+                        else:
+                            cached.append(
+                                (self._cacheKey(k),
+                                 (value._p_oid, bucket_slice,
+                                  self._generation)))
+                    found[k] = value
+                missing = still_missing
+            bucket_slice -= self.period
+
+        if cache is not None and cached:
+            cache.set_many(cached)
+        return found
+
+    def gc(self, max_buckets=None, max_seconds=None, when=None):
+        """Remove expired buckets, the oldest first
+
+        Notifies the end of their sessions.  Stops after removing
+        max_buckets buckets or after max_seconds, commit and call again
+        until it returns 0.
+
+        Return the number of buckets removed.
+        """
+        start = time.time()
+        live = self._slice(when) - self.timeout
+        index = self._getIndex()
+
+        removed = 0
+        slices = sorted(index.keys())
+        for bucket_slice in slices:
+            if bucket_slice >= live:
+                break
+            if bucket_slice == slices[-1] and index[bucket_slice][1]:
+                # created ahead, the next head takes it over
+                break
+            if max_buckets is not None and removed >= max_buckets:
+                break
+            if (max_seconds is not None and removed
+                    and time.time() - start >= max_seconds):
+                break
+            bucket = index[bucket_slice][0]
+            newer_buckets = [entry[0] for s, entry in index.items()
+                             if s > bucket_slice]
+            for k, v in bucket.items():
+                for newer_bucket in newer_buckets:
+                    if k in newer_bucket:
+                        # the session lives on (or ends) in a newer bucket
+                        break
+                else:
+                    if not _isPrincipalKey(k):
+                        notify(manager.SessionEndEvent(v))
+            del index[bucket_slice]
+            removed += 1
+        if removed:
+            cache = self._lookupCache()
+            if cache is not None:
+                cache.prune(live)
+        return removed
+
+    def query_many(self, keys, default=None, when=None):  # 'when' for testing
+        keys = list(keys)
+        found = self.search_many(keys, when=when)
+        return dict([(k, found.get(k, default)) for k in keys])
+
+    def _newData(self, key):
+        if self.offload_threshold:
+            sdo = OffloadingSessionData()
+            sdo._ol = self.offload_threshold
+        elif self.compress_threshold:
+            sdo = CompressedSessionData()
+            sdo._cz = self.compress_threshold
+        else:
+            sdo = self._DATA_TYPE()
+        if isinstance(key, tuple) and len(key) == 2:
+            # keys are (client_id, pkg_id) when coming from Session
+            sdo._pk = key[1]
+        return sdo
+
+    def get(self, key, when=None):
+        # taken from repoze.session, uses _newData to create session data
+        sdo = self.search(key, when=when)
+
+        if sdo is None or not sdo.is_valid():
+            if not self.nonlazy:
+                # created earlier in this transaction, not stored yet
+                pending = self._join().new.get(key)
+                if pending is not None and pending[0].is_valid():
+                    return pending[0]
+            sdo = self._newData(key)
+            # see repoze.session about lazy vs. nonlazy, we store new
+            # session data when the transaction commits if it was modified
+            # by then (see _storeNew)
+            if self.nonlazy:
+                self.set(key, sdo, when)
+                if self._lookupCache() is not None:
+                    self._cacheLater(key, sdo, self._slice(when))
+            else:
+                self._join().new[key] = (sdo, when)
+
+            notify(manager.SessionBeginEvent(sdo))
+
+        return sdo
 
     def clear(self):
-        self.head = self.new_head(None)
+        self._index = BucketIndex()
+        # lookup cache entries from before are ignored
+        self._generation += 1
 
     def __getitem__(self, key):
         return self.get(key)
 
+    def _liveKeys(self, when=None):
+        """Yield the keys of the live buckets, newest first
+
+        Only unpickles the buckets, not the session data in them.
+        """
+        now = self._slice(when)
+        index = self._getIndex()
+        for bucket_slice in sorted(index.keys(), reverse=True):
+            if bucket_slice > now:
+                # created ahead
+                continue
+            if now - bucket_slice > self.timeout:
+                break
+            for key in index[bucket_slice][0].keys():
+                yield key
+
+    def invalidate_clients(self, client_ids, when=None):  # 'when' for testing
+        """See ISessionInvalidation
+
+        Looks for the keys of the clients in the live buckets, without
+        loading the session data of other clients.
+        """
+        client_ids = set(client_ids)
+        keys = set([k for k in self._liveKeys(when)
+                    if isinstance(k, tuple) and len(k) == 2
+                    and k[0] in client_ids])
+        invalidated = 0
+        for sdo in self.search_many(list(keys), when=when,
+                                    touch=False).values():
+            if sdo.is_valid():
+                sdo.invalidate()
+                invalidated += 1
+        metrics.incr('invalidated', invalidated)
+        return invalidated
+
+    def add_principal(self, principal_id, client_id,
+                      when=None):  # 'when' for testing
+        """See ISessionInvalidation
+
+        Appends to the head bucket like session data does, and like session
+        data the entry is kept alive by writing it again, at most once per
+        touch_resolution.
+        """
+        key = (_PRINCIPAL, principal_id, client_id)
+        now = self._slice(when)
+        index = self._getIndex()
+        bucket_slice = now
+        while (now - bucket_slice <= self.timeout
+               and (bucket_slice == now
+                    or now - bucket_slice < self.touch_resolution)):
+            entry = index.get(bucket_slice)
+            if entry is not None and key in entry[0]:
+                return
+            bucket_slice -= self.period
+        bucket = self._headBucket(when)
+        if key not in bucket:
+            bucket[key] = True
+
+    def invalidate_principals(self, principal_ids,
+                              when=None):  # 'when' for testing
+        """See ISessionInvalidation
+
+        Invalidates the clients the principals used within the timeout.
+        """
+        principal_ids = set(principal_ids)
+        client_ids = set([k[2] for k in self._liveKeys(when)
+                          if _isPrincipalKey(k) and k[1] in principal_ids])
+        return self.invalidate_clients(sorted(client_ids), when=when)
+
+    @metrics.resolver('manager')
+    def _p_resolveConflict(self, old, committed, new):
+        if 'head' in old and 'head' in new and 'head' in committed:
+            # not migrated to the bucket index yet
+            return super(SessionDataManager, self)._p_resolveConflict(
+                old, committed, new)
+        # the buckets live in _index, we only change when we're configured,
+        # cleared or migrated
+        metrics.failure('manager', 'competing')
+        raise ConflictError("Competing writes to session data manager")
+
+
+def _beforeCommit(hook, ob):
+    """Call hook(ob) when the current transaction commits, once
+
+    Requests may commit several times, objects kept for the whole request
+    join each transaction they are used in.
+    """
+    txn = transaction.get()
+    try:
+        txn.data(ob)
+    except KeyError:
+        txn.set_data(ob, True)
+        txn.addBeforeCommitHook(hook, (ob, ))
+
+
+class _RequestCache(object):
+    """What Session looked up during a request, kept in its annotations"""
+
+    def __init__(self, client_id):
+        self.client_id = client_id
+        # pkg_id -> ISessionDataManager
+        self.managers = {}
+        # (client_id, pkg_id) -> session data
+        self.data = {}
+        # id() of the managers told about the principal of the request
+        self.principals = set()
+
 
 @zope.interface.implementer(ISession)
 class Session(object):
     """See zope.session.interfaces.ISession"""
     zope.component.adapts(IRequest)
 
+    # the session data of a request is looked up once and stored in the
+    # request annotations under this key
+    cacheKey = 'cipher.session.cache'
+
     def __init__(self, request):
-        self.client_id = str(IClientId(request))
+        cache = request.annotations.get(self.cacheKey)
+        if cache is None:
+            cache = _RequestCache(str(IClientId(request)))
+            request.annotations[self.cacheKey] = cache
+        self.request = request
+        self._cache = cache
+        self.client_id = cache.client_id
 
     def _sdc(self, pkg_id):
-        return zope.component.getUtility(interfaces.ISessionDataManager)
+        sdc = self._cache.managers.get(pkg_id)
+        if sdc is None:
+            # a manager of the package, e.g. with a shorter timeout, or the
+            # default one
+            sdc = zope.component.queryUtility(
+                interfaces.ISessionDataManager, name=pkg_id)
+            if sdc is None:
+                sdc = zope.component.getUtility(
+                    interfaces.ISessionDataManager)
+            self._cache.managers[pkg_id] = sdc
+        if id(sdc) not in self._cache.principals:
+            self._addPrincipal(sdc)
+        return sdc
 
-    def get(self, pkg_id, default=None):
-        sdc = self._sdc(pkg_id)
+    def _addPrincipal(self, sdc):
+        """Tell sdc the principal of the request, once it's authenticated"""
+        principal = getattr(self.request, 'principal', None)
+        if principal is None or (
+                IUnauthenticatedPrincipal is not None
+                and IUnauthenticatedPrincipal.providedBy(principal)):
+            return
+        if interfaces.ISessionInvalidation.providedBy(sdc):
+            sdc.add_principal(principal.id, self.client_id)
+        self._cache.principals.add(id(sdc))
 
+    def get(self, pkg_id, default=None):
         # flat SessionDataManager/SessionData structure
         # still have a feeling that updating leaf objects won't update
         # last_modified time
         ident = (self.client_id, pkg_id)
 
-        return sdc.query(ident, default)
+        data = self._cache.data.get(ident)
+        if data is None:
+            data = self._sdc(pkg_id).query(ident)
+            if data is None:
+                return default
+            self._cache.data[ident] = data
+        return data
+
+    def get_many(self, pkg_ids, default=None):
+        """Return a dict of the session data of the packages
+
+        The data of packages not in the request cache yet is looked up in
+        one go per session data manager.
+        """
+        result = {}
+        # id(sdc) -> (sdc, idents)
+        lookups = {}
+        for pkg_id in pkg_ids:
+            ident = (self.client_id, pkg_id)
+            data = self._cache.data.get(ident)
+            if data is None:
+                sdc = self._sdc(pkg_id)
+                lookups.setdefault(id(sdc), (sdc, []))[1].append(ident)
+            else:
+                result[pkg_id] = data
+        for sdc, idents in lookups.values():
+            for ident, data in sdc.query_many(idents).items():
+                if data is None:
+                    data = default
+                else:
+                    self._cache.data[ident] = data
+                result[ident[1]] = data
+        return result
 
     def __getitem__(self, pkg_id):
-        sdc = self._sdc(pkg_id)
         ident = (self.client_id, pkg_id)
-        return sdc.get(ident)
+        data = self._cache.data.get(ident)
+        if data is None or not data.is_valid():
+            data = self._sdc(pkg_id).get(ident)
+            self._cache.data[ident] = data
+        return data
 
 
 class TransientSession(object):
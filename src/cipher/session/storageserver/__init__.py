@@ -0,0 +1,25 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Register the conflict policies in a storage server process
+
+Importing this package calls loadConflictPolicies(), see policy.py.  It is
+also a ZConfig component, so a ZEO server loads it with::
+
+    %import cipher.session.storageserver
+
+at the top of zeo.conf.
+"""
+from cipher.session.policy import loadConflictPolicies
+
+loadConflictPolicies()
@@ -51,6 +51,17 @@ class ApppendOnlyDictTests(unittest.TestCase):
         aod['somekey'] = 'somevalue'
         self.assertRaises(TypeError, aod.__delitem__, 'somekey')
 
+    def test_replace_existing_key(self):
+        aod = self._makeOne()
+        aod['somekey'] = 'somevalue'
+        aod.replace('somekey', 'othervalue')
+        self.assertEqual(aod['somekey'], 'othervalue')
+        self.assertEqual(aod._rc, {'somekey': 1})
+
+    def test_replace_non_existing_key_raises_KeyError(self):
+        aod = self._makeOne()
+        self.assertRaises(KeyError, aod.replace, 'somekey', 'somevalue')
+
     def _call_p_resolveConflict(self, old, committed, new):
         aod = self._makeOne()
         # _p_resolveConflict must be called with persistent state
@@ -111,6 +122,27 @@ class ApppendOnlyDictTests(unittest.TestCase):
         with self.assertRaises(ConflictError):
             self._call_p_resolveConflict(old, committed, new)
 
+    def test__p_resolveConflict_with_committed_shrink(self):
+        from ZODB.POSException import ConflictError
+
+        old = self._makeOne({'a': 'A', 'b': 'B'})
+        committed = self._makeOne({'c': 'C'})
+        new = old.copy()
+        new['d'] = 'D'
+
+        with self.assertRaises(ConflictError):
+            self._call_p_resolveConflict(old, committed, new)
+
+    def test__p_resolveConflict_no_repr_on_success(self):
+        old = self._makeOne({'a': NoRepr('A')})
+        committed = old.copy()
+        committed['c'] = NoRepr('C')
+        new = old.copy()
+        new['d'] = NoRepr('D')
+
+        resolved = self._call_p_resolveConflict(old, committed, new)
+        self.assertEqual(sorted(resolved['data']), ['a', 'c', 'd'])
+
     def test__p_resolveConflict_with_collisions(self):
         from ZODB.POSException import ConflictError
 
@@ -124,6 +156,31 @@ class ApppendOnlyDictTests(unittest.TestCase):
         with self.assertRaises(ConflictError):
             self._call_p_resolveConflict(old, committed, new)
 
+    def test__p_resolveConflict_replaced(self):
+        old = self._makeOne({'a': 'A', 'b': 'B'})
+        committed = self._makeOne({'a': 'A', 'b': 'B'})
+        committed.replace('a', 'AA')
+        committed['c'] = 'C'
+        new = self._makeOne({'a': 'A', 'b': 'B'})
+        new.replace('b', 'BB')
+
+        resolved = self._call_p_resolveConflict(old, committed, new)
+        self.assertEqual(resolved['data'],
+                         {'a': 'AA', 'b': 'BB', 'c': 'C'})
+        self.assertEqual(resolved['_rc'], {'a': 1, 'b': 1})
+
+    def test__p_resolveConflict_both_replaced(self):
+        from ZODB.POSException import ConflictError
+
+        old = self._makeOne({'a': 'A'})
+        committed = self._makeOne({'a': 'A'})
+        committed.replace('a', 'AA')
+        new = self._makeOne({'a': 'A'})
+        new.replace('a', 'AAA')
+
+        with self.assertRaises(ConflictError):
+            self._call_p_resolveConflict(old, committed, new)
+
     def test__p_resolveConflict_same_inserted(self):
         old = self._makeOne(
             {('sid_1', u'app.auth'): 'pers_repr_1',
@@ -176,6 +233,106 @@ class ApppendOnlyDictTests(unittest.TestCase):
         with self.assertRaises(ConflictError):
             self._call_p_resolveConflict(old, committed, new)
 
+    def test__p_resolveConflict_same_inserted_fingerprints(self):
+        big = 'x' * 2000
+        old = self._makeOne()
+        old['a'] = 'A'
+        committed = old.copy()
+        committed['b'] = big
+        new = old.copy()
+        new['b'] = big
+        new['c'] = big + 'c'
+        self.assertEqual(sorted(new._fp), ['b', 'c'])
+        new_state = new.__getstate__()
+        # the values themselves are not compared
+        new_state['data']['b'] = PersistentReferenceStub('PR1')
+        resolved = old._p_resolveConflict(old.__getstate__(),
+                                          committed.__getstate__(),
+                                          new_state)
+        self.assertEqual(sorted(resolved['data']), ['a', 'b', 'c'])
+        self.assertEqual(resolved['data']['b'], big)
+        self.assertEqual(sorted(resolved['_fp']), ['b', 'c'])
+
+
+class ShardedBucketTests(unittest.TestCase):
+
+    def _makeOne(self, shards=4):
+        from cipher.session.session import ShardedBucket
+        return ShardedBucket(shards)
+
+    def test_mapping(self):
+        bucket = self._makeOne()
+        self.assertEqual(len(bucket), 0)
+        for i in range(20):
+            bucket[('client-%d' % i, u'app.auth')] = i
+        self.assertEqual(len(bucket), 20)
+        self.assertEqual(bucket[('client-3', u'app.auth')], 3)
+        self.assertEqual(bucket.get(('client-3', u'app.auth')), 3)
+        self.assertEqual(bucket.get(('nobody', u'app.auth'), 'x'), 'x')
+        self.assertTrue(('client-3', u'app.auth') in bucket)
+        self.assertFalse(('nobody', u'app.auth') in bucket)
+        self.assertEqual(sorted(bucket.values()), list(range(20)))
+        self.assertEqual(sorted(bucket.keys()), sorted(dict(bucket.items())))
+
+    def test_keys_spread_over_shards(self):
+        bucket = self._makeOne()
+        for i in range(100):
+            bucket[('client-%d' % i, u'app.auth')] = i
+        for shard in bucket.shards:
+            self.assertTrue(0 < len(shard) < 100)
+
+    def test_insert_touches_one_shard(self):
+        bucket = self._makeOne()
+        bucket['foo'] = 'bar'
+        self.assertEqual(sum([len(s) for s in bucket.shards]), 1)
+
+    def test_still_append_only(self):
+        bucket = self._makeOne()
+        bucket['foo'] = 'bar'
+        self.assertRaises(TypeError, bucket.__setitem__, 'foo', 'baz')
+
+    def test_shard_hash_is_stable(self):
+        from cipher.session.session import _shardHash
+        self.assertEqual(_shardHash(('foobar', u'app.auth')),
+                         _shardHash((u'foobar', 'app.auth')))
+        self.assertEqual(_shardHash(('foobar', u'app.auth')), 1648978241)
+
+
+class BucketIndexTests(unittest.TestCase):
+
+    def _resolve(self, old, committed, new):
+        from cipher.session.session import BucketIndex
+        return BucketIndex()._p_resolveConflict(
+            {'data': old}, {'data': committed}, {'data': new})
+
+    def test_both_created_ahead(self):
+        resolved = self._resolve({1: ('b1', False)},
+                                 {1: ('b1', False), 2: ('c2', True)},
+                                 {1: ('b1', False), 2: ('n2', True)})
+        self.assertEqual(resolved['data'], {1: ('b1', False), 2: ('c2', True)})
+
+    def test_created_ahead_and_written(self):
+        from ZODB.POSException import ConflictError
+        self.assertRaises(ConflictError, self._resolve,
+                          {1: ('b1', False)},
+                          {1: ('b1', False), 2: ('c2', True)},
+                          {1: ('b1', False), 2: ('n2', False)})
+
+    def test_removed_and_added(self):
+        resolved = self._resolve({1: ('b1', False), 2: ('b2', False)},
+                                 {2: ('b2', False)},
+                                 {1: ('b1', False), 2: ('b2', False),
+                                  3: ('n3', True)})
+        self.assertEqual(resolved['data'], {2: ('b2', False), 3: ('n3', True)})
+
+
+class NoRepr(object):
+    def __init__(self, data):
+        self.data = data
+
+    def __repr__(self):
+        raise AssertionError("repr() on the success path")
+
 
 class PersistentReferenceStub(object):
     def __init__(self, data):
@@ -199,6 +356,8 @@ class PersistentReferenceStub(object):
 def test_suite():
     return unittest.TestSuite((
         unittest.makeSuite(ApppendOnlyDictTests),
+        unittest.makeSuite(ShardedBucketTests),
+        unittest.makeSuite(BucketIndexTests),
         ))
 
 if __name__ == '__main__':
@@ -0,0 +1,89 @@
+"""Tests of the session access for event loops"""
+
+import unittest
+
+import transaction
+from ZODB.DB import DB
+from ZODB.MappingStorage import MappingStorage
+
+from cipher.session import metrics
+
+
+class TestAsyncSession(unittest.TestCase):
+
+    def setUp(self):
+        from cipher.session.asyncsession import SessionExecutor
+        from cipher.session.session import SessionDataManager
+        self.db = DB(MappingStorage())
+        conn = self.db.open()
+        conn.root()['sdm'] = SessionDataManager()
+        transaction.commit()
+        conn.close()
+        self.executor = SessionExecutor(
+            self.db, workers=1, getManager=lambda conn: conn.root()['sdm'])
+        metrics.reset()
+
+    def tearDown(self):
+        self.executor.shutdown()
+        self.db.close()
+        metrics.reset()
+
+    def _makeOne(self, client_id='client'):
+        from cipher.session.asyncsession import AsyncSession
+        return AsyncSession(self.executor, client_id)
+
+    def test_roundtrip(self):
+        session = self._makeOne()
+        self.assertEqual(session.get(u'app').result(), None)
+        data = session.item(u'app').result()
+        data['foo'] = 'bar'
+        session.commit().result()
+
+        session = self._makeOne()
+        data = session.get(u'app').result()
+        self.assertEqual(dict(data), {'foo': 'bar'})
+        found = session.get_many([u'app', u'other'], default=0).result()
+        self.assertEqual(found, {u'app': data, u'other': 0})
+        session.abort().result()
+
+    def test_request_cache(self):
+        session = self._makeOne()
+        data = session.item(u'app').result()
+        self.assertTrue(session.get(u'app').done())
+        self.assertTrue(session.get(u'app').result() is data)
+        self.assertEqual(metrics.counters['async.lookups'], 1)
+        session.abort().result()
+
+    def test_abort(self):
+        session = self._makeOne()
+        session.item(u'app').result()['foo'] = 'bar'
+        session.abort().result()
+        session = self._makeOne()
+        self.assertEqual(session.get(u'app').result(), None)
+        session.abort().result()
+
+    def test_bounded(self):
+        first = self._makeOne('first')
+        second = self._makeOne('second')
+        first.item(u'app').result()
+        # the only worker is busy with the transaction of first
+        waiting = second.item(u'app')
+        self.assertFalse(waiting.done())
+        self.assertEqual(metrics.counters['async.waited'], 1)
+        first.commit().result()
+        self.assertEqual(dict(waiting.result()), {})
+        second.commit().result()
+
+    def test_errors(self):
+        session = self._makeOne()
+        self.executor.getManager = lambda conn: None
+        self.assertRaises(AttributeError, session.item(u'app').result)
+        # the worker is released
+        session.abort().result()
+        self.assertEqual(len(self.executor._free), 1)
+
+
+def test_suite():
+    return unittest.TestSuite((
+        unittest.makeSuite(TestAsyncSession),
+        ))
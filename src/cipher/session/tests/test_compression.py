@@ -0,0 +1,194 @@
+"""Tests of compressed session data values"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import transaction
+from persistent.mapping import PersistentMapping
+from ZODB.DB import DB
+from ZODB.MappingStorage import MappingStorage
+
+from cipher.session import metrics
+
+
+class TestCompress(unittest.TestCase):
+
+    def test_roundtrip(self):
+        from cipher.session.compression import compress
+        value = {'ids': list(range(1000))}
+        compressed = compress(value, 100)
+        self.assertEqual(compressed.value(), value)
+        self.assertEqual(compressed, compress(value, 100))
+
+    def test_not_worth_it(self):
+        from cipher.session.compression import compress
+        self.assertEqual(compress(list(range(10)), 100), None)
+        self.assertEqual(compress('x' * 99, 100), None)
+        self.assertEqual(compress(os.urandom(1000), 100), None)
+        self.assertEqual(compress(12345678, 1), None)
+
+    def test_persistent_values_are_not_compressed(self):
+        from cipher.session.compression import compress
+        self.assertEqual(compress([PersistentMapping()] * 100, 10), None)
+
+
+class TestCompressedSessionData(unittest.TestCase):
+
+    def setUp(self):
+        from cipher.session.session import SessionDataManager
+        self.db = DB(MappingStorage())
+        self.conn = self.db.open()
+        self.sdm = self.conn.root()['sdm'] = SessionDataManager()
+        self.sdm.compress_threshold = 100
+        transaction.commit()
+        metrics.reset()
+
+    def tearDown(self):
+        transaction.abort()
+        self.conn.close()
+        self.db.close()
+
+    def _load(self):
+        conn = self.db.open(
+            transaction_manager=transaction.TransactionManager())
+        self.addCleanup(conn.close)
+        return conn.root()['sdm'].query('foobar')
+
+    def test_big_values_are_compressed(self):
+        sdo = self.sdm.get('foobar')
+        ids = ['item-%d' % i for i in range(1000)]
+        sdo['ids'] = ids
+        sdo['small'] = 1
+        transaction.commit()
+        state = self.db.storage.load(sdo._p_oid)[0]
+        self.assertTrue(len(state) < 5000)
+
+        loaded = self._load()
+        self.assertTrue(loaded.is_valid())
+        self.assertEqual(
+            metrics.counters.get('compression.decompressed', 0), 0)
+        self.assertEqual(loaded['ids'], ids)
+        self.assertEqual(loaded['small'], 1)
+        self.assertEqual(metrics.counters['compression.decompressed'], 1)
+
+    def test_written_without_being_used(self):
+        sdo = self.sdm.get('foobar')
+        sdo['ids'] = list(range(1000))
+        transaction.commit()
+        loaded = self._load()
+        loaded.invalidate()
+        loaded._p_jar.transaction_manager.commit()
+        self.assertEqual(
+            metrics.counters.get('compression.decompressed', 0), 0)
+        self.assertEqual(metrics.counters['compression.compressed'], 1)
+        loaded = self._load()
+        self.assertFalse(loaded.is_valid())
+        self.assertEqual(loaded['ids'], list(range(1000)))
+
+    def test_changed_in_place(self):
+        sdo = self.sdm.get('foobar')
+        sdo['ids'] = ids = list(range(1000))
+        sdo['text'] = text = u'x' * 1000
+        transaction.commit()
+        ids.append(1000)
+        sdo['other'] = 1
+        transaction.commit()
+        # the string wasn't compressed again
+        self.assertEqual(metrics.counters['compression.compressed'], 3)
+        loaded = self._load()
+        self.assertEqual(loaded['ids'], ids)
+        self.assertEqual(loaded['text'], text)
+
+    def test_compressed_later(self):
+        sdo = self.sdm.get('foobar')
+        sdo['small'] = 1
+        transaction.commit()
+        # nothing was compressed the first time
+        sdo['ids'] = list(range(1000))
+        transaction.commit()
+        self.assertEqual(metrics.counters['compression.compressed'], 1)
+        self.assertEqual(self._load()['ids'], list(range(1000)))
+
+    def test_equal_values_compressed_differently(self):
+        import zlib
+        from cipher.session._compat import pickle
+        from cipher.session.compression import Compressed
+        pickled = pickle.dumps(list(range(1000)), 2)
+        fast = Compressed(zlib.compress(pickled, 1))
+        best = Compressed(zlib.compress(pickled, 9))
+        self.assertNotEqual(fast.compressed, best.compressed)
+        self.assertTrue(fast == best)
+        self.assertFalse(fast != best)
+        other = Compressed(zlib.compress(pickle.dumps([1] * 1000, 2), 9))
+        self.assertFalse(fast == other)
+        self.assertTrue(fast != other)
+        self.assertFalse(fast == list(range(1000)))
+
+    def test_resolve_conflict_same_value(self):
+        import zlib
+        from cipher.session._compat import pickle
+        from cipher.session.compression import Compressed, compress
+        from cipher.session.session import CompressedSessionData
+        pickled = pickle.dumps(list(range(1000)), 2)
+        sdo = CompressedSessionData()
+        old = {'_lm': 0, '_pk': u'pkg', '_cz': 100,
+               'data': {'ids': compress([0] * 100, 100)}}
+        committed = dict(old, _lm=1, data={
+            'ids': Compressed(zlib.compress(pickled, 1))})
+        new = dict(old, _lm=2, data={
+            'ids': Compressed(zlib.compress(pickled, 9))})
+        resolved = sdo._p_resolveConflict(old, committed, new)
+        self.assertEqual(resolved['data']['ids'], committed['data']['ids'])
+
+    def test_resolve_conflict(self):
+        from cipher.session.policy import clearConflictPolicies
+        from cipher.session.policy import registerConflictPolicy
+        from cipher.session.session import CompressedSessionData
+        from cipher.session.compression import compress
+        seen = []
+
+        def policy(old, committed, new, committed_lm, new_lm):
+            seen.append((old, committed, new))
+            return committed + new
+        registerConflictPolicy(policy, u'pkg', 'ids')
+        self.addCleanup(clearConflictPolicies)
+        sdo = CompressedSessionData()
+        old = {'_lm': 0, '_pk': u'pkg', '_cz': 100,
+               'data': {'ids': compress([0] * 100, 100)}}
+        committed = dict(old, _lm=1, data={'ids': compress([1] * 100, 100)})
+        new = dict(old, _lm=2, data={'ids': compress([2] * 100, 100)})
+        resolved = sdo._p_resolveConflict(old, committed, new)
+        self.assertEqual(seen, [([0] * 100, [1] * 100, [2] * 100)])
+        self.assertEqual(resolved['data'], {'ids': [1] * 100 + [2] * 100})
+
+
+class TestSQLiteCompression(unittest.TestCase):
+
+    def setUp(self):
+        from cipher.session.external import SQLiteSessionDataManager
+        self.tmpdir = tempfile.mkdtemp()
+        self.sdm = SQLiteSessionDataManager(
+            os.path.join(self.tmpdir, 'sessions.db'), compress_threshold=100)
+
+    def tearDown(self):
+        transaction.abort()
+        shutil.rmtree(self.tmpdir)
+
+    def test_roundtrip(self):
+        from cipher.session.session import CompressedSessionData
+        self.sdm.get('foobar')['ids'] = list(range(1000))
+        transaction.commit()
+        self.sdm.compress_threshold = None
+        sdo = self.sdm.query('foobar')
+        self.assertTrue(isinstance(sdo, CompressedSessionData))
+        self.assertEqual(sdo['ids'], list(range(1000)))
+
+
+def test_suite():
+    return unittest.TestSuite((
+        unittest.makeSuite(TestCompress),
+        unittest.makeSuite(TestCompressedSessionData),
+        unittest.makeSuite(TestSQLiteCompression),
+        ))
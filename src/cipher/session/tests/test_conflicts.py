@@ -0,0 +1,168 @@
+"""Concurrent writes to session storage against a real ZODB"""
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import transaction
+from ZODB.DB import DB
+from ZODB.FileStorage import FileStorage
+from ZODB.POSException import ConflictError
+
+
+class FileStorageTestCase(unittest.TestCase):
+    # MappingStorage doesn't resolve conflicts
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.db = DB(FileStorage(os.path.join(self.tmpdir, 'Data.fs')))
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.tmpdir)
+
+
+class TestHeadRotation(FileStorageTestCase):
+
+    def setUp(self):
+        from cipher.session.session import SessionDataManager
+        super(TestHeadRotation, self).setUp()
+        self.T0 = int(time.time() // 600 + 6) * 600
+        tm = transaction.TransactionManager()
+        conn = self.db.open(tm)
+        conn.root()['sdm'] = sdm = SessionDataManager()
+        sdm.get('first', when=self.T0)
+        tm.commit()
+        conn.close()
+
+    def _open(self):
+        tm = transaction.TransactionManager()
+        conn = self.db.open(tm)
+        return tm, conn.root()['sdm']
+
+    def _buckets(self):
+        tm, sdm = self._open()
+        return [(s - self.T0, ahead, sorted(bucket.keys()))
+                for s, (bucket, ahead) in sorted(sdm._index.items())]
+
+    def test_concurrent_rotation(self):
+        # both cross into the period of the bucket created ahead
+        tm1, sdm1 = self._open()
+        tm2, sdm2 = self._open()
+        sdm1.get('one', when=self.T0 + 600)
+        sdm2.get('two', when=self.T0 + 600)
+        tm1.commit()
+        tm2.commit()
+        self.assertEqual(self._buckets(), [
+            (0, False, ['first']),
+            (600, True, ['one', 'two']),
+            (1200, True, []),
+            ])
+
+    def test_concurrent_rotation_after_idle_period(self):
+        # nobody wrote in the period of the bucket created ahead, both take
+        # it over for this period
+        tm1, sdm1 = self._open()
+        tm2, sdm2 = self._open()
+        sdm1.get('one', when=self.T0 + 1200)
+        sdm2.get('two', when=self.T0 + 1200)
+        tm1.commit()
+        tm2.commit()
+        self.assertEqual(self._buckets(), [
+            (0, False, ['first']),
+            (1200, False, ['one', 'two']),
+            (1800, True, []),
+            ])
+
+    def test_concurrent_rotation_after_timeout(self):
+        # all sessions expired, both remove them and take the bucket over
+        tm1, sdm1 = self._open()
+        tm2, sdm2 = self._open()
+        sdm1.get('one', when=self.T0 + 7200)
+        sdm2.get('two', when=self.T0 + 7200)
+        tm1.commit()
+        tm2.commit()
+        self.assertEqual(self._buckets(), [
+            (7200, False, ['one', 'two']),
+            (7800, True, []),
+            ])
+
+    def test_concurrent_creation_conflicts(self):
+        # without a bucket created ahead both create one
+        tm, sdm = self._open()
+        del sdm._index[self.T0 + 600]
+        tm.commit()
+        tm1, sdm1 = self._open()
+        tm2, sdm2 = self._open()
+        sdm1.get('one', when=self.T0 + 1200)
+        sdm2.get('two', when=self.T0 + 1200)
+        tm1.commit()
+        self.assertRaises(ConflictError, tm2.commit)
+
+    def test_concurrent_gc(self):
+        tm1, sdm1 = self._open()
+        tm2, sdm2 = self._open()
+        sdm1.gc(when=self.T0 + 4200)
+        sdm2.get('two', when=self.T0 + 600)
+        tm1.commit()
+        tm2.commit()
+        self.assertEqual(self._buckets(), [
+            (600, True, ['two']),
+            (1200, True, []),
+            ])
+
+    def test_concurrent_new_sessions(self):
+        # clients and principals are found in the buckets, new sessions
+        # don't write anything else
+        tm1, sdm1 = self._open()
+        tm2, sdm2 = self._open()
+        sdm1.get(('client1', u'pkg'), when=self.T0)
+        sdm1.add_principal('user1', 'client1', when=self.T0)
+        sdm2.get(('client2', u'pkg'), when=self.T0)
+        sdm2.add_principal('user2', 'client2', when=self.T0)
+        tm1.commit()
+        tm2.commit()
+        tm, sdm = self._open()
+        self.assertEqual(sdm.invalidate_clients(['client1'], when=self.T0),
+                         1)
+        self.assertEqual(sdm.invalidate_principals(['user2'], when=self.T0),
+                         1)
+        tm.commit()
+        tm, sdm = self._open()
+        self.assertFalse(sdm.search(('client1', u'pkg'),
+                                    when=self.T0).is_valid())
+        self.assertFalse(sdm.search(('client2', u'pkg'),
+                                    when=self.T0).is_valid())
+
+
+class TestSessionData(FileStorageTestCase):
+
+    def test_concurrent_writes_to_different_keys(self):
+        from cipher.session.session import SessionData
+        tm = transaction.TransactionManager()
+        conn = self.db.open(tm)
+        conn.root()['sdo'] = SessionData({'a': 1})
+        tm.commit()
+        conn.close()
+
+        tm1 = transaction.TransactionManager()
+        tm2 = transaction.TransactionManager()
+        sdo1 = self.db.open(tm1).root()['sdo']
+        sdo2 = self.db.open(tm2).root()['sdo']
+        sdo1['b'] = 2
+        sdo2['c'] = 3
+        tm1.commit()
+        tm2.commit()
+
+        tm = transaction.TransactionManager()
+        sdo = self.db.open(tm).root()['sdo']
+        self.assertEqual(dict(sdo), {'a': 1, 'b': 2, 'c': 3})
+
+
+def test_suite():
+    return unittest.TestSuite((
+        unittest.makeSuite(TestHeadRotation),
+        unittest.makeSuite(TestSessionData),
+        ))
@@ -0,0 +1,186 @@
+"""Tests of session data kept in signed cookies"""
+
+import unittest
+
+import transaction
+import zope.component
+import zope.component.testing
+import zope.interface
+from zope.publisher.browser import TestRequest
+from zope.publisher.interfaces import IRequest
+from zope.session.http import CookieClientIdManager
+from zope.session.interfaces import IClientId, IClientIdManager
+
+from cipher.session import interfaces
+
+
+@zope.interface.implementer(IClientId)
+class ClientIdStub(object):
+    zope.component.adapts(IRequest)
+
+    def __init__(self, request):
+        pass
+
+    def __str__(self):
+        return 'foobar'
+
+
+class TestCookieSession(unittest.TestCase):
+
+    def setUp(self):
+        from cipher.session.session import SessionDataManager
+        zope.component.testing.setUp(self)
+        zope.component.provideAdapter(ClientIdStub)
+        zope.component.provideUtility(CookieClientIdManager(secret=u'sekrit'),
+                                      IClientIdManager)
+        self.sdm = SessionDataManager()
+        zope.component.provideUtility(self.sdm,
+                                      interfaces.ISessionDataManager)
+        transaction.begin()
+
+    def tearDown(self):
+        transaction.abort()
+        zope.component.testing.tearDown(self)
+
+    def _makeOne(self, request):
+        from cipher.session.cookie import CookieSession
+        return CookieSession(request)
+
+    def _request(self, previous=None):
+        if previous is None:
+            return TestRequest()
+        cookies = ['%s=%s' % (name, cookie['value'])
+                   for name, cookie in previous.response._cookies.items()
+                   if cookie.get('max_age') != 0]
+        return TestRequest(environ={'HTTP_COOKIE': '; '.join(cookies)})
+
+    def test_roundtrip(self):
+        request = self._request()
+        session = self._makeOne(request)
+        session[u'app.locale']['locale'] = u'de'
+        transaction.commit()
+        cookie = request.response.getCookie('session.app.locale')
+        self.assertTrue(cookie['httponly'])
+        self.assertEqual(self.sdm.query(('foobar', u'app.locale')), None)
+
+        session = self._makeOne(self._request(request))
+        data = session.get(u'app.locale')
+        self.assertEqual(dict(data), {u'locale': u'de'})
+        self.assertTrue(session[u'app.locale'] is data)
+        self.assertEqual(session.get_many([u'app.locale', u'app.other']),
+                         {u'app.locale': data, u'app.other': None})
+
+    def test_unchanged_is_not_written(self):
+        request = self._request()
+        self._makeOne(request)[u'app.locale']['locale'] = u'de'
+        transaction.commit()
+        request = self._request(request)
+        self._makeOne(request)[u'app.locale']
+        transaction.commit()
+        self.assertEqual(request.response.getCookie('session.app.locale'),
+                         None)
+
+    def test_new_and_unmodified_is_not_written(self):
+        request = self._request()
+        session = self._makeOne(request)
+        session[u'app.locale']
+        session.get(u'app.other')
+        transaction.commit()
+        self.assertEqual(request.response._cookies, {})
+
+    def test_commit_twice(self):
+        from cipher.session import metrics
+        metrics.reset()
+        request = self._request()
+        self._makeOne(request)[u'app.locale']['locale'] = u'de'
+        transaction.commit()
+        self._makeOne(request)[u'app.locale']['theme'] = u'dark'
+        transaction.commit()
+        # nothing changed since
+        self._makeOne(request)[u'app.locale']
+        transaction.commit()
+        self.assertEqual(metrics.counters['cookie.written'], 2)
+        session = self._makeOne(self._request(request))
+        self.assertEqual(dict(session[u'app.locale']),
+                         {u'locale': u'de', u'theme': u'dark'})
+
+    def test_commit_twice_after_fallback(self):
+        request = self._request()
+        self._makeOne(request)[u'app.cart']['items'] = [
+            u'%d' % i for i in range(5000)]
+        transaction.commit()
+        self._makeOne(request)[u'app.cart']['more'] = 1
+        transaction.commit()
+        self.assertEqual(request.response.getCookie('session.app.cart'), None)
+        self.assertEqual(self.sdm.query(('foobar', u'app.cart'))['more'], 1)
+
+    def test_abort(self):
+        request = self._request()
+        self._makeOne(request)[u'app.locale']['locale'] = u'de'
+        transaction.abort()
+        self.assertEqual(request.response.getCookie('session.app.locale'),
+                         None)
+
+    def test_forged(self):
+        request = self._request()
+        self._makeOne(request)[u'app.locale']['locale'] = u'de'
+        transaction.commit()
+        cookie = request.response.getCookie('session.app.locale')
+        payload, mac = cookie['value'].split('.')
+        forged = TestRequest(environ={'HTTP_COOKIE': 'session.app.locale=%s.%s'
+                                      % (payload, mac[:-2] + 'AA')})
+        self.assertEqual(self._makeOne(forged).get(u'app.locale'), None)
+
+    def test_other_client(self):
+        request = self._request()
+        self._makeOne(request)[u'app.locale']['locale'] = u'de'
+        transaction.commit()
+        other = self._request(request)
+        session = self._makeOne(other)
+        session.client_id = 'other'
+        self.assertEqual(session.get(u'app.locale'), None)
+
+    def test_too_big_falls_back(self):
+        request = self._request()
+        data = self._makeOne(request)[u'app.cart']
+        data['items'] = [u'%d' % i for i in range(5000)]
+        transaction.commit()
+        self.assertEqual(request.response.getCookie('session.app.cart'), None)
+        self.assertEqual(
+            len(self.sdm.query(('foobar', u'app.cart'))['items']), 5000)
+        # and it's found there
+        session = self._makeOne(self._request(request))
+        self.assertEqual(len(session[u'app.cart']['items']), 5000)
+
+    def test_not_json_falls_back(self):
+        request = self._request()
+        self._makeOne(request)[u'app.auth']['pair'] = (1, 2)
+        transaction.commit()
+        self.assertEqual(request.response.getCookie('session.app.auth'), None)
+        self.assertEqual(
+            self.sdm.query(('foobar', u'app.auth'))['pair'], (1, 2))
+
+    def test_compressed(self):
+        request = self._request()
+        self._makeOne(request)[u'app.cart']['items'] = [u'x'] * 300
+        transaction.commit()
+        cookie = request.response.getCookie('session.app.cart')
+        self.assertTrue(len(cookie['value']) < 200)
+        session = self._makeOne(self._request(request))
+        self.assertEqual(session[u'app.cart']['items'], [u'x'] * 300)
+
+    def test_invalidate(self):
+        request = self._request()
+        self._makeOne(request)[u'app.locale']['locale'] = u'de'
+        transaction.commit()
+        request = self._request(request)
+        self._makeOne(request)[u'app.locale'].invalidate()
+        transaction.commit()
+        self.assertEqual(
+            request.response.getCookie('session.app.locale')['max_age'], 0)
+
+
+def test_suite():
+    return unittest.TestSuite((
+        unittest.makeSuite(TestCookieSession),
+        ))
@@ -0,0 +1,31 @@
+"""Tests of the comparable SessionCredentials"""
+
+import unittest
+
+
+class TestSessionCredentials(unittest.TestCase):
+
+    def _makeOne(self, login, password):
+        from cipher.session.credentials import SessionCredentials
+        return SessionCredentials(login, password)
+
+    def test_equal(self):
+        a = self._makeOne('login', 'secret')
+        b = self._makeOne('login', 'secret')
+        self.assertTrue(a == b)
+        self.assertFalse(a != b)
+        self.assertEqual(hash(a), hash(b))
+        self.assertEqual(len(set([a, b])), 1)
+
+    def test_not_equal(self):
+        a = self._makeOne('login', 'secret')
+        self.assertTrue(a != self._makeOne('login', 'other'))
+        self.assertTrue(a != self._makeOne('other', 'secret'))
+        self.assertTrue(a != ('login', 'secret'))
+        self.assertFalse(a == None)
+
+
+def test_suite():
+    return unittest.TestSuite((
+        unittest.makeSuite(TestSessionCredentials),
+        ))
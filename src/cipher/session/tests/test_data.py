@@ -92,3 +92,156 @@ class TestSessionData(unittest.TestCase):
         new       = {'_lm':2, 'data':ref2}
         self.assertRaises(ConflictError, sdo._p_resolveConflict, old,
                           committed, new)
+
+    def test_p_resolveConflict_merge_different_keys(self):
+        sdo = self._makeOne()
+        old       = {'_lm':0, 'data':{'a': 1, 'b': 2, 'c': 3}}
+        committed = {'_lm':1, 'data':{'a': 10, 'b': 2, 'c': 3, 'd': 4}}
+        new       = {'_lm':2, 'data':{'a': 1, 'c': 3, 'e': 5}}
+        result = sdo._p_resolveConflict(old, committed, new)
+        self.assertEqual(
+            result,
+            {'_lm': 2, 'data': {'a': 10, 'c': 3, 'd': 4, 'e': 5}}
+            )
+
+    def test_p_resolveConflict_merge_committed_deletes(self):
+        sdo = self._makeOne()
+        old       = {'_lm':0, 'data':{'a': 1, 'b': 2}}
+        committed = {'_lm':1, 'data':{'b': 2}}
+        new       = {'_lm':2, 'data':{'a': 1, 'b': 2, 'c': 3}}
+        result = sdo._p_resolveConflict(old, committed, new)
+        self.assertEqual(result, {'_lm': 2, 'data': {'b': 2, 'c': 3}})
+
+    def test_p_resolveConflict_merge_same_change(self):
+        sdo = self._makeOne()
+        old       = {'_lm':0, 'data':{'a': 1}}
+        committed = {'_lm':1, 'data':{'a': 2, 'b': 3}}
+        new       = {'_lm':2, 'data':{'a': 2}}
+        result = sdo._p_resolveConflict(old, committed, new)
+        self.assertEqual(result, {'_lm': 2, 'data': {'a': 2, 'b': 3}})
+
+    def test_p_resolveConflict_merge_same_key_collision(self):
+        from ZODB.POSException import ConflictError
+        sdo = self._makeOne()
+        old       = {'_lm':0, 'data':{'a': 1}}
+        committed = {'_lm':1, 'data':{'a': 2}}
+        new       = {'_lm':2, 'data':{'a': 3, 'b': 4}}
+        self.assertRaises(ConflictError, sdo._p_resolveConflict, old,
+                          committed, new)
+
+    def test_p_resolveConflict_merge_delete_vs_change(self):
+        from ZODB.POSException import ConflictError
+        sdo = self._makeOne()
+        old       = {'_lm':0, 'data':{'a': 1}}
+        committed = {'_lm':1, 'data':{}}
+        new       = {'_lm':2, 'data':{'a': 3}}
+        self.assertRaises(ConflictError, sdo._p_resolveConflict, old,
+                          committed, new)
+
+    def test_p_resolveConflict_merge_same_key_persistent(self):
+        from ZODB.POSException import ConflictError
+        from ZODB.ConflictResolution import PersistentReference
+
+        ref1 = PersistentReference(b'my_oid')
+        ref2 = PersistentReference((b'another_oid', 'my_class'))
+
+        sdo = self._makeOne()
+        old       = {'_lm':0, 'data':{}}
+        committed = {'_lm':1, 'data':{'a': ref1}}
+        new       = {'_lm':2, 'data':{'a': ref2}}
+        self.assertRaises(ConflictError, sdo._p_resolveConflict, old,
+                          committed, new)
+
+    def test___getstate___compact(self):
+        sdo = self._makeOne({'a': 1})
+        sdo._pk = u'pkg'
+        state = sdo.__getstate__()
+        self.assertEqual(state,
+                         ({'a': 1}, sdo._lm, sdo._ct, False, u'pkg'))
+        self.assertTrue(isinstance(sdo._ct, int))
+
+    def test___getstate___extra_attributes(self):
+        sdo = self._makeOne()
+        sdo._la = 1
+        self.assertEqual(sdo.__getstate__()[5:], ({'_la': 1}, ))
+
+    def test___setstate___roundtrip(self):
+        sdo = self._makeOne({'a': 1})
+        sdo._la = 1
+        sdo.invalidate()
+        copy = self._getTargetClass().__new__(self._getTargetClass())
+        copy.__setstate__(sdo.__getstate__())
+        self.assertEqual(copy.data, {'a': 1})
+        self.assertEqual(copy.created, sdo.created)
+        self.assertEqual(copy._la, 1)
+        self.assertFalse(copy.is_valid())
+
+    def test___setstate___old_format(self):
+        copy = self._getTargetClass().__new__(self._getTargetClass())
+        copy.__setstate__({'data': {'a': 1}, '_lm': 2.5, '_ct': 1.5})
+        self.assertEqual(copy.data, {'a': 1})
+        self.assertEqual(copy.last_modified, 2.5)
+        self.assertEqual(copy._pk, None)
+
+    def test___getstate___fingerprints(self):
+        big = 'x' * 2000
+        sdo = self._makeOne({'a': 1, 'big': big})
+        state = sdo.__getstate__()
+        fp = state[5]['_fp']['big']
+        self.assertEqual(list(state[5]['_fp']), ['big'])
+        # taken once per value
+        cached = sdo._v_fp['big']
+        sdo['a'] = 2
+        sdo.__getstate__()
+        self.assertTrue(sdo._v_fp['big'] is cached)
+        sdo['big'] = big + 'y'
+        self.assertNotEqual(sdo.__getstate__()[5]['_fp']['big'], fp)
+        # not an attribute
+        copy = self._getTargetClass().__new__(self._getTargetClass())
+        copy.__setstate__(state)
+        self.assertFalse('_fp' in copy.__dict__)
+        self.assertEqual(copy.__getstate__(), state)
+
+    def test_p_resolveConflict_fingerprints(self):
+        from ZODB.POSException import ConflictError
+        sdo = self._makeOne()
+        old       = {'_lm': 0, 'data': {'a': Uncomparable()},
+                     '_fp': {'a': b'1'}}
+        committed = {'_lm': 1, 'data': {'a': Uncomparable(), 'b': 2},
+                     '_fp': {'a': b'2'}}
+        new       = {'_lm': 2, 'data': {'a': Uncomparable()},
+                     '_fp': {'a': b'2'}}
+        result = sdo._p_resolveConflict(old, committed, new)
+        self.assertEqual(sorted(result['data']), ['a', 'b'])
+        self.assertTrue(result['data']['a'] is new['data']['a'])
+        self.assertEqual(result['_fp'], {'a': b'2'})
+        new['_fp'] = {'a': b'3'}
+        self.assertRaises(ConflictError, sdo._p_resolveConflict, old,
+                          committed, new)
+
+    def test_p_resolveConflict_compact(self):
+        sdo = self._makeOne()
+        old       = ({'a': 1}, 0, 0, False, u'pkg')
+        committed = ({'a': 1, 'b': 2}, 1, 0, False, u'pkg')
+        new       = ({'a': 1, 'c': 3}, 2, 0, True, u'pkg')
+        result = sdo._p_resolveConflict(old, committed, new)
+        self.assertEqual(result,
+                         ({'a': 1, 'b': 2, 'c': 3}, 2, 0, True, u'pkg'))
+
+    def test_p_resolveConflict_old_format_old_state(self):
+        # the first write after an upgrade resolves against the old format
+        sdo = self._makeOne()
+        old       = {'_lm': 0, '_ct': 0, 'data': {'a': 1}}
+        committed = ({'a': 1, 'b': 2}, 1, 0, False, None)
+        new       = ({'a': 1, 'c': 3}, 2, 0, False, None)
+        result = sdo._p_resolveConflict(old, committed, new)
+        self.assertEqual(result,
+                         ({'a': 1, 'b': 2, 'c': 3}, 2, 0, False, None))
+
+
+class Uncomparable(object):
+
+    def __eq__(self, other):
+        raise AssertionError("compared")
+
+    __ne__ = __eq__
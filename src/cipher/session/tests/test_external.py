@@ -0,0 +1,237 @@
+"""Tests of the session data managers keeping data outside of the ZODB"""
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import transaction
+import zope.component.testing
+from ZODB.POSException import ConflictError
+
+
+class TestSQLiteSessionDataManager(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.T0 = int(time.time() // 600 + 6) * 600
+
+    def tearDown(self):
+        transaction.abort()
+        shutil.rmtree(self.tmpdir)
+
+    def _makeOne(self):
+        from cipher.session.external import SQLiteSessionDataManager
+        sdm = SQLiteSessionDataManager(
+            os.path.join(self.tmpdir, 'sessions.db'))
+        sdm.transaction_manager = transaction.TransactionManager()
+        return sdm
+
+    def _rows(self, sdm):
+        return sdm._connection().execute(
+            'SELECT key, serial, slice - ? FROM sessions ORDER BY key',
+            (self.T0, )).fetchall()
+
+    def test_interface(self):
+        from zope.interface.verify import verifyObject
+        from cipher.session.interfaces import ISessionDataManager
+        verifyObject(ISessionDataManager, self._makeOne())
+
+    def test_commit(self):
+        sdm = self._makeOne()
+        sdo = sdm.get(('client', u'pkg'), when=self.T0)
+        sdo['foo'] = 'bar'
+        self.assertTrue(sdm.get(('client', u'pkg'), when=self.T0) is sdo)
+        self.assertEqual(self._rows(sdm), [])
+        sdm.transaction_manager.commit()
+        self.assertEqual(self._rows(sdm), [(u'client\x00pkg', 1, 0)])
+
+        sdo = self._makeOne().query(('client', u'pkg'), when=self.T0)
+        self.assertEqual(dict(sdo), {'foo': 'bar'})
+        self.assertEqual(sdo._pk, u'pkg')
+
+    def test_abort(self):
+        sdm = self._makeOne()
+        sdm.get('foobar', when=self.T0)['foo'] = 'bar'
+        sdm.transaction_manager.abort()
+        self.assertEqual(sdm.query('foobar', when=self.T0), None)
+
+    def test_unchanged_is_not_written(self):
+        sdm = self._makeOne()
+        sdm.get('foobar', when=self.T0)['foo'] = 'bar'
+        sdm.transaction_manager.commit()
+        sdm.query('foobar', when=self.T0)
+        sdm.transaction_manager.commit()
+        self.assertEqual(self._rows(sdm), [(u'foobar', 1, 0)])
+
+    def test_read_only_does_not_lock(self):
+        import sqlite3
+        sdm = self._makeOne()
+        sdm.get('foobar', when=self.T0)['foo'] = 'bar'
+        sdm.transaction_manager.commit()
+        other = sqlite3.connect(os.path.join(self.tmpdir, 'sessions.db'),
+                                isolation_level=None)
+        other.execute('BEGIN IMMEDIATE')
+        try:
+            sdm.query('foobar', when=self.T0)
+            sdm.transaction_manager.commit()
+        finally:
+            other.execute('ROLLBACK')
+            other.close()
+
+    def test_savepoint(self):
+        sdm = self._makeOne()
+        sdo = sdm.get('foobar', when=self.T0)
+        sdo['foo'] = 'bar'
+        savepoint = sdm.transaction_manager.savepoint()
+        sdo['foo'] = 'baz'
+        sdm.get('other', when=self.T0)['foo'] = 'bar'
+        savepoint.rollback()
+        self.assertEqual(dict(sdo), {'foo': 'bar'})
+        sdm.transaction_manager.commit()
+        self.assertEqual(self._rows(sdm), [(u'foobar', 1, 0)])
+        self.assertEqual(
+            dict(self._makeOne().query('foobar', when=self.T0)),
+            {'foo': 'bar'})
+
+    def test_query_many(self):
+        sdm = self._makeOne()
+        sdm.get('a', when=self.T0)['foo'] = 'bar'
+        sdm.transaction_manager.commit()
+        found = sdm.query_many(['a', 'b'], default=0, when=self.T0)
+        self.assertEqual(dict(found['a']), {'foo': 'bar'})
+        self.assertEqual(found['b'], 0)
+
+    def test_concurrent_writes_are_resolved(self):
+        sdm = self._makeOne()
+        sdm.get('foobar', when=self.T0)['a'] = 1
+        sdm.transaction_manager.commit()
+
+        sdm1 = self._makeOne()
+        sdm2 = self._makeOne()
+        sdm1.get('foobar', when=self.T0)['b'] = 2
+        sdm2.get('foobar', when=self.T0)['c'] = 3
+        sdm1.transaction_manager.commit()
+        sdm2.transaction_manager.commit()
+        self.assertEqual(dict(sdm.query('foobar', when=self.T0)),
+                         {'a': 1, 'b': 2, 'c': 3})
+        self.assertEqual(self._rows(sdm), [(u'foobar', 3, 0)])
+
+    def test_concurrent_writes_conflict(self):
+        sdm = self._makeOne()
+        sdm.get('foobar', when=self.T0)['a'] = 1
+        sdm.transaction_manager.commit()
+
+        sdm1 = self._makeOne()
+        sdm2 = self._makeOne()
+        sdm1.get('foobar', when=self.T0)['a'] = 2
+        sdm2.get('foobar', when=self.T0)['a'] = 3
+        sdm1.transaction_manager.commit()
+        self.assertRaises(ConflictError, sdm2.transaction_manager.commit)
+        sdm2.transaction_manager.abort()
+        # and the database isn't locked
+        sdm2.get('foobar', when=self.T0)['a'] = 4
+        sdm2.transaction_manager.commit()
+
+    def test_concurrent_new_sessions_conflict(self):
+        sdm1 = self._makeOne()
+        sdm2 = self._makeOne()
+        sdm1.get('foobar', when=self.T0)['a'] = 1
+        sdm2.get('foobar', when=self.T0)['a'] = 2
+        sdm1.transaction_manager.commit()
+        self.assertRaises(ConflictError, sdm2.transaction_manager.commit)
+
+    def test_unmodified_new_sessions_are_not_written(self):
+        sdm = self._makeOne()
+        sdm.get('foobar', when=self.T0)
+        sdm.transaction_manager.commit()
+        self.assertEqual(self._rows(sdm), [])
+
+    def test_touch(self):
+        sdm = self._makeOne()
+        sdm.get('foobar', when=self.T0)['a'] = 1
+        sdm.transaction_manager.commit()
+        sdm.query('foobar', when=self.T0 + 600)
+        sdm.transaction_manager.commit()
+        self.assertEqual(self._rows(sdm), [(u'foobar', 1, 600)])
+
+        sdm.touch_resolution = 1200
+        sdm.query('foobar', when=self.T0 + 1200)
+        sdm.transaction_manager.commit()
+        self.assertEqual(self._rows(sdm), [(u'foobar', 1, 600)])
+
+    def test_expiry_and_gc(self):
+        from repoze.session.interfaces import ISessionEndEvent
+        ended = []
+        zope.component.testing.setUp(self)
+        self.addCleanup(zope.component.testing.tearDown, self)
+        zope.component.provideHandler(
+            lambda event: ended.append(dict(event.session)),
+            [ISessionEndEvent])
+
+        sdm = self._makeOne()
+        sdm.inline_gc = False
+        sdm.get('old', when=self.T0)['a'] = 1
+        sdm.transaction_manager.commit()
+        sdm.get('new', when=self.T0 + 600)['b'] = 2
+        sdm.transaction_manager.commit()
+
+        later = self.T0 + 4200
+        self.assertEqual(sdm.query('old', when=later), None)
+        self.assertEqual(dict(sdm.query('new', when=later)), {'b': 2})
+        sdm.transaction_manager.abort()
+        self.assertEqual(sdm.gc(when=later), 1)
+        self.assertEqual(ended, [{'a': 1}])
+        self.assertEqual(self._rows(sdm), [(u'new', 1, 600)])
+
+    def test_inline_gc(self):
+        sdm = self._makeOne()
+        sdm.get('old', when=self.T0)['a'] = 1
+        sdm.transaction_manager.commit()
+        sdm.query('new', when=self.T0 + 4200)
+        self.assertEqual(self._rows(sdm), [])
+
+    def test_clear(self):
+        sdm = self._makeOne()
+        sdm.get('foobar', when=self.T0)['a'] = 1
+        sdm.transaction_manager.commit()
+        sdm.clear()
+        sdm.transaction_manager.commit()
+        self.assertEqual(self._rows(sdm), [])
+
+
+class TestDirective(unittest.TestCase):
+
+    def setUp(self):
+        zope.component.testing.setUp(self)
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        zope.component.testing.tearDown(self)
+        shutil.rmtree(self.tmpdir)
+
+    def test_sqliteSessionDataManager(self):
+        from zope.configuration import xmlconfig
+        import cipher.session
+        from cipher.session.interfaces import ISessionDataManager
+        context = xmlconfig.file('meta.zcml', cipher.session)
+        xmlconfig.string("""
+            <configure xmlns="http://namespaces.zope.org/session">
+              <sqliteSessionDataManager
+                  file="%s/sessions.db"
+                  timeout="7200"
+                  />
+            </configure>
+            """ % self.tmpdir, context)
+        sdm = zope.component.getUtility(ISessionDataManager)
+        self.assertEqual(sdm.file, os.path.join(self.tmpdir, 'sessions.db'))
+        self.assertEqual(sdm.timeout, 7200)
+        self.assertEqual(sdm.period, 600)
+
+
+def test_suite():
+    return unittest.TestSuite((
+        unittest.makeSuite(TestSQLiteSessionDataManager),
+        unittest.makeSuite(TestDirective),
+        ))
@@ -0,0 +1,209 @@
+"""Tests of the session lookup cache"""
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import transaction
+import zope.component
+import zope.component.testing
+from ZODB.DB import DB
+from ZODB.MappingStorage import MappingStorage
+
+from cipher.session import interfaces
+from cipher.session import metrics
+
+
+class TestSQLiteLookupCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _makeOne(self):
+        from cipher.session.lookupcache import SQLiteLookupCache
+        return SQLiteLookupCache(os.path.join(self.tmpdir, 'lookup.db'))
+
+    def test_interface(self):
+        from zope.interface.verify import verifyObject
+        verifyObject(interfaces.ISessionLookupCache, self._makeOne())
+
+    def test_shared(self):
+        cache = self._makeOne()
+        cache.set_many([(u'a', (b'\0' * 8, 600, 0)),
+                        (u'b', (b'\1' * 8, 1200, 0))])
+        other = self._makeOne()
+        self.assertEqual(other.get_many([u'a', u'c']),
+                         {u'a': (b'\0' * 8, 600, 0)})
+        other.prune(1200)
+        self.assertEqual(cache.get_many([u'a', u'b']),
+                         {u'b': (b'\1' * 8, 1200, 0)})
+
+
+class TestSessionDataManagerWithCache(unittest.TestCase):
+
+    def setUp(self):
+        from cipher.session.lookupcache import SQLiteLookupCache
+        from cipher.session.session import SessionDataManager
+        zope.component.testing.setUp(self)
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = SQLiteLookupCache(os.path.join(self.tmpdir, 'lookup.db'))
+        zope.component.provideUtility(self.cache,
+                                      interfaces.ISessionLookupCache)
+        self.T0 = int(time.time() // 600 + 6) * 600
+        self.db = DB(MappingStorage())
+        self.conn = self.db.open()
+        self.sdm = self.conn.root()['sdm'] = SessionDataManager()
+        self.sdm.inline_gc = False
+        transaction.commit()
+        metrics.reset()
+
+    def tearDown(self):
+        transaction.abort()
+        self.conn.close()
+        self.db.close()
+        shutil.rmtree(self.tmpdir)
+        zope.component.testing.tearDown(self)
+
+    def _other(self):
+        # the manager as another process sees it
+        conn = self.db.open(
+            transaction_manager=transaction.TransactionManager())
+        conn.cacheMinimize()
+        self.addCleanup(conn.close)
+        return conn.root()['sdm']
+
+    def test_hit(self):
+        self.sdm.get('foobar', when=self.T0)['a'] = 1
+        transaction.commit()
+        self.assertEqual(len(self.cache.get_many(
+            [self.sdm._cacheKey('foobar')])), 1)
+
+        metrics.reset()
+        other = self._other()
+        bucket = other._getIndex()[self.T0][0]
+        self.assertEqual(dict(other.search('foobar', when=self.T0)),
+                         {'a': 1})
+        # the bucket wasn't loaded
+        self.assertEqual(bucket._p_changed, None)
+        self.assertEqual(metrics.counters['lookup_cache.hit'], 1)
+
+    def test_touch_is_cached_after_commit(self):
+        self.sdm.get('foobar', when=self.T0)['a'] = 1
+        transaction.commit()
+        later = self.T0 + 600
+        self.sdm.search('foobar', when=later)
+        self.assertEqual(metrics.counters['touch.written'], 1)
+        cache_key = self.sdm._cacheKey('foobar')
+        self.assertEqual(self.cache.get_many([cache_key])[cache_key][1],
+                         self.T0)
+        transaction.commit()
+        self.assertEqual(self.cache.get_many([cache_key])[cache_key][1],
+                         later)
+
+    def test_stale_entries_are_not_used(self):
+        self.sdm.get('foobar', when=self.T0)['a'] = 1
+        transaction.commit()
+        metrics.reset()
+        # needs a touch
+        other = self._other()
+        self.assertEqual(dict(other.search('foobar', when=self.T0 + 600)),
+                         {'a': 1})
+        self.assertEqual(metrics.counters['lookup_cache.miss'], 1)
+        # expired
+        self.assertEqual(
+            self._other().search('foobar', when=self.T0 + 4200), None)
+        self.assertEqual(metrics.counters.get('lookup_cache.hit', 0), 0)
+
+    def test_clear(self):
+        self.sdm.get('foobar', when=self.T0)['a'] = 1
+        transaction.commit()
+        self.sdm.clear()
+        transaction.commit()
+        self.assertEqual(self._other().search('foobar', when=self.T0), None)
+
+    def test_invalidated(self):
+        self.sdm.get('foobar', when=self.T0)['a'] = 1
+        transaction.commit()
+        self.sdm.get('foobar', when=self.T0).invalidate()
+        transaction.commit()
+        metrics.reset()
+        other = self._other()
+        self.assertFalse(other.search('foobar', when=self.T0).is_valid())
+        self.assertEqual(metrics.counters['lookup_cache.hit'], 0)
+
+    def test_abort(self):
+        self.sdm.get('foobar', when=self.T0)['a'] = 1
+        transaction.abort()
+        self.assertEqual(
+            self.cache.get_many([self.sdm._cacheKey('foobar')]), {})
+
+    def test_other_database(self):
+        from cipher.session.session import SessionDataManager
+        self.sdm.get('foobar', when=self.T0)['a'] = 1
+        transaction.commit()
+        # another database with a manager of the same oid shares the cache
+        db = DB(MappingStorage('other'))
+        self.addCleanup(db.close)
+        tm = transaction.TransactionManager()
+        conn = db.open(transaction_manager=tm)
+        self.addCleanup(conn.close)
+        conn.root()['sdm'] = other = SessionDataManager()
+        tm.commit()
+        self.assertEqual(other._p_oid, self.sdm._p_oid)
+        self.assertNotEqual(other._cacheKey('foobar'),
+                            self.sdm._cacheKey('foobar'))
+        self.assertEqual(other.search('foobar', when=self.T0), None)
+
+    def test_not_session_data(self):
+        from ZODB.utils import z64
+        self.sdm.get('foobar', when=self.T0)['a'] = 1
+        transaction.commit()
+        cache_key = self.sdm._cacheKey('foobar')
+        self.cache.set_many([(cache_key, (z64, self.T0, 0))])
+        metrics.reset()
+        self.assertEqual(dict(self._other().search('foobar', when=self.T0)),
+                         {'a': 1})
+        self.assertEqual(metrics.counters['lookup_cache.miss'], 1)
+
+    def test_gc_prunes(self):
+        self.sdm.get('foobar', when=self.T0)['a'] = 1
+        transaction.commit()
+        self.assertEqual(self.sdm.gc(when=self.T0 + 4200), 1)
+        self.assertEqual(
+            self.cache.get_many([self.sdm._cacheKey('foobar')]), {})
+
+
+class TestDirective(unittest.TestCase):
+
+    def setUp(self):
+        zope.component.testing.setUp(self)
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        zope.component.testing.tearDown(self)
+
+    def test_lookupCache(self):
+        from zope.configuration import xmlconfig
+        import cipher.session
+        context = xmlconfig.file('meta.zcml', cipher.session)
+        xmlconfig.string("""
+            <configure xmlns="http://namespaces.zope.org/session">
+              <lookupCache file="%s" />
+            </configure>
+            """ % os.path.join(self.tmpdir, 'lookup.db'), context)
+        cache = zope.component.getUtility(interfaces.ISessionLookupCache)
+        self.assertEqual(cache.file, os.path.join(self.tmpdir, 'lookup.db'))
+
+
+def test_suite():
+    return unittest.TestSuite((
+        unittest.makeSuite(TestSQLiteLookupCache),
+        unittest.makeSuite(TestSessionDataManagerWithCache),
+        unittest.makeSuite(TestDirective),
+        ))
@@ -0,0 +1,134 @@
+"""`maintenance` module tests"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import transaction
+import zope.component.testing
+from persistent import Persistent
+from repoze.session.manager import timeslice
+from zope.component.persistentregistry import PersistentComponents
+
+
+class RootFolderStub(Persistent):
+
+    def __init__(self):
+        self.sm = PersistentComponents()
+
+    def getSiteManager(self):
+        return self.sm
+
+
+def populate(db):
+    from cipher.session import interfaces
+    from cipher.session.session import SessionDataManager
+    conn = db.open()
+    root_folder = conn.root()['Application'] = RootFolderStub()
+    sdm = SessionDataManager()
+    sdm.inline_gc = False
+    root_folder.getSiteManager().registerUtility(
+        sdm, interfaces.ISessionDataManager)
+    # two hours of sessions, one bucket per period
+    start = timeslice(600) - 2 * 3600
+    for i in range(12):
+        sdm.get('session-%d' % i, when=start + i * 600)
+    transaction.commit()
+    conn.close()
+
+
+ended = []
+
+
+def sessionEnded(event):
+    ended.append(event.session)
+
+
+class TestCollect(unittest.TestCase):
+
+    def setUp(self):
+        from ZODB.DB import DB
+        from ZODB.MappingStorage import MappingStorage
+        self.db = DB(MappingStorage())
+        populate(self.db)
+
+    def tearDown(self):
+        transaction.abort()
+        self.db.close()
+
+    def _bucketCount(self):
+        from cipher.session.maintenance import findSessionDataManagers
+        conn = self.db.open()
+        try:
+            sdm, = findSessionDataManagers(conn.root()['Application'])
+            return len(sdm._index)
+        finally:
+            conn.close()
+
+    def test_collect(self):
+        from cipher.session.maintenance import collect
+        self.assertEqual(self._bucketCount(), 13)
+        # 12 buckets and the one created ahead, the ones more than an
+        # hour (timeout) older than the current one expired
+        removed = collect(self.db, max_buckets=2)
+        self.assertEqual(removed, 6)
+        self.assertEqual(self._bucketCount(), 7)
+        self.assertEqual(collect(self.db), 0)
+
+    def test_collect_commits_batches(self):
+        from cipher.session.maintenance import collect
+        before = self.db.lastTransaction()
+        collect(self.db, max_buckets=2)
+        tids = [t.tid for t in self.db.storage.iterator(before)][1:]
+        self.assertEqual(len(tids), 3)
+
+
+class TestMain(unittest.TestCase):
+
+    def setUp(self):
+        from ZODB.DB import DB
+        from ZODB.FileStorage import FileStorage
+        self.tmpdir = tempfile.mkdtemp()
+        path = os.path.join(self.tmpdir, 'Data.fs')
+        db = DB(FileStorage(path))
+        populate(db)
+        db.close()
+        self.config = os.path.join(self.tmpdir, 'zodb.conf')
+        with open(self.config, 'w') as f:
+            f.write('<zodb>\n  <filestorage>\n    path %s\n'
+                    '  </filestorage>\n</zodb>\n' % path)
+        self.zcml = os.path.join(self.tmpdir, 'site.zcml')
+        with open(self.zcml, 'w') as f:
+            f.write("""
+                <configure xmlns="http://namespaces.zope.org/zope">
+                  <include package="zope.component" file="meta.zcml" />
+                  <subscriber
+                      for="repoze.session.interfaces.ISessionEndEvent"
+                      handler="%s.sessionEnded"
+                      />
+                </configure>
+                """ % __name__)
+
+    def tearDown(self):
+        del ended[:]
+        zope.component.testing.tearDown()
+        shutil.rmtree(self.tmpdir)
+
+    def test_main(self):
+        from cipher.session.maintenance import main
+        main([self.config, '--max-buckets', '2'])
+        self.assertEqual(ended, [])
+
+    def test_main_zcml(self):
+        from cipher.session.maintenance import main
+        main([self.config, '--zcml', self.zcml])
+        # the sessions of the 6 expired buckets
+        self.assertEqual(len(ended), 6)
+
+
+def test_suite():
+    return unittest.TestSuite((
+        unittest.makeSuite(TestCollect),
+        unittest.makeSuite(TestMain),
+        ))
@@ -0,0 +1,231 @@
+"""Tests of the in-memory session data manager"""
+
+import time
+import unittest
+
+import transaction
+import zope.component.testing
+
+
+class TestMemorySessionDataManager(unittest.TestCase):
+
+    def setUp(self):
+        self.T0 = int(time.time() // 600 + 6) * 600
+
+    def tearDown(self):
+        transaction.abort()
+
+    def _makeOne(self, **kw):
+        from cipher.session.memory import MemorySessionDataManager
+        sdm = MemorySessionDataManager(**kw)
+        sdm.transaction_manager = transaction.TransactionManager()
+        return sdm
+
+    def _other(self, sdm):
+        # another thread using the same manager
+        from cipher.session.memory import MemorySessionDataManager
+        other = MemorySessionDataManager.__new__(MemorySessionDataManager)
+        other.__dict__.update(sdm.__dict__)
+        other.transaction_manager = transaction.TransactionManager()
+        return other
+
+    def test_interface(self):
+        from zope.interface.verify import verifyObject
+        from cipher.session.interfaces import ISessionDataManager
+        verifyObject(ISessionDataManager, self._makeOne())
+
+    def test_commit(self):
+        sdm = self._makeOne()
+        sdo = sdm.get(('client', u'pkg'), when=self.T0)
+        sdo['foo'] = 'bar'
+        self.assertTrue(sdm.get(('client', u'pkg'), when=self.T0) is sdo)
+        self.assertEqual(len(sdm), 0)
+        sdm.transaction_manager.commit()
+        self.assertEqual(len(sdm), 1)
+
+        found = sdm.query(('client', u'pkg'), when=self.T0)
+        self.assertEqual(dict(found), {'foo': 'bar'})
+        self.assertEqual(found._pk, u'pkg')
+        # a copy
+        self.assertFalse(found is sdo)
+
+    def test_unmodified_new_sessions_are_not_stored(self):
+        sdm = self._makeOne()
+        sdm.get('foobar', when=self.T0)
+        sdm.transaction_manager.commit()
+        self.assertEqual(len(sdm), 0)
+
+    def test_abort(self):
+        sdm = self._makeOne()
+        sdm.get('foobar', when=self.T0)['foo'] = 'bar'
+        sdm.transaction_manager.commit()
+        sdm.get('foobar', when=self.T0)['foo'] = 'baz'
+        sdm.get('new', when=self.T0)
+        sdm.transaction_manager.abort()
+        self.assertEqual(dict(sdm.query('foobar', when=self.T0)),
+                         {'foo': 'bar'})
+        self.assertEqual(sdm.query('new', when=self.T0), None)
+
+    def test_concurrent_writes_are_merged(self):
+        sdm = self._makeOne()
+        sdm.get('foobar', when=self.T0)['a'] = 1
+        sdm.transaction_manager.commit()
+
+        other = self._other(sdm)
+        sdm.get('foobar', when=self.T0)['b'] = 2
+        other.get('foobar', when=self.T0)['c'] = 3
+        sdm.transaction_manager.commit()
+        other.transaction_manager.commit()
+        self.assertEqual(dict(sdm.query('foobar', when=self.T0)),
+                         {'a': 1, 'b': 2, 'c': 3})
+
+    def test_concurrent_writes_of_the_same_key_conflict(self):
+        from ZODB.POSException import ConflictError
+        sdm = self._makeOne()
+        sdm.get('foobar', when=self.T0)['a'] = 1
+        sdm.transaction_manager.commit()
+
+        other = self._other(sdm)
+        sdm.get('foobar', when=self.T0)['a'] = 2
+        other.get('foobar', when=self.T0)['a'] = 3
+        sdm.transaction_manager.commit()
+        self.assertRaises(ConflictError, other.transaction_manager.commit)
+        other.transaction_manager.abort()
+        self.assertEqual(dict(sdm.query('foobar', when=self.T0)), {'a': 2})
+        # the shard locks were released
+        other.get('foobar', when=self.T0)['a'] = 4
+        other.transaction_manager.commit()
+        sdm.transaction_manager.abort()
+        self.assertEqual(dict(sdm.query('foobar', when=self.T0)), {'a': 4})
+
+    def test_concurrent_inserts_conflict(self):
+        from ZODB.POSException import ConflictError
+        sdm = self._makeOne()
+        other = self._other(sdm)
+        sdm.get('foobar', when=self.T0)['a'] = 1
+        other.get('foobar', when=self.T0)['b'] = 2
+        sdm.transaction_manager.commit()
+        self.assertRaises(ConflictError, other.transaction_manager.commit)
+        other.transaction_manager.abort()
+        self.assertEqual(dict(sdm.query('foobar', when=self.T0)), {'a': 1})
+
+    def test_savepoint(self):
+        sdm = self._makeOne()
+        sdo = sdm.get('foobar', when=self.T0)
+        sdo['a'] = 1
+        savepoint = sdm.transaction_manager.savepoint()
+        sdo['a'] = 2
+        sdo['b'] = 3
+        savepoint.rollback()
+        sdm.transaction_manager.commit()
+        self.assertEqual(dict(sdm.query('foobar', when=self.T0)), {'a': 1})
+
+    def test_expiry_and_gc(self):
+        from repoze.session.interfaces import ISessionEndEvent
+        ended = []
+        zope.component.testing.setUp(self)
+        self.addCleanup(zope.component.testing.tearDown, self)
+        zope.component.provideHandler(
+            lambda event: ended.append(dict(event.session)),
+            [ISessionEndEvent])
+
+        sdm = self._makeOne(shards=1)
+        sdm.inline_gc = False
+        sdm.get('old', when=self.T0)['a'] = 1
+        sdm.transaction_manager.commit()
+        sdm.get('new', when=self.T0 + 600)['b'] = 2
+        sdm.transaction_manager.commit()
+
+        later = self.T0 + 4200
+        self.assertEqual(sdm.query('old', when=later), None)
+        self.assertEqual(dict(sdm.query('new', when=later)), {'b': 2})
+        sdm.transaction_manager.abort()
+        self.assertEqual(sdm.gc(when=later), 1)
+        self.assertEqual(ended, [{'a': 1}])
+        self.assertEqual(len(sdm), 1)
+
+    def test_touch(self):
+        sdm = self._makeOne(shards=1)
+        sdm.inline_gc = False
+        sdm.get('a', when=self.T0)['a'] = 1
+        sdm.transaction_manager.commit()
+        sdm.get('b', when=self.T0 + 600)['b'] = 2
+        sdm.transaction_manager.commit()
+        # reading moves it to the end
+        sdm.query('a', when=self.T0 + 1200)
+        self.assertEqual(sdm.gc(when=self.T0 + 4800), 1)
+        self.assertEqual(sdm.query('b', when=self.T0 + 4800), None)
+        self.assertEqual(dict(sdm.query('a', when=self.T0 + 4800)),
+                         {'a': 1})
+
+    def test_max_sessions(self):
+        sdm = self._makeOne(shards=1, max_sessions=2)
+        for key in ('a', 'b', 'c'):
+            sdm.get(key, when=self.T0)[key] = 1
+            sdm.transaction_manager.commit()
+        self.assertEqual(len(sdm), 2)
+        self.assertEqual(sdm.query('a', when=self.T0), None)
+
+    def test_clear(self):
+        sdm = self._makeOne()
+        sdm.get('foobar', when=self.T0)['a'] = 1
+        sdm.transaction_manager.commit()
+        sdm.clear()
+        self.assertEqual(sdm.query('foobar', when=self.T0), None)
+        self.assertEqual(len(sdm), 1)
+        sdm.transaction_manager.commit()
+        self.assertEqual(len(sdm), 0)
+
+
+class TestDirective(unittest.TestCase):
+
+    def setUp(self):
+        zope.component.testing.setUp(self)
+
+    def tearDown(self):
+        zope.component.testing.tearDown(self)
+
+    def test_memorySessionDataManager(self):
+        from zope.configuration import xmlconfig
+        import cipher.session
+        from cipher.session.interfaces import ISessionDataManager
+        context = xmlconfig.file('meta.zcml', cipher.session)
+        xmlconfig.string("""
+            <configure xmlns="http://namespaces.zope.org/session">
+              <memorySessionDataManager
+                  max_sessions="1000"
+                  shards="4"
+                  />
+            </configure>
+            """, context)
+        sdm = zope.component.getUtility(ISessionDataManager)
+        self.assertEqual(sdm.max_sessions, 1000)
+        self.assertEqual(len(sdm._shards), 4)
+        self.assertEqual(sdm.timeout, 3600)
+
+    def test_named(self):
+        from zope.configuration import xmlconfig
+        import cipher.session
+        from cipher.session.interfaces import ISessionDataManager
+        context = xmlconfig.file('meta.zcml', cipher.session)
+        xmlconfig.string("""
+            <configure xmlns="http://namespaces.zope.org/session">
+              <memorySessionDataManager
+                  name="app.flash"
+                  timeout="300"
+                  period="60"
+                  />
+            </configure>
+            """, context)
+        sdm = zope.component.getUtility(ISessionDataManager,
+                                        name=u'app.flash')
+        self.assertEqual(sdm.timeout, 300)
+        self.assertEqual(
+            zope.component.queryUtility(ISessionDataManager), None)
+
+
+def test_suite():
+    return unittest.TestSuite((
+        unittest.makeSuite(TestMemorySessionDataManager),
+        unittest.makeSuite(TestDirective),
+        ))
@@ -0,0 +1,111 @@
+"""Metrics tests"""
+
+import unittest
+
+from zope.testing.cleanup import CleanUp
+
+
+class TestHistogram(unittest.TestCase):
+
+    def _makeOne(self):
+        from cipher.session.metrics import Histogram
+        return Histogram()
+
+    def test_empty(self):
+        histogram = self._makeOne()
+        self.assertEqual(histogram.count, 0)
+        self.assertEqual(histogram.mean, None)
+
+    def test_add(self):
+        histogram = self._makeOne()
+        for value in (0, 0.3, 3, 4, 5):
+            histogram.add(value)
+        self.assertEqual(histogram.count, 5)
+        self.assertEqual(histogram.min, 0)
+        self.assertEqual(histogram.max, 5)
+        self.assertAlmostEqual(histogram.mean, 2.46)
+        self.assertEqual(histogram.buckets, {0: 1, 0.5: 1, 4: 2, 8: 1})
+
+
+class TestRegistry(CleanUp, unittest.TestCase):
+
+    def test_incr_and_observe(self):
+        from cipher.session import metrics
+        metrics.incr('foo')
+        metrics.incr('foo', 2)
+        metrics.observe('bar', 1.5)
+        self.assertEqual(metrics.counters, {'foo': 3})
+        self.assertEqual(metrics.histograms['bar'].count, 1)
+        metrics.reset()
+        self.assertEqual(metrics.counters, {})
+        self.assertEqual(metrics.histograms, {})
+
+    def test_sink(self):
+        from cipher.session import metrics
+        seen = []
+        sink = lambda *args: seen.append(args)
+        metrics.addSink(sink)
+        metrics.incr('foo')
+        metrics.observe('bar', 1.5)
+        metrics.removeSink(sink)
+        metrics.incr('foo')
+        self.assertEqual(seen, [('count', 'foo', 1), ('value', 'bar', 1.5)])
+
+    def test_broken_sink(self):
+        from cipher.session import metrics
+        def sink(kind, name, value):
+            raise RuntimeError(name)
+        metrics.addSink(sink)
+        metrics.incr('foo')
+        self.assertEqual(metrics.counters, {'foo': 1})
+
+
+class TestResolver(CleanUp, unittest.TestCase):
+
+    def _resolve(self, old, committed, new):
+        from cipher.session.session import AppendOnlyDict
+        return AppendOnlyDict()._p_resolveConflict(
+            {'data': old}, {'data': committed}, {'data': new})
+
+    def test_succeeded(self):
+        from cipher.session import metrics
+        self._resolve({'a': 1}, {'a': 1, 'b': 2}, {'a': 1, 'c': 3})
+        self.assertEqual(sorted(metrics.counters.items()), [
+            ('resolve.bucket.attempted', 1),
+            ('resolve.bucket.succeeded', 1)])
+        self.assertEqual(metrics.histograms['resolve.bucket.size'].max, 2)
+        self.assertEqual(metrics.histograms['resolve.bucket.seconds'].count,
+                         1)
+
+    def test_failed_by_reason(self):
+        from ZODB.POSException import ConflictError
+        from cipher.session import metrics
+        self.assertRaises(ConflictError, self._resolve,
+                          {'a': 1}, {}, {'a': 1, 'c': 3})
+        self.assertRaises(ConflictError, self._resolve,
+                          {'a': 1}, {'a': 1, 'b': 2}, {'a': 1, 'b': 3})
+        self.assertEqual(sorted(metrics.counters.items()), [
+            ('resolve.bucket.attempted', 2),
+            ('resolve.bucket.failed', 2),
+            ('resolve.bucket.failed.clear', 1),
+            ('resolve.bucket.failed.insert', 1)])
+
+    def test_session_data(self):
+        from ZODB.POSException import ConflictError
+        from cipher.session import metrics
+        from cipher.session.session import SessionData
+        old = {'data': {'a': 1}, '_lm': 1}
+        committed = {'data': {'a': 2}, '_lm': 2}
+        new = {'data': {'a': 3}, '_lm': 3}
+        self.assertRaises(ConflictError, SessionData()._p_resolveConflict,
+                          old, committed, new)
+        self.assertEqual(metrics.counters['resolve.data.failed.competing'],
+                         1)
+
+
+def test_suite():
+    return unittest.TestSuite((
+        unittest.makeSuite(TestHistogram),
+        unittest.makeSuite(TestRegistry),
+        unittest.makeSuite(TestResolver),
+        ))
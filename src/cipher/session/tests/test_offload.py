@@ -0,0 +1,179 @@
+"""Tests of session data values stored apart"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import transaction
+from ZODB.blob import Blob, BlobStorage
+from ZODB.DB import DB
+from ZODB.FileStorage import FileStorage
+from ZODB.MappingStorage import MappingStorage
+
+from cipher.session import metrics
+from cipher.session import offload
+
+
+class TestOffloadingSessionData(unittest.TestCase):
+
+    def setUp(self):
+        from cipher.session.session import SessionDataManager
+        self.tmpdir = tempfile.mkdtemp()
+        self.db = DB(FileStorage(os.path.join(self.tmpdir, 'Data.fs')))
+        self.conn = self.db.open()
+        self.sdm = self.conn.root()['sdm'] = SessionDataManager()
+        self.sdm.offload_threshold = 1000
+        transaction.commit()
+        self.ids = ['item-%d' % i for i in range(1000)]
+        metrics.reset()
+
+    def tearDown(self):
+        transaction.abort()
+        self.conn.close()
+        self.db.close()
+        shutil.rmtree(self.tmpdir)
+
+    def _other(self):
+        tm = transaction.TransactionManager()
+        conn = self.db.open(transaction_manager=tm)
+        self.addCleanup(conn.close)
+        return conn.root()['sdm'].query('foobar'), tm
+
+    def test_big_values_are_stored_apart(self):
+        sdo = self.sdm.get('foobar')
+        sdo['ids'] = self.ids
+        sdo['page'] = 1
+        transaction.commit()
+        holder = sdo.data['ids']
+        self.assertTrue(isinstance(holder, offload.SessionValue))
+        self.assertEqual(sdo['page'], 1)
+        self.assertEqual(sdo['ids'], self.ids)
+        self.assertEqual(dict(sdo.items()), {'ids': self.ids, 'page': 1})
+        self.assertEqual(metrics.counters['offload.stored'], 1)
+
+        # small changes don't write it again
+        serial = holder._p_serial
+        sdo['page'] = 2
+        transaction.commit()
+        self.assertEqual(holder._p_serial, serial)
+        self.assertEqual(metrics.counters['offload.stored'], 1)
+
+    def test_unread_values_are_not_loaded(self):
+        sdo = self.sdm.get('foobar')
+        sdo['ids'] = self.ids
+        sdo['page'] = 1
+        transaction.commit()
+        other, tm = self._other()
+        self.assertEqual(other['page'], 1)
+        self.assertEqual(other.data['ids']._p_changed, None)
+        self.assertEqual(other['ids'], self.ids)
+
+    def test_set_again(self):
+        sdo = self.sdm.get('foobar')
+        sdo['ids'] = self.ids
+        transaction.commit()
+        sdo['ids'] = self.ids + ['more']
+        transaction.commit()
+        self.assertEqual(metrics.counters['offload.stored'], 2)
+        other, tm = self._other()
+        self.assertEqual(other['ids'], self.ids + ['more'])
+        self.assertEqual(other.pop('ids'), self.ids + ['more'])
+
+    def test_overlay_loads_read_values(self):
+        from cipher.session.writeback import SessionDataOverlay
+        sdo = self.sdm.get('foobar')
+        sdo['ids'] = self.ids
+        sdo['page'] = 1
+        transaction.commit()
+        other, tm = self._other()
+        overlay = SessionDataOverlay(other)
+        self.assertEqual(overlay['page'], 1)
+        overlay['page'] = 2
+        self.assertTrue(overlay.flush())
+        tm.commit()
+        self.assertEqual(other.data['ids']._p_changed, None)
+        self.assertEqual(overlay['ids'], self.ids)
+        self.assertEqual(overlay.changes(), {})
+        other, tm = self._other()
+        self.assertEqual(dict(other.items()), {'ids': self.ids, 'page': 2})
+
+    def test_policy_sees_references(self):
+        from ZODB.ConflictResolution import PersistentReference
+        from cipher.session.policy import clearConflictPolicies
+        from cipher.session.policy import registerConflictPolicy
+        seen = []
+
+        def policy(old, committed, new, committed_lm, new_lm):
+            seen.append((old, committed, new))
+            return new
+        registerConflictPolicy(policy, prefix='ids')
+        self.addCleanup(clearConflictPolicies)
+        sdo = self.sdm.get('foobar')
+        sdo['ids'] = self.ids
+        transaction.commit()
+        other, tm = self._other()
+        other['ids'] = self.ids[:600]
+        sdo['ids'] = self.ids[:500]
+        transaction.commit()
+        tm.commit()
+        [(old, committed, new)] = seen
+        self.assertTrue(isinstance(committed, PersistentReference))
+        self.assertTrue(isinstance(new, PersistentReference))
+        other, tm = self._other()
+        self.assertEqual(other['ids'], self.ids[:600])
+
+    def test_resolve_conflict(self):
+        sdo = self.sdm.get('foobar')
+        sdo['ids'] = self.ids
+        transaction.commit()
+        other, tm = self._other()
+        other['page'] = 1
+        other['more'] = self.ids
+        sdo['ids'] = self.ids[:500]
+        transaction.commit()
+        tm.commit()
+        other, tm = self._other()
+        self.assertEqual(dict(other.items()), {
+            'ids': self.ids[:500], 'page': 1, 'more': self.ids})
+
+
+class TestBlobs(unittest.TestCase):
+
+    def setUp(self):
+        from cipher.session.session import SessionDataManager
+        self.tmpdir = tempfile.mkdtemp()
+        self.db = DB(BlobStorage(self.tmpdir, MappingStorage()))
+        self.conn = self.db.open()
+        self.sdm = self.conn.root()['sdm'] = SessionDataManager()
+        self.sdm.offload_threshold = 1000
+        transaction.commit()
+        self.old_threshold = offload.BLOB_THRESHOLD
+        offload.BLOB_THRESHOLD = 10000
+
+    def tearDown(self):
+        offload.BLOB_THRESHOLD = self.old_threshold
+        transaction.abort()
+        self.conn.close()
+        self.db.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_big_bytes_are_blobs(self):
+        sdo = self.sdm.get('foobar')
+        sdo['pdf'] = b'%PDF' * 5000
+        sdo['text'] = b'x' * 5000
+        transaction.commit()
+        self.assertTrue(isinstance(sdo.data['pdf'], Blob))
+        self.assertTrue(isinstance(sdo.data['text'], offload.SessionValue))
+        conn = self.db.open(
+            transaction_manager=transaction.TransactionManager())
+        self.addCleanup(conn.close)
+        self.assertEqual(conn.root()['sdm'].query('foobar')['pdf'],
+                         b'%PDF' * 5000)
+
+
+def test_suite():
+    return unittest.TestSuite((
+        unittest.makeSuite(TestOffloadingSessionData),
+        unittest.makeSuite(TestBlobs),
+        ))
@@ -0,0 +1,184 @@
+"""Conflict policy tests"""
+
+import unittest
+
+import zope.component.testing
+
+
+class TestPolicies(unittest.TestCase):
+
+    def test_lastWriterWins(self):
+        from cipher.session.policy import lastWriterWins
+        self.assertEqual(lastWriterWins(1, 2, 3, 10, 20), 3)
+        self.assertEqual(lastWriterWins(1, 2, 3, 20, 10), 2)
+
+    def test_maxValue(self):
+        from cipher.session.policy import maxValue
+        self.assertEqual(maxValue(1, 5, 3, 10, 20), 5)
+
+    def test_maxValue_deleted(self):
+        from ZODB.POSException import ConflictError
+        from cipher.session.policy import maxValue, MISSING
+        self.assertRaises(ConflictError, maxValue, 1, MISSING, 3, 10, 20)
+
+    def test_sumOfDeltas(self):
+        from cipher.session.policy import sumOfDeltas, MISSING
+        self.assertEqual(sumOfDeltas(10, 12, 15, 1, 2), 17)
+        self.assertEqual(sumOfDeltas(MISSING, 1, 1, 1, 2), 2)
+
+    def test_setUnion(self):
+        from cipher.session.policy import setUnion
+        self.assertEqual(setUnion(set([1]), set([1, 2]), set([1, 3]), 1, 2),
+                         set([1, 2, 3]))
+        self.assertEqual(setUnion([1], [1, 2], [3, 1], 1, 2), [1, 2, 3])
+        self.assertEqual(setUnion((), (1,), (2,), 1, 2), (1, 2))
+
+    def test_setUnion_incompatible(self):
+        from ZODB.POSException import ConflictError
+        from cipher.session.policy import setUnion
+        self.assertRaises(ConflictError, setUnion, 1, [1], 2, 1, 2)
+
+
+class TestRegistry(unittest.TestCase):
+
+    def tearDown(self):
+        from cipher.session.policy import clearConflictPolicies
+        clearConflictPolicies()
+
+    def test_queryConflictPolicy_nothing(self):
+        from cipher.session.policy import queryConflictPolicy
+        self.assertEqual(queryConflictPolicy('pkg', 'key'), None)
+
+    def test_queryConflictPolicy_most_specific(self):
+        from cipher.session.policy import registerConflictPolicy
+        from cipher.session.policy import queryConflictPolicy
+        registerConflictPolicy('any')
+        registerConflictPolicy('any-prefix', prefix=u'count')
+        registerConflictPolicy('pkg', pkg_id=u'pkg')
+        registerConflictPolicy('pkg-prefix', pkg_id=u'pkg', prefix=u'count')
+        self.assertEqual(queryConflictPolicy(u'other', u'key'), 'any')
+        self.assertEqual(queryConflictPolicy(u'other', u'counter'),
+                         'any-prefix')
+        self.assertEqual(queryConflictPolicy(u'pkg', u'key'), 'pkg')
+        self.assertEqual(queryConflictPolicy(u'pkg', u'counter'),
+                         'pkg-prefix')
+        self.assertEqual(queryConflictPolicy(u'pkg', ('not', 'text')), 'pkg')
+
+    def test_resolveConflict_with_policy(self):
+        from cipher.session.policy import registerConflictPolicy
+        from cipher.session.policy import sumOfDeltas
+        from cipher.session.session import SessionData
+        registerConflictPolicy(sumOfDeltas, pkg_id=u'pkg', prefix=u'hits')
+        old       = {'_lm':0, '_pk':u'pkg', 'data':{'hits': 1, 'a': 1}}
+        committed = {'_lm':1, '_pk':u'pkg', 'data':{'hits': 2, 'a': 1}}
+        new       = {'_lm':2, '_pk':u'pkg', 'data':{'hits': 3, 'a': 1}}
+        result = SessionData()._p_resolveConflict(old, committed, new)
+        self.assertEqual(result['data'], {'hits': 4, 'a': 1})
+
+    def test_resolveConflict_other_package(self):
+        from ZODB.POSException import ConflictError
+        from cipher.session.policy import registerConflictPolicy
+        from cipher.session.policy import sumOfDeltas
+        from cipher.session.session import SessionData
+        registerConflictPolicy(sumOfDeltas, pkg_id=u'pkg')
+        old       = {'_lm':0, '_pk':u'other', 'data':{'hits': 1}}
+        committed = {'_lm':1, '_pk':u'other', 'data':{'hits': 2}}
+        new       = {'_lm':2, '_pk':u'other', 'data':{'hits': 3}}
+        self.assertRaises(ConflictError, SessionData()._p_resolveConflict,
+                          old, committed, new)
+
+    def test_resolveConflict_policy_raises(self):
+        from ZODB.POSException import ConflictError
+        from cipher.session.policy import registerConflictPolicy
+        from cipher.session.policy import maxValue
+        from cipher.session.session import SessionData
+        registerConflictPolicy(maxValue)
+        old       = {'_lm':0, 'data':{'seen': 1}}
+        committed = {'_lm':1, 'data':{}}
+        new       = {'_lm':2, 'data':{'seen': 3}}
+        self.assertRaises(ConflictError, SessionData()._p_resolveConflict,
+                          old, committed, new)
+
+
+def registerTestPolicies():
+    from cipher.session.policy import registerConflictPolicy, maxValue
+    registerConflictPolicy(maxValue, u'pkg', u'count')
+
+
+class TestLoadConflictPolicies(unittest.TestCase):
+
+    def tearDown(self):
+        zope.component.testing.tearDown()
+
+    def _working_set(self):
+        import pkg_resources
+        dist = pkg_resources.Distribution(
+            location='/nowhere', project_name='myapp', version='1.0')
+        dist._ep_map = {'cipher.session.conflict_policies': {
+            'myapp': pkg_resources.EntryPoint.parse(
+                'myapp = %s:registerTestPolicies' % __name__, dist=dist)}}
+        working_set = pkg_resources.WorkingSet([])
+        working_set.add(dist)
+        return working_set
+
+    def test_loadConflictPolicies(self):
+        from cipher.session.policy import loadConflictPolicies, maxValue
+        from cipher.session.policy import queryConflictPolicy
+        self.assertEqual(loadConflictPolicies(self._working_set()),
+                         ['myapp'])
+        self.assertTrue(queryConflictPolicy(u'pkg', u'count') is maxValue)
+
+    def test_zeo_import(self):
+        # zeo.conf loads the package with %import
+        import ZConfig
+        from io import StringIO
+        schema = ZConfig.loadSchemaFile(StringIO(u'<schema/>'))
+        ZConfig.loadConfigFile(
+            schema, StringIO(u'%import cipher.session.storageserver\n'))
+
+
+class TestDirective(unittest.TestCase):
+
+    def setUp(self):
+        zope.component.testing.setUp(self)
+
+    def tearDown(self):
+        zope.component.testing.tearDown(self)
+
+    def test_conflictPolicy(self):
+        from zope.configuration import xmlconfig
+        import cipher.session
+        from cipher.session.policy import queryConflictPolicy
+        from cipher.session.policy import maxValue
+        context = xmlconfig.file('meta.zcml', cipher.session)
+        xmlconfig.string("""
+            <configure xmlns="http://namespaces.zope.org/session">
+              <conflictPolicy
+                  policy="cipher.session.policy.maxValue"
+                  pkg_id="app.tracking"
+                  prefix="last_seen"
+                  />
+            </configure>
+            """, context)
+        self.assertTrue(
+            queryConflictPolicy(u'app.tracking', u'last_seen') is maxValue)
+        self.assertEqual(queryConflictPolicy(u'app.tracking', u'x'), None)
+
+
+class TestSessionDataManager(unittest.TestCase):
+
+    def test_get_sets_package_id(self):
+        from cipher.session.session import SessionDataManager
+        sdc = SessionDataManager()
+        self.assertEqual(sdc.get(('client', u'pkg'))._pk, u'pkg')
+        self.assertEqual(sdc.get('foobar')._pk, None)
+
+
+def test_suite():
+    return unittest.TestSuite((
+        unittest.makeSuite(TestPolicies),
+        unittest.makeSuite(TestRegistry),
+        unittest.makeSuite(TestLoadConflictPolicies),
+        unittest.makeSuite(TestDirective),
+        unittest.makeSuite(TestSessionDataManager),
+        ))
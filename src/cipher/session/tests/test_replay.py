@@ -0,0 +1,141 @@
+"""Tests of the conflict resolution replay script"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import transaction
+from persistent.mapping import PersistentMapping
+from ZODB.DB import DB
+from ZODB.FileStorage import FileStorage
+from ZODB.POSException import ConflictError
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+
+class TestReplay(unittest.TestCase):
+
+    def setUp(self):
+        from cipher.session.replay import record
+        from cipher.session.session import AppendOnlyDict, SessionData
+        from cipher.session.session import CompressedSessionData
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'Data.fs')
+        self.conflicts = os.path.join(self.tmpdir, 'conflicts')
+        storage = FileStorage(self.path)
+        # record the resolved conflicts too
+        record(storage, self.conflicts, slow=0)
+        self.db = DB(storage)
+        conn = self.db.open()
+        root = conn.root()
+        root['bucket'] = bucket = AppendOnlyDict()
+        root['sdo'] = sdo = SessionData()
+        root['csdo'] = CompressedSessionData()
+        root['other'] = other = PersistentMapping()
+        transaction.commit()
+        self.bucket_oid = bucket._p_oid
+        # one after another, nothing conflicts
+        for i in range(3):
+            bucket['key%d' % i] = SessionData()
+            sdo['count'] = i
+            other['count'] = i
+            transaction.commit()
+        conn.close()
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.tmpdir)
+
+    def _concurrently(self, *changes):
+        tms = []
+        for change in changes:
+            tm = transaction.TransactionManager()
+            change(self.db.open(tm).root())
+            tms.append(tm)
+        for tm in tms:
+            try:
+                tm.commit()
+            except ConflictError:
+                tm.abort()
+
+    def _replay(self, **kw):
+        from cipher.session.replay import recorded, replay
+        self.db.close()
+        storage = FileStorage(self.path, read_only=True)
+        out = StringIO()
+        try:
+            replays = []
+            if os.path.exists(self.conflicts):
+                replays = recorded(self.conflicts, **kw)
+            stats = replay(storage, replays, out=out)
+        finally:
+            storage.close()
+        return stats, out.getvalue()
+
+    def _conflicts(self):
+        from cipher.session.session import SessionData
+
+        def first(root):
+            root['bucket']['one'] = SessionData()
+            root['sdo']['count'] = 10
+
+        def second(root):
+            root['bucket']['two'] = SessionData()
+            root['sdo']['count'] = 20
+        self._concurrently(first, second)
+
+        def big(suffix):
+            def change(root):
+                root['csdo']['big'] = 'x' * 10000 + suffix
+            return change
+        self._concurrently(big('a'), big('b'))
+
+    def test_sequential_writes(self):
+        stats, out = self._replay()
+        self.assertEqual(stats, {})
+        self.assertEqual(out, '')
+
+    def test_stats(self):
+        self._conflicts()
+        stats, out = self._replay()
+        self.assertEqual(
+            sorted([(k, v[:2]) for k, v in stats.items()]),
+            [('cipher.session.session.AppendOnlyDict', (1, 0)),
+             ('cipher.session.session.CompressedSessionData', (1, 1)),
+             ('cipher.session.session.SessionData', (1, 1))])
+
+    def test_failures_are_reported(self):
+        self._conflicts()
+        stats, out = self._replay()
+        # both sides changed 'count'
+        self.assertTrue('SessionData' in out)
+        self.assertTrue("'count': int -> int -> int" in out)
+        # compressed values are compared uncompressed
+        self.assertTrue("'big': missing -> str -> str" in out)
+
+    def test_oid_filter(self):
+        self._conflicts()
+        stats, out = self._replay(oids=set([self.bucket_oid]))
+        self.assertEqual(list(stats), [
+            'cipher.session.session.AppendOnlyDict'])
+
+    def test_main(self):
+        from cipher.session.replay import main
+        self._conflicts()
+        self.db.close()
+        profile = os.path.join(self.tmpdir, 'replay.prof')
+        out = StringIO()
+        main([self.path, self.conflicts, '--slow', '0',
+              '--profile', profile], out)
+        self.assertTrue(os.path.exists(profile))
+        self.assertTrue('cipher.session.session.SessionData' in out.getvalue())
+
+
+def test_suite():
+    return unittest.TestSuite((
+        unittest.makeSuite(TestReplay),
+        ))
@@ -26,7 +26,9 @@ class ClientIdStub(object):
 
 
 class SessionDataStub(dict):
-    pass
+
+    def is_valid(self):
+        return True
 
 
 @zope.interface.implementer(interfaces.ISessionDataManager)
@@ -38,6 +40,9 @@ class SessionDataManagerStub(object):
     def query(self, key, default=None):
         return self._data.get(key, default)
 
+    def query_many(self, keys, default=None):
+        return dict([(key, self.query(key, default)) for key in keys])
+
     def get(self, key):
         if key in self._data:
             return self._data[key]
@@ -50,6 +55,15 @@ class SessionDataManagerStub(object):
         self.get(key)
 
 
+def printBuckets(sdc):
+    for bucket_slice, (bucket, ahead) in sorted(sdc._index.items()):
+        print('%r%s' % (bucket, ahead and ' (ahead)' or ''))
+
+
+def headBucket(sdc, when=None):
+    return sdc._index[sdc._slice(when)][0]
+
+
 def doctest_TransientSession():
     """class TransientSession: A session that stores data in the request
     annotations.
@@ -99,11 +113,105 @@ def doctest_Session():
     """
 
 
+def doctest_Session_request_cache():
+    r"""Session looks up session data once per request
+
+        >>> class LoggingSessionDataManagerStub(SessionDataManagerStub):
+        ...     def query(self, key, default=None):
+        ...         print('query %r' % (key, ))
+        ...         return SessionDataManagerStub.query(self, key, default)
+        ...     def get(self, key):
+        ...         print('get %r' % (key, ))
+        ...         return SessionDataManagerStub.get(self, key)
+
+        >>> sdm = LoggingSessionDataManagerStub()
+        >>> zope.component.provideUtility(sdm)
+
+        >>> request = TestRequest()
+        >>> session.Session(request).get('a-package') is None
+        query ('foobar', 'a-package')
+        True
+        >>> session.Session(request)['a-package']['foo'] = 'bar'
+        get ('foobar', 'a-package')
+
+        >>> session.Session(request)['a-package']
+        {'foo': 'bar'}
+        >>> session.Session(request).get('a-package')
+        {'foo': 'bar'}
+
+    The next request looks it up again
+
+        >>> session.Session(TestRequest()).get('a-package')
+        query ('foobar', 'a-package')
+        {'foo': 'bar'}
+
+    """
+
+
+def doctest_Session_get_many():
+    r"""Session.get_many looks up the data of several packages at once
+
+        >>> class LoggingSessionDataManagerStub(SessionDataManagerStub):
+        ...     def query_many(self, keys, default=None):
+        ...         print('query_many %r' % (sorted(keys), ))
+        ...         return SessionDataManagerStub.query_many(
+        ...             self, keys, default)
+
+        >>> sdm = LoggingSessionDataManagerStub()
+        >>> zope.component.provideUtility(sdm)
+
+        >>> request = TestRequest()
+        >>> session.Session(request)['a-package']['foo'] = 'bar'
+        >>> session.Session(TestRequest())['c-package']['baz'] = 'qux'
+
+        >>> pprint(session.Session(request).get_many(
+        ...     ['a-package', 'b-package', 'c-package'], 'DEFAULT'))
+        query_many [('foobar', 'b-package'), ('foobar', 'c-package')]
+        {'a-package': {'foo': 'bar'},
+         'b-package': 'DEFAULT',
+         'c-package': {'baz': 'qux'}}
+
+        >>> pprint(session.Session(request).get_many(
+        ...     ['a-package', 'c-package']))
+        {'a-package': {'foo': 'bar'}, 'c-package': {'baz': 'qux'}}
+
+    """
+
+
+def doctest_Session_package_managers():
+    r"""Session data of a package goes to the manager named after it
+
+        >>> default = SessionDataManagerStub()
+        >>> zope.component.provideUtility(default)
+        >>> flash = SessionDataManagerStub()
+        >>> zope.component.provideUtility(flash, name='app.flash')
+
+        >>> request = TestRequest()
+        >>> session.Session(request)['app.flash']['message'] = 'Saved'
+        >>> session.Session(request)['app.cart']['items'] = 3
+        >>> pprint(flash._data)
+        {('foobar', 'app.flash'): {'message': 'Saved'}}
+        >>> pprint(default._data)
+        {('foobar', 'app.cart'): {'items': 3}}
+
+        >>> pprint(session.Session(TestRequest()).get_many(
+        ...     ['app.flash', 'app.cart']))
+        {'app.cart': {'items': 3}, 'app.flash': {'message': 'Saved'}}
+
+    """
+
+
 def doctest_SessionDataManager():
     r"""Test for utils.SessionDataManager
 
         >>> sdc = session.SessionDataManager()
 
+        >>> from zope.interface.verify import verifyObject
+        >>> verifyObject(interfaces.ISessionDataManager, sdc)
+        True
+        >>> verifyObject(interfaces.ISessionInvalidation, sdc)
+        True
+
         >>> sdc.timeout
         3600
 
@@ -113,8 +221,8 @@ def doctest_SessionDataManager():
         >>> sdc.nonlazy
         True
 
-        >>> sdc.head
-        <ListNode object at ... for ob (..., {}) with next None>
+        >>> len(sdc._index)
+        0
 
         >>> data = sdc.get('foobar')
         >>> data
@@ -125,13 +233,368 @@ def doctest_SessionDataManager():
         >>> sdc['foobar']
         {'foo': 'bar'}
 
-        >>> sdc.head
-        <ListNode object at ... for ob (..., {'foobar': {'foo': 'bar'}}) with next None>
+        >>> printBuckets(sdc)
+        {'foobar': {'foo': 'bar'}}
+        {} (ahead)
 
         >>> sdc.clear()
 
+        >>> len(sdc._index)
+        0
+
+    """
+
+
+def doctest_SessionDataManager_buckets():
+    r"""Test for utils.SessionDataManager's bucket index
+
+    Buckets are kept by the start of their period, the bucket of the next
+    period is created ahead of time
+
+        >>> import time
+        >>> T0 = int(time.time() // 600 + 6) * 600
+        >>> sdc = session.SessionDataManager()
+        >>> sdc.get('foobar', when=T0)['foo'] = 'bar'
+        >>> [s - T0 for s in sorted(sdc._index)]
+        [0, 600]
+        >>> printBuckets(sdc)
+        {'foobar': {'foo': 'bar'}}
+        {} (ahead)
+
+    Writing into a bucket created ahead in the same transaction marks it as
+    a regular one, conflict resolution must not throw it away
+
+        >>> sdc.get('baz', when=T0 + 600)['foo'] = 'qux'
+        >>> printBuckets(sdc)
+        {'foobar': {'foo': 'bar'}}
+        {'baz': {'foo': 'qux'}}
+        {} (ahead)
+
+    Reads that don't copy the session into the current bucket don't create
+    buckets
+
+        >>> sdc.touch_resolution = 3600
+        >>> sdc.search('foobar', when=T0 + 2400)
+        {'foo': 'bar'}
+        >>> len(sdc._index)
+        3
+
+    """
+
+
+def doctest_SessionDataManager_migration():
+    r"""SessionDataManagers used to keep the buckets in a linked list
+
+        >>> from repoze.session import manager
+        >>> sdc = session.SessionDataManager.__new__(
+        ...     session.SessionDataManager)
+        >>> manager.SessionDataManager.__init__(sdc, 3600, 600)
+        >>> ignored, bucket = sdc.head.ob
+        >>> bucket['foobar'] = session.SessionData({'foo': 'bar'})
+
+        >>> sdc.query('foobar')
+        {'foo': 'bar'}
         >>> sdc.head
-        <ListNode object at ... for ob (..., {}) with next None>
+        Traceback (most recent call last):
+        ...
+        AttributeError: 'SessionDataManager' object has no attribute 'head'
+        >>> printBuckets(sdc)
+        {'foobar': {'foo': 'bar'}}
+
+    """
+
+
+def doctest_SessionDataManager_query_many():
+    r"""Test for utils.SessionDataManager.query_many
+
+        >>> import time
+        >>> T0 = time.time() + 3600
+        >>> sdc = session.SessionDataManager()
+        >>> sdc.get('old', when=T0)['foo'] = 'old'
+        >>> sdc.get('new', when=T0 + 600)['foo'] = 'new'
+
+        >>> pprint(sdc.search_many(['old', 'new', 'none'], when=T0 + 600))
+        {'new': {'foo': 'new'}, 'old': {'foo': 'old'}}
+
+    The sessions found in older buckets are copied into the head bucket
+
+        >>> sorted(headBucket(sdc, T0 + 600).keys())
+        ['new', 'old']
+
+        >>> pprint(sdc.query_many(['old', 'none'], 'DEFAULT', when=T0 + 600))
+        {'none': 'DEFAULT', 'old': {'foo': 'old'}}
+
+    """
+
+
+def doctest_SessionDataManager_gc():
+    r"""Test for utils.SessionDataManager.gc
+
+        >>> from repoze.session.interfaces import ISessionEndEvent
+        >>> @zope.component.adapter(ISessionEndEvent)
+        ... def printEnd(event):
+        ...     print('end %r' % (event.session, ))
+        >>> zope.component.provideHandler(printEnd)
+
+        >>> import time
+        >>> T0 = time.time() + 3600
+        >>> sdc = session.SessionDataManager()
+        >>> sdc.inline_gc = False
+        >>> sdc.get('one', when=T0)['n'] = 1
+        >>> sdc.get('two', when=T0 + 600)['n'] = 2
+        >>> sdc.get('three', when=T0 + 1200)['n'] = 3
+        >>> sdc.search('two', when=T0 + 1200)
+        {'n': 2}
+
+    Without inline_gc requests don't see expired data, but don't remove it
+
+        >>> sdc.search('one', when=T0 + 4200) is None
+        True
+        >>> len(sdc._index)
+        4
+
+    gc() removes it, the oldest bucket first
+
+        >>> sdc.gc(max_buckets=1, when=T0 + 4800)
+        end {'n': 1}
+        1
+        >>> len(sdc._index)
+        3
+
+    'two' moved to a newer bucket when it was read, it ends with that one
+
+        >>> sdc.gc(when=T0 + 4800)
+        1
+        >>> sdc.gc(when=T0 + 4800)
+        0
+
+        >>> sdc.gc(when=T0 + 6000)
+        end {'n': ...}
+        end {'n': ...}
+        1
+
+    The bucket created ahead is kept, the next request takes it over.
+
+        >>> printBuckets(sdc)
+        {} (ahead)
+        >>> sdc.get('four', when=T0 + 6000)
+        {}
+        >>> printBuckets(sdc)
+        {'four': {}}
+        {} (ahead)
+
+    """
+
+
+def doctest_SessionDataManager_shards():
+    r"""Test for utils.SessionDataManager with sharded buckets
+
+        >>> sdc = session.SessionDataManager(shards=8)
+
+        >>> sdc.get(('foobar', 'a-package'))['foo'] = 'bar'
+        >>> sdc[('foobar', 'a-package')]
+        {'foo': 'bar'}
+
+        >>> printBuckets(sdc)
+        <ShardedBucket with 8 shards>
+        <ShardedBucket with 8 shards> (ahead)
+
+        >>> bucket = headBucket(sdc)
+        >>> bucket.items()
+        [(('foobar', 'a-package'), {'foo': 'bar'})]
+        >>> sorted([len(shard) for shard in bucket.shards])
+        [0, 0, 0, 0, 0, 0, 0, 1]
+
+    """
+
+
+def doctest_SessionDataManager_touch_resolution():
+    r"""Test for utils.SessionDataManager.touch_resolution
+
+    Sessions are kept alive by copying them into the head bucket when they
+    are read, that is a write to the database.
+
+        >>> import time
+        >>> from cipher.session import metrics
+        >>> T0 = time.time() + 3600
+        >>> sdc = session.SessionDataManager()
+        >>> sdc.get('foobar', when=T0)['foo'] = 'bar'
+
+        >>> sdc.search('foobar', when=T0 + 600)
+        {'foo': 'bar'}
+        >>> bucket = headBucket(sdc, T0 + 600)
+        >>> bucket.keys()
+        ['foobar']
+        >>> metrics.counters
+        {'touch.written': 1}
+
+    With a touch_resolution the write is skipped as long as the session's
+    bucket is more recent than that.
+
+        >>> metrics.reset()
+        >>> sdc = session.SessionDataManager()
+        >>> sdc.touch_resolution = 1200
+        >>> sdc.get('foobar', when=T0)['foo'] = 'bar'
+
+        >>> sdc.search('foobar', when=T0 + 600)
+        {'foo': 'bar'}
+        >>> bucket = headBucket(sdc, T0 + 600)
+        >>> bucket.keys()
+        []
+        >>> metrics.counters
+        {'touch.skipped': 1}
+
+        >>> sdc.search('foobar', when=T0 + 1200)
+        {'foo': 'bar'}
+        >>> bucket = headBucket(sdc, T0 + 1200)
+        >>> bucket.keys()
+        ['foobar']
+        >>> sorted(metrics.counters.items())
+        [('touch.skipped', 1), ('touch.written', 1)]
+
+    """
+
+
+def doctest_SessionDataManager_lazy():
+    r"""Lazy SessionDataManagers store new session data once it's modified
+
+        >>> import time
+        >>> import transaction
+        >>> from cipher.session import metrics
+        >>> T0 = time.time() + 3600
+        >>> sdc = session.SessionDataManager(lazy=True)
+        >>> sdc.nonlazy
+        False
+
+    Session data that was only read isn't stored.
+
+        >>> data = sdc.get('crawler', when=T0)
+        >>> transaction.commit()
+        >>> sdc.search('crawler', when=T0) is None
+        True
+        >>> metrics.counters
+        {'lazy.discarded': 1}
+
+    Until the transaction commits, the same new session data is returned
+    every time, it's stored if any of those changed it.
+
+        >>> data = sdc.get('visitor', when=T0)
+        >>> sdc.get('visitor', when=T0) is data
+        True
+        >>> sdc['visitor'] is data
+        True
+        >>> data['foo'] = 'bar'
+        >>> sdc.search('visitor', when=T0) is None
+        True
+        >>> transaction.commit()
+        >>> sdc.search('visitor', when=T0) is data
+        True
+
+    Nothing is stored when the transaction is aborted.
+
+        >>> sdc.get('aborted', when=T0)['foo'] = 'bar'
+        >>> transaction.abort()
+        >>> sdc.search('aborted', when=T0) is None
+        True
+        >>> sorted(metrics.counters.items())
+        [('lazy.discarded', 1), ('lazy.stored', 1)]
+
+    """
+
+
+def doctest_SessionDataManager_invalidate_clients():
+    r"""SessionDataManager finds the session data of clients by key
+
+        >>> import time
+        >>> T0 = time.time() + 3600
+        >>> sdc = session.SessionDataManager()
+        >>> sdc.get(('client', 'app.a'), when=T0)['foo'] = 'bar'
+        >>> sdc.get(('client', 'app.b'), when=T0 + 600)['foo'] = 'bar'
+        >>> sdc.get(('other', 'app.a'), when=T0)['foo'] = 'bar'
+
+    All the session data of clients is invalidated without looking at that
+    of other clients, and without keeping it alive.
+
+        >>> sdc.invalidate_clients(['client'], when=T0 + 1200)
+        2
+        >>> sdc.search(('client', 'app.a'), when=T0 + 1200).is_valid()
+        False
+        >>> sdc.search(('other', 'app.a'), when=T0 + 1200).is_valid()
+        True
+        >>> printBuckets(sdc)
+        {('client', 'app.a'): {'foo': 'bar'}, ('other', 'app.a'): {...}}
+        {('client', 'app.b'): {'foo': 'bar'}}
+        {('other', 'app.a'): {'foo': 'bar'}}
+        {} (ahead)
+
+    The client gets new session data, also in the period its old session
+    data is in.
+
+        >>> data = sdc.get(('client', 'app.a'), when=T0)
+        >>> data.is_valid(), data
+        (True, {})
+        >>> sdc.search(('client', 'app.a'), when=T0) is data
+        True
+
+    Lazy managers store the new session data when the transaction commits.
+
+        >>> import transaction
+        >>> sdc.nonlazy = False
+        >>> sdc.invalidate_clients(['other'], when=T0)
+        1
+        >>> sdc.get(('other', 'app.a'), when=T0)['foo'] = 'baz'
+        >>> transaction.commit()
+        >>> sdc.search(('other', 'app.a'), when=T0)
+        {'foo': 'baz'}
+        >>> sdc.nonlazy = True
+
+    Session tells the manager about the principal of the request, the
+    session data of all the clients of a principal can be invalidated.
+
+        >>> class PrincipalStub(object):
+        ...     id = 'zope.user'
+        >>> request = TestRequest()
+        >>> request.setPrincipal(PrincipalStub())
+        >>> zope.component.provideUtility(sdc, interfaces.ISessionDataManager)
+        >>> session.Session(request)['app.a']['foo'] = 'bar'
+        >>> sorted([k for k in headBucket(sdc).keys() if len(k) == 3])
+        [(u'\x00principal', 'zope.user', 'foobar')]
+        >>> sdc.invalidate_principals(['zope.user'])
+        1
+
+    The principal is written into the head bucket again when the client
+    comes back after a period, not on every request.
+
+        >>> now = time.time()
+        >>> sdc.add_principal('zope.user', 'foobar', when=now)
+        >>> sdc.add_principal('zope.user', 'foobar', when=now + 600)
+        >>> len([k for k in headBucket(sdc, now + 600).keys()
+        ...      if len(k) == 3])
+        1
+
+    Session data invalidated by the application is replaced as well.
+
+        >>> data = session.Session(request)['app.c']
+        >>> data['foo'] = 'bar'
+        >>> data.invalidate()
+        >>> session.Session(request)['app.c']
+        {}
+
+    Principals expire with the buckets, gc() doesn't notify their end.
+
+        >>> from repoze.session.interfaces import ISessionEndEvent
+        >>> ended = []
+        >>> @zope.component.adapter(ISessionEndEvent)
+        ... def collectEnd(event):
+        ...     ended.append(event.session)
+        >>> zope.component.provideHandler(collectEnd)
+        >>> sdc.inline_gc = False
+        >>> sdc.gc(when=time.time() + 7200) > 0
+        True
+        >>> len(ended), [sdo for sdo in ended if sdo is True]
+        (2, [])
+        >>> sdc.invalidate_principals(['zope.user'], when=time.time() + 7200)
+        0
 
     """
 
@@ -0,0 +1,101 @@
+"""Tests of the write-back session"""
+
+import unittest
+
+import transaction
+import zope.component
+import zope.component.testing
+from zope.publisher.browser import TestRequest
+from zope.session.http import CookieClientIdManager
+from zope.session.interfaces import IClientIdManager
+
+from cipher.session import interfaces
+from cipher.session import metrics
+from cipher.session.tests.test_cookie import ClientIdStub
+
+
+class TestWriteBackSession(unittest.TestCase):
+
+    def setUp(self):
+        from cipher.session.session import SessionDataManager
+        zope.component.testing.setUp(self)
+        zope.component.provideAdapter(ClientIdStub)
+        zope.component.provideUtility(CookieClientIdManager(secret=u'sekrit'),
+                                      IClientIdManager)
+        self.sdm = SessionDataManager()
+        zope.component.provideUtility(self.sdm,
+                                      interfaces.ISessionDataManager)
+        transaction.begin()
+        self.sdo = self.sdm.get(('foobar', u'app'))
+        self.sdo['a'] = 1
+        self.lm = self.sdo.last_modified = 1000
+        transaction.commit()
+        metrics.reset()
+
+    def tearDown(self):
+        transaction.abort()
+        zope.component.testing.tearDown(self)
+
+    def _makeOne(self, request=None):
+        from cipher.session.writeback import WriteBackSession
+        return WriteBackSession(request or TestRequest())
+
+    def test_changes_are_written_on_commit(self):
+        session = self._makeOne()
+        data = session[u'app']
+        data['b'] = 2
+        data['c'] = 3
+        del data['a']
+        self.assertEqual(dict(self.sdo), {'a': 1})
+        self.assertEqual(session.get(u'app'), {'b': 2, 'c': 3})
+        transaction.commit()
+        self.assertEqual(dict(self.sdo), {'b': 2, 'c': 3})
+        self.assertNotEqual(self.sdo.last_modified, self.lm)
+        self.assertEqual(metrics.counters, {'writeback.flushed': 1})
+
+    def test_commit_twice(self):
+        data = self._makeOne()[u'app']
+        data['b'] = 2
+        transaction.commit()
+        data['c'] = 3
+        transaction.commit()
+        self.assertEqual(dict(self.sdo), {'a': 1, 'b': 2, 'c': 3})
+        self.assertEqual(metrics.counters, {'writeback.flushed': 2})
+
+    def test_no_net_change_is_not_written(self):
+        data = self._makeOne()[u'app']
+        data['a'] = 1
+        data['b'] = 2
+        del data['b']
+        transaction.commit()
+        self.assertEqual(dict(self.sdo), {'a': 1})
+        self.assertEqual(self.sdo.last_modified, self.lm)
+        self.assertEqual(metrics.counters, {'writeback.skipped': 1})
+
+    def test_same_overlay_per_request(self):
+        request = TestRequest()
+        data = self._makeOne(request)[u'app']
+        self.assertTrue(self._makeOne(request).get(u'app') is data)
+        self.assertTrue(
+            self._makeOne(request).get_many([u'app'])[u'app'] is data)
+        self.assertEqual(self._makeOne(request).get(u'other', 0), 0)
+
+    def test_abort(self):
+        self._makeOne()[u'app']['b'] = 2
+        transaction.abort()
+        self.assertEqual(dict(self.sdo), {'a': 1})
+
+    def test_invalidate(self):
+        data = self._makeOne()[u'app']
+        data['b'] = 2
+        data.invalidate()
+        self.assertFalse(data.is_valid())
+        transaction.commit()
+        self.assertEqual(dict(self.sdo), {'a': 1})
+        self.assertFalse(self.sdo.is_valid())
+
+
+def test_suite():
+    return unittest.TestSuite((
+        unittest.makeSuite(TestWriteBackSession),
+        ))
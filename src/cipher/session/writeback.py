@@ -0,0 +1,200 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Session data changes buffered until the transaction commits
+
+Register WriteBackSession instead of Session, e.g. in overrides.zcml::
+
+  <adapter
+      factory="cipher.session.writeback.WriteBackSession"
+      provides="zope.session.interfaces.ISession"
+      permission="zope.Public"
+      />
+"""
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+
+import zope.interface
+from repoze.session.interfaces import ISessionData
+
+from cipher.session import metrics
+from cipher.session import offload
+from cipher.session.session import OffloadingSessionData
+from cipher.session.session import Session, _beforeCommit, _differs, _marker
+
+
+@zope.interface.implementer(ISessionData)
+class SessionDataOverlay(MutableMapping):
+    """A request local copy of session data
+
+    Changes are applied to the session data by flush().  Values are not
+    copied: changing a mutable value in place changes it in the session
+    data too, but doesn't make the session data (or the overlay) modified.
+    Values OffloadingSessionData stored apart are loaded when read.
+
+    join, if given, is called when the overlay is changed, e.g. to flush it
+    when the transaction commits.
+    """
+
+    def __init__(self, sdo, join=None):
+        self.sdo = sdo
+        self._join = join
+        self.data = dict(sdo.data)
+        self._loaded = dict(self.data)
+        # keys whose values are still the SessionValue or Blob holding them
+        self._unread = set()
+        if isinstance(sdo, OffloadingSessionData):
+            self._unread.update([key for key, value in self.data.items()
+                                 if offload.isOffloaded(value)])
+
+    def __getitem__(self, key):
+        if key in self._unread:
+            self._unread.discard(key)
+            value = offload.loaded(self.data[key])
+            self.data[key] = self._loaded[key] = value
+        return self.data[key]
+
+    def __setitem__(self, key, value):
+        self._unread.discard(key)
+        self.data[key] = value
+        if self._join is not None:
+            self._join()
+
+    def __delitem__(self, key):
+        self._unread.discard(key)
+        del self.data[key]
+        if self._join is not None:
+            self._join()
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    has_key = __contains__
+
+    def __repr__(self):
+        return repr(self.copy())
+
+    def copy(self):
+        return dict(self.items())
+
+    def invalidate(self):
+        self.sdo.invalidate()
+
+    def is_valid(self):
+        return self.sdo.is_valid()
+
+    @property
+    def last_modified(self):
+        return self.sdo.last_modified
+
+    @property
+    def created(self):
+        return self.sdo.created
+
+    def changes(self):
+        """Return a dict of the changed keys and their values
+
+        Removed keys have the value _marker.
+        """
+        changed = {}
+        for key in set(self._loaded).union(self.data):
+            value = self.data.get(key, _marker)
+            if _differs(self._loaded.get(key, _marker), value):
+                changed[key] = value
+        return changed
+
+    def flush(self):
+        """Apply the changes to the session data
+
+        Return whether there were any.
+        """
+        changed = self.changes()
+        if not changed or not self.sdo.is_valid():
+            return False
+        removed = [key for key, value in changed.items()
+                   if value is _marker]
+        for key in removed:
+            del changed[key]
+            del self.sdo[key]
+        if changed:
+            self.sdo.update(changed)
+        self._loaded = dict(self.data)
+        return True
+
+
+class WriteBackSession(Session):
+    """Returns overlays of session data, changes are written once
+
+    Several changes of the session data of a package in one request write
+    it once, when the transaction commits.  Changes that end up where the
+    request started, or set values that were there already, don't write it
+    at all.
+    """
+
+    # the overlays of a request, (client_id, pkg_id) -> overlay, are kept in
+    # the request annotations under this key
+    overlayKey = 'cipher.session.overlays'
+
+    def __init__(self, request):
+        super(WriteBackSession, self).__init__(request)
+        overlays = request.annotations.get(self.overlayKey)
+        if overlays is None:
+            overlays = request.annotations[self.overlayKey] = {}
+        self._overlays = overlays
+        self._join()
+
+    def _join(self):
+        _beforeCommit(self._flush, self._overlays)
+
+    def _overlay(self, pkg_id, sdo):
+        ident = (self.client_id, pkg_id)
+        overlay = self._overlays.get(ident)
+        if overlay is None or overlay.sdo is not sdo:
+            overlay = self._overlays[ident] = SessionDataOverlay(
+                sdo, self._join)
+        return overlay
+
+    def get(self, pkg_id, default=None):
+        sdo = super(WriteBackSession, self).get(pkg_id, _marker)
+        if sdo is _marker:
+            return default
+        return self._overlay(pkg_id, sdo)
+
+    def get_many(self, pkg_ids, default=None):
+        result = super(WriteBackSession, self).get_many(pkg_ids, _marker)
+        for pkg_id, sdo in result.items():
+            if sdo is _marker:
+                result[pkg_id] = default
+            else:
+                result[pkg_id] = self._overlay(pkg_id, sdo)
+        return result
+
+    def __getitem__(self, pkg_id):
+        sdo = super(WriteBackSession, self).__getitem__(pkg_id)
+        return self._overlay(pkg_id, sdo)
+
+    @staticmethod
+    def _flush(overlays):
+        for overlay in overlays.values():
+            if overlay.flush():
+                metrics.incr('writeback.flushed')
+            else:
+                metrics.incr('writeback.skipped')
@@ -0,0 +1,150 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""ZCML directives
+"""
+import zope.interface
+import zope.schema
+from zope.component.zcml import utility
+from zope.configuration.fields import GlobalObject, Path
+
+from cipher.session.external import SQLiteSessionDataManager
+from cipher.session.interfaces import ISessionDataManager
+from cipher.session.interfaces import ISessionLookupCache
+from cipher.session.lookupcache import SQLiteLookupCache
+from cipher.session.memory import MemorySessionDataManager
+from cipher.session.policy import registerConflictPolicy
+
+
+class IConflictPolicyDirective(zope.interface.Interface):
+    """Register a conflict policy for session data keys"""
+
+    policy = GlobalObject(
+        title=u"Policy",
+        description=u"An IConflictPolicy, e.g. "
+                    u"cipher.session.policy.lastWriterWins",
+        required=True)
+
+    pkg_id = zope.schema.TextLine(
+        title=u"Session package id",
+        description=u"Limit the policy to the data of this package",
+        required=False)
+
+    prefix = zope.schema.TextLine(
+        title=u"Key prefix",
+        description=u"Limit the policy to keys starting with this prefix",
+        required=False,
+        default=u'')
+
+
+def conflictPolicy(_context, policy, pkg_id=None, prefix=u''):
+    _context.action(
+        discriminator=('cipher.session.conflictPolicy', pkg_id, prefix),
+        callable=registerConflictPolicy,
+        args=(policy, pkg_id, prefix),
+        )
+
+
+class ISessionDataManagerDirective(zope.interface.Interface):
+
+    name = zope.schema.TextLine(
+        title=u"Package id",
+        description=u"Register it for the session data of this package "
+                    u"only, instead of as the default manager",
+        required=False,
+        default=u'')
+
+
+class ISQLiteSessionDataManagerDirective(ISessionDataManagerDirective):
+    """Register an SQLiteSessionDataManager as the ISessionDataManager"""
+
+    file = Path(
+        title=u"Database file",
+        description=u"Created if it doesn't exist",
+        required=True)
+
+    timeout = zope.schema.Int(
+        title=u"Timeout (seconds)",
+        required=False,
+        default=60 * 60,
+        min=1)
+
+    period = zope.schema.Int(
+        title=u"Timeout resolution (in seconds)",
+        required=False,
+        default=10 * 60,
+        min=1)
+
+    compress_threshold = zope.schema.Int(
+        title=u"Compress values of at least (bytes)",
+        required=False,
+        min=1)
+
+
+def sqliteSessionDataManager(_context, file, timeout=60 * 60,
+                             period=10 * 60, name=u'',
+                             compress_threshold=None):
+    sdm = SQLiteSessionDataManager(file, timeout=timeout, period=period,
+                                   compress_threshold=compress_threshold)
+    utility(_context, provides=ISessionDataManager, component=sdm, name=name)
+
+
+class IMemorySessionDataManagerDirective(ISessionDataManagerDirective):
+    """Register a MemorySessionDataManager as the ISessionDataManager"""
+
+    timeout = zope.schema.Int(
+        title=u"Timeout (seconds)",
+        required=False,
+        default=60 * 60,
+        min=1)
+
+    period = zope.schema.Int(
+        title=u"Timeout resolution (in seconds)",
+        required=False,
+        default=10 * 60,
+        min=1)
+
+    shards = zope.schema.Int(
+        title=u"Lock shards",
+        required=False,
+        default=16,
+        min=1)
+
+    max_sessions = zope.schema.Int(
+        title=u"Maximum number of sessions",
+        description=u"The least recently used are dropped beyond that",
+        required=False,
+        default=100000,
+        min=1)
+
+
+def memorySessionDataManager(_context, timeout=60 * 60, period=10 * 60,
+                             shards=16, max_sessions=100000, name=u''):
+    sdm = MemorySessionDataManager(timeout=timeout, period=period,
+                                   shards=shards, max_sessions=max_sessions)
+    utility(_context, provides=ISessionDataManager, component=sdm, name=name)
+
+
+class ILookupCacheDirective(zope.interface.Interface):
+    """Register an SQLiteLookupCache as the ISessionLookupCache"""
+
+    file = Path(
+        title=u"Cache file",
+        description=u"Shared by the processes of a host, created if it "
+                    u"doesn't exist",
+        required=True)
+
+
+def lookupCache(_context, file):
+    cache = SQLiteLookupCache(file)
+    utility(_context, provides=ISessionLookupCache, component=cache)